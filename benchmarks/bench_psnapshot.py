@@ -0,0 +1,173 @@
+"""Benchmark of psnapshot's scan, clone, find, rotate and expire phases on a synthetic source tree.
+
+Run from repository root, e.g.::
+
+    python benchmarks/bench_psnapshot.py --files 100000 --depth 3 --fanout 10 --output bench.json
+
+Calls counted per phase are calls of the wrapped ``os`` functions made from Python. Stat calls hidden inside
+``os.DirEntry`` are not included.
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from psnapshot.clone import TreeCloner  # noqa: E402
+from psnapshot.snapshot import Organizer, Queue, Snapshot  # noqa: E402
+
+COUNTED_FUNCTIONS = ('stat', 'lstat', 'scandir', 'listdir', 'open', 'link', 'mkdir', 'rename', 'unlink', 'rmdir', 'chmod', 'utime')
+
+
+class CallCounter:
+    """Counts calls of selected os functions while active."""
+
+    def __init__(self, names=COUNTED_FUNCTIONS):
+        self.names = names
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._originals = {}
+
+    def _wrap(self, name, function):
+        @functools.wraps(function)
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.counts[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        self.counts.clear()
+        for name in self.names:
+            self._originals[name] = getattr(os, name)
+            setattr(os, name, self._wrap(name, self._originals[name]))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, function in self._originals.items():
+            setattr(os, name, function)
+
+
+def generate_tree(root, files, depth, fanout):
+    """Creates directory tree with given depth and fan-out and spreads the files evenly over all directories."""
+    dirs = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(parent, 'd{}'.format(i)) for parent in level for i in range(fanout)]
+        dirs.extend(level)
+
+    for relpath in dirs:
+        os.makedirs(os.path.join(root, relpath), exist_ok=True)
+
+    for index in range(files):
+        path = os.path.join(root, dirs[index % len(dirs)], 'f{}'.format(index))
+        with open(path, 'w') as file:
+            file.write(str(index))
+
+    return len(dirs)
+
+
+class Benchmark:
+    """Times the phases of psnapshot on a synthetic tree.
+
+    :ivar files: Number of files in synthetic tree.
+    :ivar results: Result per phase.
+    """
+
+    def __init__(self, workdir, files, depth, fanout, snapshots):
+        self.files = files
+        self.snapshots = snapshots
+        self.srcdir = os.path.join(workdir, 'src')
+        self.dstdir = os.path.join(workdir, 'dst')
+        self.results = collections.OrderedDict()
+
+        os.mkdir(self.dstdir)
+        self.directories = generate_tree(self.srcdir, files, depth, fanout)
+
+    @contextlib.contextmanager
+    def phase(self, name, count, unit):
+        with CallCounter() as counter:
+            start = time.perf_counter()
+            yield
+            seconds = time.perf_counter() - start
+
+        throughput = count / seconds if seconds else None
+        self.results[name] = {
+            'seconds': seconds,
+            'count': count,
+            'unit': unit,
+            'per_second': throughput,
+            'calls': dict(counter.counts),
+        }
+        print('{:<10} {:>10.3f} s {:>14.0f} {}/s'.format(name, seconds, throughput or 0, unit), file=sys.stderr)
+
+    def run(self):
+        # older snapshots to rotate, the queue is full so every push expires one of them:
+        base = datetime.datetime(2000, 1, 1)
+        for day in range(self.snapshots):
+            TreeCloner(self.srcdir, os.path.join(self.dstdir, Snapshot.build_name('daily', base + datetime.timedelta(days=day)))).clone()
+
+        organizer = Organizer(self.srcdir, self.dstdir, [Queue('daily', 1, self.snapshots)])
+
+        with self.phase('scan', self.files, 'files'):
+            organizer.srcdir_time
+
+        with self.phase('find', self.snapshots, 'snapshots'):
+            organizer.find_snapshots()
+
+        with self.phase('find-index', self.snapshots, 'snapshots'):
+            organizer.find_snapshots()
+
+        with self.phase('create', self.files, 'files'):
+            snapshot = organizer.create_snapshot()
+
+        with self.phase('push', self.snapshots, 'snapshots'):
+            organizer.push(snapshot)
+
+        # the snapshot expired by push and another one are reaped:
+        with self.phase('expire', 2 * self.files, 'files'):
+            organizer.queues[0].snapshots[-1].delete()
+            organizer.reap_trash()
+
+    def report(self):
+        return {
+            'shape': {'files': self.files, 'directories': self.directories, 'snapshots': self.snapshots},
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'phases': self.results,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks psnapshot phases on a synthetic source tree.')
+    parser.add_argument('--files', help='Number of files in source tree.', type=int, default=20000)
+    parser.add_argument('--depth', help='Depth of directory tree.', type=int, default=3)
+    parser.add_argument('--fanout', help='Number of subdirectories per directory.', type=int, default=8)
+    parser.add_argument('--snapshots', help='Number of existing snapshots in queue.', type=int, default=3)
+    parser.add_argument('--workdir', help='Directory for temporary trees, must be on the file system to benchmark.')
+    parser.add_argument('--output', help='JSON file to write results to, default is standard output.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir, prefix='psnapshot-bench-') as workdir:
+        benchmark = Benchmark(workdir, args.files, args.depth, args.fanout, args.snapshots)
+        benchmark.run()
+        report = benchmark.report()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""Export of expired snapshots into compressed tar archives before they are deleted."""
+import functools
+import grp
+import gzip
+import logging
+import lzma
+import os
+import pwd
+import queue
+import stat as statmod
+import tarfile
+import threading
+
+from psnapshot.state import state_path
+
+_logger = logging.getLogger(__name__)
+
+STAGING_DIRNAME = 'archive'
+
+COMPRESSIONS = {
+    'xz': lambda file: lzma.LZMAFile(file, 'wb'),
+    'gz': lambda file: gzip.GzipFile(filename='', mode='wb', fileobj=file),
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def staging_path(dstdir, *names):
+    """Returns path of folder in state folder, where expired snapshots wait to be archived."""
+    return state_path(dstdir, STAGING_DIRNAME, *names)
+
+
+def archive_filename(name, compression):
+    return '{}.tar.{}'.format(name, compression)
+
+
+@functools.lru_cache(maxsize=256)
+def _user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ''
+
+
+@functools.lru_cache(maxsize=256)
+def _group_name(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ''
+
+
+class _Stopped(Exception):
+    pass
+
+
+class ArchiveExporter:
+    """Streams a directory tree into a compressed tar archive in PAX format.
+
+    Reading files and compressing run in separate threads, connected by a bounded queue of chunks, so memory does not
+    grow with file sizes and compression, which releases the GIL, overlaps with reading. Files hard-linked to an
+    inode already archived are stored as hard link entries. To find those, the archive name of each inode with more
+    than one link is kept until the export completes.
+
+    The archive is written under a temporary name and only renamed to its final name once it is complete.
+
+    :ivar path: Path of archive to be created.
+    :ivar compression: Compression, a key of COMPRESSIONS.
+    :ivar queue_size: Maximum number of chunks read ahead of compression.
+    :ivar files: Number of files archived, without hard link entries.
+    :ivar links: Number of hard link entries.
+    :ivar bytes: Size of file content archived.
+    """
+
+    def __init__(self, path, compression='xz', queue_size=16):
+        self.path = path
+        self.compression = compression
+        self.queue_size = queue_size
+        self.files = 0
+        self.links = 0
+        self.bytes = 0
+
+        self._queue = None
+        self._stop = threading.Event()
+        self._offset = 0
+
+    def export(self, root, arcname):
+        """Archives tree at root under given top-level name."""
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._stop.clear()
+        self._offset = 0
+        reader = threading.Thread(target=self._read, args=(root, arcname), name='archive-reader', daemon=True)
+
+        part_path = self.path + '.part'
+        try:
+            with open(part_path, 'wb') as file:
+                with COMPRESSIONS[self.compression](file) as compressed:
+                    reader.start()
+                    while True:
+                        chunk = self._queue.get()
+                        if chunk is None:
+                            break
+                        if isinstance(chunk, BaseException):
+                            raise chunk
+                        compressed.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(part_path, self.path)
+        except BaseException:
+            self._stop.set()
+            if os.path.lexists(part_path):
+                os.unlink(part_path)
+            raise
+        finally:
+            if reader.is_alive():
+                reader.join()
+
+    def _put(self, chunk):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                self._queue.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _read(self, root, arcname):
+        try:
+            inodes = {}
+            for path, name in self._entries(root, arcname):
+                self._add(path, name, inodes)
+            # end of archive marker, padded to full record as tarfile does:
+            end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+            self._put(end + tarfile.NUL * (-(self._offset + len(end)) % tarfile.RECORDSIZE))
+            self._put(None)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            try:
+                self._put(e)
+            except _Stopped:
+                pass
+
+    @staticmethod
+    def _entries(root, arcname):
+        """Yields paths and archive names of all entries below root, each directory before its content, streaming
+        directory entries instead of listing them."""
+        yield root, arcname
+        stack = [(os.scandir(root), arcname)]
+        try:
+            while stack:
+                entries, dirname = stack[-1]
+                entry = next(entries, None)
+                if entry is None:
+                    entries.close()
+                    stack.pop()
+                    continue
+                name = dirname + '/' + entry.name
+                yield entry.path, name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((os.scandir(entry.path), name))
+        finally:
+            for entries, _ in stack:
+                entries.close()
+
+    def _add(self, path, name, inodes):
+        stat = os.lstat(path)
+        info = tarfile.TarInfo(name)
+        info.mode = statmod.S_IMODE(stat.st_mode)
+        info.uid = stat.st_uid
+        info.gid = stat.st_gid
+        info.uname = _user_name(stat.st_uid)
+        info.gname = _group_name(stat.st_gid)
+        info.mtime = stat.st_mtime
+
+        size = 0
+        if statmod.S_ISREG(stat.st_mode):
+            inode = (stat.st_dev, stat.st_ino)
+            if inode in inodes:
+                info.type = tarfile.LNKTYPE
+                info.linkname = inodes[inode]
+                self.links += 1
+            else:
+                if stat.st_nlink > 1:
+                    inodes[inode] = name
+                info.size = size = stat.st_size
+                self.files += 1
+        elif statmod.S_ISDIR(stat.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif statmod.S_ISLNK(stat.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif statmod.S_ISFIFO(stat.st_mode):
+            info.type = tarfile.FIFOTYPE
+        elif statmod.S_ISCHR(stat.st_mode) or statmod.S_ISBLK(stat.st_mode):
+            info.type = tarfile.CHRTYPE if statmod.S_ISCHR(stat.st_mode) else tarfile.BLKTYPE
+            info.devmajor = os.major(stat.st_rdev)
+            info.devminor = os.minor(stat.st_rdev)
+        else:
+            _logger.warning('Not archiving {}, which is a socket or of unknown type.'.format(path))
+            return
+
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        self._put(header)
+        self._offset += len(header)
+        if size:
+            self._put_content(path, size)
+
+    def _put_content(self, path, size):
+        remaining = size
+        with open(path, 'rb') as file:
+            while remaining:
+                chunk = file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    # snapshots are not modified, but the header cannot be changed anymore anyway:
+                    _logger.warning('File {} shrank while being archived, padding it.'.format(path))
+                    chunk = tarfile.NUL * remaining
+                remaining -= len(chunk)
+                if not remaining:
+                    chunk += tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+                self._put(chunk)
+                self._offset += len(chunk)
+        self.bytes += size
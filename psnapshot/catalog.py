@@ -0,0 +1,172 @@
+"""Catalog of file versions across all snapshots of a destination directory."""
+import collections
+import logging
+import os
+import re
+import sqlite3
+
+from psnapshot.exclude import translate
+from psnapshot.verify import list_files
+from psnapshot.walk import DEFAULT_WORKERS
+
+_logger = logging.getLogger(__name__)
+
+Version = collections.namedtuple('Version', 'path size mtime_ns first last snapshots')
+Version.__doc__ = """File version held by the snapshots taken from first to last, given as timestamps."""
+
+Match = collections.namedtuple('Match', 'path versions first last')
+Match.__doc__ = """Path found in the catalog with its number of versions and timestamps of first and last snapshot holding it."""
+
+
+def _timestamp(snapshot):
+    return '{:%Y%m%d%H%M%S}'.format(snapshot.time)
+
+
+def _regexp(expression, text):
+    return re.match(expression, text, re.DOTALL) is not None
+
+
+# file name of a path in SQL, what remains after trimming all characters but slashes from its end:
+_NAME_SQL = "substr(path, length(rtrim(path, replace(path, '/', ''))) + 1)"
+
+
+def _name_glob(pattern):
+    """Returns SQLite GLOB matching the file names a gitignore pattern can match, or None if it cannot tell."""
+    name = pattern.rsplit('/', 1)[-1]
+    if not name or '**' in name or '\\' in name or re.search(r'\[(?![^\]]+\])', name):
+        return None
+    return name.replace('[!', '[^')
+
+
+class Catalog:
+    """Persistent catalog of all file versions in the snapshots of a destination directory.
+
+    Unchanged files share their inode between snapshots, so a version is stored once as inode, size and modification
+    time of a path, along with the range of snapshots holding it. A version is held by all catalogued snapshots taken
+    from its first to its last snapshot. Adding a snapshot extends the versions held by the newest one so far that it
+    holds as well, expiring a snapshot only shrinks ranges starting or ending with it. Snapshots are identified by
+    timestamp, so the catalog stays valid when they move between queues.
+
+    :ivar path: Path to SQLite database.
+    :ivar workers: Number of threads listing snapshots.
+    :ivar added: Number of snapshots added by the last update.
+    :ivar expired: Number of snapshots dropped by the last update.
+    """
+
+    FILENAME = 'catalog.sqlite'
+
+    def __init__(self, path, workers=DEFAULT_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.added = 0
+        self.expired = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.create_function('REGEXP', 2, _regexp, deterministic=True)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS snapshots (timestamp TEXT PRIMARY KEY)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS paths (id INTEGER PRIMARY KEY, path TEXT UNIQUE, name TEXT)')
+            if 'name' not in [row[1] for row in self._db.execute('PRAGMA table_info(paths)')]:
+                self._db.execute('ALTER TABLE paths ADD COLUMN name TEXT')
+                self._db.execute('UPDATE paths SET name = {}'.format(_NAME_SQL))
+            self._db.execute('CREATE INDEX IF NOT EXISTS paths_name ON paths (name)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS versions (path_id INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                             'first TEXT, last TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS versions_path ON versions (path_id)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS versions_first ON versions (first)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS versions_last ON versions (last)')
+
+    def close(self):
+        self._db.close()
+
+    def timestamps(self):
+        return [row[0] for row in self._db.execute('SELECT timestamp FROM snapshots ORDER BY timestamp')]
+
+    def update(self, snapshots):
+        """Drops snapshots that no longer exist and adds new ones, oldest first.
+
+        Snapshots are only added after the newest one catalogued. If an older one is missing, the catalog is rebuilt.
+        """
+        self.added = 0
+        self.expired = 0
+        current = {_timestamp(snapshot): snapshot for snapshot in snapshots}
+
+        known = self.timestamps()
+        for timestamp in known:
+            if timestamp not in current:
+                self._expire(timestamp)
+        known = [timestamp for timestamp in known if timestamp in current]
+
+        new = sorted(timestamp for timestamp in current if timestamp not in known)
+        if new and known and new[0] < known[-1]:
+            _logger.info('Snapshot {} is older than catalogued snapshots, rebuilding catalog.'.format(current[new[0]].name))
+            self._clear()
+            new = sorted(current)
+
+        for timestamp in new:
+            self._add(timestamp, current[timestamp])
+
+    def _clear(self):
+        with self._db:
+            self._db.execute('DELETE FROM versions')
+            self._db.execute('DELETE FROM paths')
+            self._db.execute('DELETE FROM snapshots')
+
+    def _add(self, timestamp, snapshot):
+        _logger.info('Adding snapshot {} to catalog.'.format(snapshot.name))
+        files = list_files(snapshot.dirpath, self.workers)
+        previous = self._db.execute('SELECT MAX(timestamp) FROM snapshots').fetchone()[0]
+
+        # the table is created outside the transaction, so it may be left over by a failed addition:
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS current (path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, mtime_ns INTEGER)')
+        with self._db:
+            self._db.execute('DELETE FROM current')
+            self._db.executemany('INSERT INTO current VALUES (?, ?, ?, ?)', ((path,) + key[1:] for path, key in files.items()))
+            self._db.execute('INSERT OR IGNORE INTO paths (path, name) SELECT path, {} FROM current'.format(_NAME_SQL))
+
+            # versions unchanged since the previous snapshot are extended to the new one:
+            self._db.execute('UPDATE versions SET last = ? WHERE last = ? AND EXISTS (SELECT 1 FROM current JOIN paths '
+                             'ON paths.path = current.path WHERE paths.id = versions.path_id AND current.ino = versions.ino '
+                             'AND current.size = versions.size AND current.mtime_ns = versions.mtime_ns)', (timestamp, previous))
+            self._db.execute('INSERT INTO versions SELECT paths.id, current.ino, current.size, current.mtime_ns, ?, ? FROM current '
+                             'JOIN paths ON paths.path = current.path WHERE NOT EXISTS (SELECT 1 FROM versions '
+                             'WHERE versions.path_id = paths.id AND versions.last = ?)', (timestamp, timestamp, timestamp))
+            self._db.execute('INSERT INTO snapshots VALUES (?)', (timestamp,))
+            self._db.execute('DELETE FROM current')
+        self.added += 1
+
+    def _expire(self, timestamp):
+        _logger.info('Dropping expired snapshot {} from catalog.'.format(timestamp))
+        with self._db:
+            self._db.execute('DELETE FROM snapshots WHERE timestamp = ?', (timestamp,))
+            self._db.execute('DELETE FROM versions WHERE first = ? AND last = ?', (timestamp, timestamp))
+            # ranges only shrink at their ends, snapshots within a range remain covered:
+            self._db.execute('UPDATE versions SET first = (SELECT MIN(timestamp) FROM snapshots WHERE timestamp > ?) WHERE first = ?',
+                             (timestamp, timestamp))
+            self._db.execute('UPDATE versions SET last = (SELECT MAX(timestamp) FROM snapshots WHERE timestamp < ?) WHERE last = ?',
+                             (timestamp, timestamp))
+            self._db.execute('DELETE FROM paths WHERE NOT EXISTS (SELECT 1 FROM versions WHERE versions.path_id = paths.id)')
+        self.expired += 1
+
+    def history(self, path):
+        """Returns all versions of file at path relative to the snapshot root, oldest first."""
+        path = os.path.normpath(path).lstrip(os.sep)
+        rows = self._db.execute('SELECT paths.path, size, mtime_ns, first, last, (SELECT COUNT(*) FROM snapshots WHERE timestamp '
+                                'BETWEEN first AND last) FROM versions JOIN paths ON paths.id = versions.path_id WHERE paths.path = ? '
+                                'ORDER BY first', (path,))
+        return [Version(*row) for row in rows]
+
+    def find(self, pattern):
+        """Returns paths matching a pattern in gitignore syntax, see psnapshot.exclude, sorted by path.
+
+        File names are matched first with GLOB, which uses the index of file names for a literal prefix and otherwise
+        runs within SQLite, so the regular expression only checks paths with a matching name.
+        """
+        pattern = pattern.rstrip('/')
+        # CROSS JOIN makes SQLite filter paths before looking up their versions, and the unary plus keeps it from
+        # walking paths in id order for grouping instead of using the index of file names:
+        rows = self._db.execute('SELECT paths.path, COUNT(*), MIN(first), MAX(last) FROM paths CROSS JOIN versions ON versions.path_id = paths.id '
+                                'WHERE paths.name GLOB ? AND paths.path REGEXP ? GROUP BY +paths.id ORDER BY paths.path',
+                                (_name_glob(pattern) or '*', '(?:{})\\Z'.format(translate(pattern))))
+        return [Match(*row) for row in rows]
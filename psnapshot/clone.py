@@ -0,0 +1,351 @@
+"""Parallel creation of hard-linked directory tree copies."""
+import collections
+import errno
+import fcntl
+import logging
+import os
+import stat as statmod
+import threading
+
+from psnapshot.exceptions import CloneError
+from psnapshot.exclude import NO_EXCLUDES
+from psnapshot.remove import TreeRemover
+from psnapshot.walk import DEFAULT_WORKERS, DIR_FLAGS, DirectoryRecord, opened_directory, walk_parallel
+
+_logger = logging.getLogger(__name__)
+
+# ioctl sharing all extents of a file with another one, see ioctl_ficlone(2):
+FICLONE = 0x40049409
+
+# errors of os.link that are not solved by retrying, but by copying the file instead:
+LINK_FALLBACK_ERRORS = (errno.EMLINK, errno.EXDEV)
+
+# errors telling that a copy method is not available for the given files:
+_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+BUFFERED = 'buffered'
+SPECIAL = 'special'
+
+
+def copy_file(name, src_dir_fd, dst_dir_fd, dst_name=None):
+    """Copies file between directories given by descriptors along with its permissions and times, returns copy method used.
+
+    Data is shared by a reflink where the file system supports it, otherwise copied in kernel by ``copy_file_range`` and
+    only if neither is possible copied through a buffer. The copy has the same name unless another one is given.
+
+    Like hard links, symbolic links are followed. FIFOs, sockets and devices are never opened, which could block or have
+    side effects, but created anew by copy_special.
+    """
+    dst_name = dst_name or name
+    stat = os.stat(name, dir_fd=src_dir_fd)
+    if not statmod.S_ISREG(stat.st_mode):
+        return copy_special(stat, dst_dir_fd, dst_name)
+
+    # not blocking, should the file have been replaced by a FIFO since:
+    src_fd = os.open(name, os.O_RDONLY | os.O_NONBLOCK, dir_fd=src_dir_fd)
+    try:
+        stat = os.fstat(src_fd)
+        if not statmod.S_ISREG(stat.st_mode):
+            raise OSError(errno.EINVAL, 'File was replaced by a special file', name)
+        dst_fd = os.open(dst_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600, dir_fd=dst_dir_fd)
+        try:
+            method = _copy_data(src_fd, dst_fd, stat.st_size)
+            try:
+                os.fchown(dst_fd, stat.st_uid, stat.st_gid)
+            except PermissionError:
+                # unprivileged runs keep their own ownership, like shutil.copy2:
+                pass
+            os.fchmod(dst_fd, statmod.S_IMODE(stat.st_mode))
+            os.utime(dst_fd, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        except BaseException:
+            os.close(dst_fd)
+            os.unlink(dst_name, dir_fd=dst_dir_fd)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    return method
+
+
+def chown_if_permitted(name, uid, gid, dir_fd):
+    """Changes owner of entry in directory given by descriptor, not following symbolic links. Unprivileged runs keep
+    their own ownership, like shutil.copy2."""
+    try:
+        os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+    except PermissionError:
+        pass
+
+
+def copy_special(stat, dst_dir_fd, dst_name):
+    """Creates FIFO, socket or device file of given status in directory given by descriptor, with its permissions and
+    times. Device files can only be created with privileges. Returns copy method SPECIAL."""
+    if statmod.S_ISFIFO(stat.st_mode):
+        os.mkfifo(dst_name, 0o600, dir_fd=dst_dir_fd)
+    else:
+        os.mknod(dst_name, statmod.S_IFMT(stat.st_mode) | 0o600, stat.st_rdev, dir_fd=dst_dir_fd)
+    try:
+        chown_if_permitted(dst_name, stat.st_uid, stat.st_gid, dst_dir_fd)
+        os.chmod(dst_name, statmod.S_IMODE(stat.st_mode), dir_fd=dst_dir_fd)
+        os.utime(dst_name, ns=(stat.st_atime_ns, stat.st_mtime_ns), dir_fd=dst_dir_fd)
+    except BaseException:
+        os.unlink(dst_name, dir_fd=dst_dir_fd)
+        raise
+    return SPECIAL
+
+
+def _copy_data(src_fd, dst_fd, size):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return REFLINK
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRORS:
+            raise
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copied = 0
+            while copied < size:
+                count = os.copy_file_range(src_fd, dst_fd, size - copied)
+                if not count:
+                    break
+                copied += count
+            return COPY_FILE_RANGE
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRORS:
+                raise
+            # start over, a part may have been copied already:
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+
+    while True:
+        data = os.read(src_fd, COPY_BUFFER_SIZE)
+        if not data:
+            return BUFFERED
+        os.write(dst_fd, data)
+
+
+class TreeCloner:
+    """Creates a copy of a directory tree in which all files are hard links to the source files.
+
+    Directories are processed concurrently on a thread pool. Within a directory, all system calls are relative to open
+    directory descriptors, so long paths are not resolved again for every file. Directory permissions and times are
+    copied along with their owner in a final pass, after no more links are added to them.
+
+    Symbolic links are handled like ``shutil.copytree`` does by default: links to files are replaced by hard links to
+    the target, links to directories are copied as directories. Optionally they are copied as symbolic links instead.
+
+    Files that cannot be hard-linked because they reached the file system's link limit or live on another file system
+    are copied instead, see copy_file. Linking can be turned off to copy all files, e.g. when restoring from a snapshot
+    to another file system.
+
+    Excluded entries are left out and excluded directories are not entered, see psnapshot.exclude.
+
+    A copy left incomplete by an interrupted run can be resumed. Then existing links to the current source files are
+    kept, stale or missing ones are replaced and entries no longer in the source or excluded by now are removed.
+
+    :ivar srcdir: Path to source directory tree.
+    :ivar dstdir: Path of copy to be created, must not exist yet unless resuming.
+    :ivar workers: Number of directories processed concurrently.
+    :ivar resume: Whether an existing, incomplete copy at dstdir is completed.
+    :ivar exclude: Exclude rules.
+    :ivar link: Whether files are hard-linked, otherwise all files are copied.
+    :ivar symlinks: Whether symbolic links are copied as links rather than followed.
+    :ivar directories: Number of directories created.
+    :ivar links: Number of hard links created.
+    :ivar copies: Number of files copied instead of linked, by copy method.
+    :ivar bytes_copied: Size of files copied.
+    :ivar reused: Number of files of an incomplete copy that were kept.
+    """
+
+    def __init__(self, srcdir, dstdir, workers=DEFAULT_WORKERS, resume=False, exclude=NO_EXCLUDES, link=True, symlinks=False):
+        self.srcdir = srcdir
+        self.dstdir = dstdir
+        self.workers = workers
+        self.resume = resume
+        self.exclude = exclude
+        self.link = link
+        self.symlinks = symlinks
+        self.directories = 0
+        self.links = 0
+        self.copies = collections.Counter()
+        self.bytes_copied = 0
+        self.reused = 0
+
+        self._lock = threading.Lock()
+        self._src_fd = None
+        self._dst_fd = None
+        self._failed = False
+
+    def clone(self):
+        """Creates the copy, raises CloneError after the first failure."""
+        try:
+            os.mkdir(self.dstdir)
+        except FileExistsError:
+            if not self.resume:
+                raise
+
+        self._src_fd = os.open(self.srcdir, DIR_FLAGS)
+        try:
+            self._dst_fd = os.open(self.dstdir, DIR_FLAGS)
+            try:
+                created = [DirectoryRecord.from_stat(os.curdir, os.stat(self._src_fd))]
+                for subdirs in walk_parallel(self._clone_directory, [os.curdir], self.workers):
+                    created.extend(subdirs)
+
+                if self._failed:
+                    raise CloneError('Hard-linked copy of {} is incomplete.'.format(self.srcdir))
+
+                # children are created after their parents, so this restores times bottom-up:
+                for record in reversed(created):
+                    chown_if_permitted(record.relpath, record.uid, record.gid, self._dst_fd)
+                    os.chmod(record.relpath, statmod.S_IMODE(record.mode), dir_fd=self._dst_fd)
+                    os.utime(record.relpath, ns=(record.atime_ns, record.mtime_ns), dir_fd=self._dst_fd)
+            finally:
+                os.close(self._dst_fd)
+        finally:
+            os.close(self._src_fd)
+
+    def _clone_directory(self, relpath):
+        """Links files of a single directory and creates its subdirectories, returned as records of their source status."""
+        if self._failed:
+            return [], []
+
+        subdirs = []
+        directories = 0
+        links = 0
+        reused = 0
+        copies = collections.Counter()
+        bytes_copied = 0
+        try:
+            if self.resume:
+                # an interrupted run may have copied permissions of a read-only source directory already:
+                os.chmod(relpath, statmod.S_IRWXU, dir_fd=self._dst_fd)
+
+            with opened_directory(relpath, self._src_fd) as src_fd, opened_directory(relpath, self._dst_fd) as dst_fd:
+                with os.scandir(src_fd) as entries:
+                    for entry in entries:
+                        is_dir = entry.is_dir()
+                        if self.exclude and self.exclude.excluded(relpath, entry.name, is_dir):
+                            continue
+                        if self.symlinks and entry.is_symlink():
+                            self._copy_symlink(relpath, entry.name, src_fd, dst_fd)
+                            continue
+                        if is_dir:
+                            if not (self.resume and self._keep_directory(entry.name, dst_fd)):
+                                os.mkdir(entry.name, dir_fd=dst_fd)
+                                directories += 1
+                            subdirs.append(DirectoryRecord.from_stat(os.path.join(relpath, entry.name), entry.stat()))
+                            continue
+
+                        try:
+                            linked = self._link(relpath, entry.name, src_fd, dst_fd, copies)
+                        except FileExistsError:
+                            if not self.resume:
+                                raise
+                            if self._is_current(entry, dst_fd):
+                                reused += 1
+                                continue
+                            self._remove(relpath, entry.name, dst_fd)
+                            linked = self._link(relpath, entry.name, src_fd, dst_fd, copies)
+                        if linked:
+                            links += 1
+                        else:
+                            bytes_copied += entry.stat().st_size
+
+                if self.resume:
+                    self._remove_vanished(relpath, src_fd, dst_fd)
+        except OSError as e:
+            # reported right away, but only stops scheduling of further directories:
+            _logger.error('Cannot copy {}: {}'.format(os.path.join(self.srcdir, relpath), e))
+            self._failed = True
+
+        with self._lock:
+            self.directories += directories
+            self.links += links
+            self.reused += reused
+            self.copies.update(copies)
+            self.bytes_copied += bytes_copied
+
+        return subdirs, [record.relpath for record in subdirs]
+
+    def _link(self, relpath, name, src_fd, dst_fd, copies):
+        """Links file into copy or, if it cannot be linked, copies it and counts the copy method. Returns whether it was linked."""
+        if not self.link:
+            copies[copy_file(name, src_fd, dst_fd)] += 1
+            return False
+        try:
+            os.link(name, name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+            return True
+        except OSError as e:
+            if e.errno not in LINK_FALLBACK_ERRORS:
+                raise
+            method = copy_file(name, src_fd, dst_fd)
+            _logger.debug('Copied %s by %s, cannot link it: %s', os.path.join(relpath, name), method, e)
+            copies[method] += 1
+            return False
+
+    def _copy_symlink(self, relpath, name, src_fd, dst_fd):
+        target = os.readlink(name, dir_fd=src_fd)
+        try:
+            os.symlink(target, name, dir_fd=dst_fd)
+        except FileExistsError:
+            if not self.resume:
+                raise
+            self._remove(relpath, name, dst_fd)
+            os.symlink(target, name, dir_fd=dst_fd)
+        stat = os.stat(name, dir_fd=src_fd, follow_symlinks=False)
+        chown_if_permitted(name, stat.st_uid, stat.st_gid, dst_fd)
+        os.utime(name, ns=(stat.st_atime_ns, stat.st_mtime_ns), dir_fd=dst_fd, follow_symlinks=False)
+
+    def _keep_directory(self, name, dst_fd):
+        """Returns whether a directory of an incomplete copy exists, removing anything else in its place."""
+        try:
+            stat = os.stat(name, dir_fd=dst_fd, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        if statmod.S_ISDIR(stat.st_mode):
+            return True
+        os.unlink(name, dir_fd=dst_fd)
+        return False
+
+    @staticmethod
+    def _is_current(entry, dst_fd):
+        """Returns whether existing file of copy is a link to or, if it had to be copied, a copy of the source file."""
+        src_stat = entry.stat()
+        dst_stat = os.stat(entry.name, dir_fd=dst_fd, follow_symlinks=False)
+        if statmod.S_ISDIR(dst_stat.st_mode):
+            return False
+        if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+            return True
+
+        # the same quick check rsync does, for files copied because they could not be linked:
+        return dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+
+    def _remove_vanished(self, relpath, src_fd, dst_fd):
+        """Removes entries of an incomplete copy whose source no longer exists or is excluded.
+
+        The copy is streamed and every name looked up in the source, rather than comparing two full listings.
+        """
+        with os.scandir(dst_fd) as entries:
+            for entry in entries:
+                try:
+                    os.stat(entry.name, dir_fd=src_fd, follow_symlinks=False)
+                except FileNotFoundError:
+                    self._remove(relpath, entry.name, dst_fd)
+                    continue
+                # the copy holds directories for source links to directories, so its entries tell what was a directory:
+                if self.exclude and self.exclude.excluded(relpath, entry.name, entry.is_dir(follow_symlinks=False)):
+                    self._remove(relpath, entry.name, dst_fd)
+
+    def _remove(self, relpath, name, dst_fd):
+        _logger.debug('Removing stale %s from incomplete copy.', os.path.join(relpath, name))
+        if statmod.S_ISDIR(os.stat(name, dir_fd=dst_fd, follow_symlinks=False).st_mode):
+            TreeRemover(os.path.join(self.dstdir, relpath, name), workers=1).remove()
+        else:
+            os.unlink(name, dir_fd=dst_fd)
@@ -1,45 +1,532 @@
 """Top-level control flow of snapshot creation."""
 import argparse
+import concurrent.futures
+import datetime
 import logging
+import os
+import signal
 
 import sys
 
-from psnapshot.snapshot import Organizer, Queue
+from psnapshot.archive import COMPRESSIONS
+from psnapshot.catalog import Catalog
+from psnapshot.daemon import Daemon
+from psnapshot.diff import diff_trees
+from psnapshot.exclude import ExcludeRules
+from psnapshot.exceptions import ConsistencyError, JobError, SnapshotDirError, VerificationError
+from psnapshot.fsck import REPAIRABLE, TRASH, ConsistencyChecker
+from psnapshot.jobs import Job, JobScheduler, format_summary, load_jobs
+from psnapshot.metrics import NULL_METRICS, RunMetrics
+from psnapshot.replicate import Replicator
+from psnapshot.restore import Restorer, find_snapshot, snapshot_path
+from psnapshot.rotation import RotationExecutor
+from psnapshot.simulate import Simulation
+from psnapshot.snapshot import Organizer, Queue, Snapshot, find_all_snapshots, parse_period
+from psnapshot.state import state_path
+from psnapshot.trash import Reaper, trash_path
+from psnapshot.usage import snapshot_usage
+from psnapshot.verify import Verifier
+from psnapshot.walk import DEFAULT_WORKERS
 
 _logger = logging.getLogger(__name__)
 
 
 class SnapshotController:
-    """Main control class to be used by end-user."""
+    """Main control class to be used by end-user.
 
-    def __init__(self, srcdir, dstdir, queues):
-        self.organizer = Organizer(srcdir, dstdir, queues)
+    Phase timing and counters of each run are collected if a path for a JSON run report or a Prometheus textfile is
+    given, otherwise collection is disabled.
 
-    def create_snapshot(self):
-        self.organizer.find_snapshots()
-        snapshot = self.organizer.create_snapshot()
-        if snapshot:
-            self.organizer.push(snapshot)
+    If an archive directory is given, snapshots expiring from the last queue are archived while the trash is reaped.
+    They are moved to trash once archived, to be reaped by the next run.
 
+    If the catalog is enabled, the file catalog of the destination directory is updated after each rotation.
+    """
 
-def main():
-    try:
-        parser = argparse.ArgumentParser(description='Python version of rsnapshot, managing queues of hard-linked copies or an rsync destination folder.')
-        parser.add_argument('srcdir', help='Source directory to create hard-linked copies from.')
-        parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
-        parser.add_argument('-q', '--queue',
-                            help='Queue definition in the form <name>[<length>]+<delta>, where <name> is the name of the queue, <length> the max length and '
-                                 '<delta> the number of days between queue entries. This argument can be used multiple times to define more than one queue. '
-                                 'If not given the default queue setup is daily[7]+1, weekly[4]+7 and monthly[3]+28.', action='append',
-                            default=['daily[7]+1', 'weekly[4]+7', 'monthly[3]+28'])
-        parser.add_argument('-l', '--log-level', help='Logging output level.', choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'], default='INFO')
-        args = parser.parse_args()
-
-        logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)-7s %(name)s %(message)s')
-
-        _logger.info('Storing {} in {}.'.format(args.srcdir, args.dstdir))
-        controller = SnapshotController(args.srcdir, args.dstdir, [Queue.from_textual_spec(spec) for spec in args.queue])
+    def __init__(self, srcdir, dstdir, queues, incremental_scan=False, reap=True, reap_timeout=None, reap_rate=None, report=None,
+                 prometheus_textfile=None, dedup=False, archive_dir=None, archive_compression='xz', exclude=(), catalog=False):
+        self.organizer = Organizer(srcdir, dstdir, queues, incremental_scan=incremental_scan, archive_dir=archive_dir,
+                                   archive_compression=archive_compression, exclude=ExcludeRules(exclude))
+        self.dedup = dedup
+        self.catalog = catalog
+        self.reap = reap
+        self.reap_timeout = reap_timeout
+        self.reap_rate = reap_rate
+        self.report = report
+        self.prometheus_textfile = prometheus_textfile
+
+    def create_snapshot(self, srcdir_time=None):
+        metrics = RunMetrics({'dstdir': self.organizer.dstdir}) if self.report or self.prometheus_textfile else NULL_METRICS
+        self.organizer.metrics = metrics
+        try:
+            # a rotation interrupted by an earlier run is completed before looking at the queues:
+            self.organizer.recover_rotation()
+            with metrics.phase('find'):
+                self.organizer.find_snapshots()
+            snapshot = self.organizer.create_snapshot(srcdir_time)
+            if snapshot:
+                if self.dedup:
+                    with metrics.phase('dedup'):
+                        self.organizer.deduplicate(snapshot)
+                with metrics.phase('rotate'):
+                    self.organizer.push(snapshot)
+                if self.catalog:
+                    with metrics.phase('catalog'):
+                        self.organizer.update_catalog()
+
+            if self.organizer.archive_dir:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                    archiving = executor.submit(self._archive, metrics)
+                    self._reap(metrics)
+                    archiving.result()
+                self.organizer.trash_archived()
+            else:
+                self._reap(metrics)
+
+            with metrics.phase('index'):
+                self.organizer.save_index()
+            metrics.success = True
+        except Exception:
+            metrics.success = False
+            raise
+        finally:
+            self.organizer.metrics = NULL_METRICS
+            if metrics.enabled:
+                self._export(metrics)
+
+    def _reap(self, metrics):
+        # expired snapshots are only moved to trash, this includes trash left over by earlier runs:
+        if self.reap:
+            with metrics.phase('reap'):
+                self.organizer.reap_trash(timeout=self.reap_timeout, rate=self.reap_rate)
+
+    def _archive(self, metrics):
+        with metrics.phase('archive'):
+            self.organizer.export_archives()
+
+    def plan_snapshot(self, srcdir_time=None):
+        """Returns name of snapshot a run would create and rotation plan, without changing the destination directory."""
+        if RotationExecutor(self.organizer.dstdir).pending() is not None:
+            _logger.warning('A rotation was interrupted, the next run completes it first. Planning from current snapshot names.')
+        self.organizer.find_snapshots(dry_run=True)
+        return self.organizer.plan_snapshot(srcdir_time)
+
+    def _export(self, metrics):
+        _logger.info('Run phases: {}.'.format(', '.join('{} {:.2f} s'.format(name, seconds) for name, seconds in metrics.phases.items())))
+        try:
+            if self.report:
+                metrics.write_report(self.report)
+            if self.prometheus_textfile:
+                metrics.write_prometheus(self.prometheus_textfile)
+        except OSError as e:
+            _logger.error('Cannot write run metrics: {}'.format(e))
+
+
+def add_log_level_argument(parser):
+    parser.add_argument('-l', '--log-level', help='Logging output level.', choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'], default='INFO')
+
+
+def add_reap_arguments(parser):
+    parser.add_argument('--reap-timeout', help='Number of seconds after which reclaiming space of expired snapshots stops. Remaining trash is '
+                                               'reaped by later runs.', type=float)
+    parser.add_argument('--reap-rate', help='Maximum number of files and directories removed per second when reclaiming space of expired '
+                                            'snapshots.', type=float)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--report', help='Path of JSON file to write a report of phase durations and counters of the run to.')
+    parser.add_argument('--prometheus-textfile', help='Path of file to write run metrics to in Prometheus text format, e.g. in the directory '
+                                                      'of the node exporter\'s textfile collector.')
+
+
+def parse_arguments(parser, argv):
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)-7s %(name)s %(message)s')
+    return args
+
+
+def snapshot_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot',
+                                     description='Python version of rsnapshot, managing queues of hard-linked copies or an rsync destination folder.',
+                                     epilog='Further commands are available as "psnapshot <command> -h": {}.'.format(', '.join(sorted(COMMANDS))))
+    parser.add_argument('srcdir', help='Source directory to create hard-linked copies from.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('-q', '--queue',
+                        help='Queue definition in the form <name>[<length>]+<delta>, where <name> is the name of the queue, <length> the max length and '
+                             '<delta> the time between queue entries, in days or with a unit m, h, d or w like 15m or 1h. This argument can be used '
+                             'multiple times to define more than one queue. '
+                             'If not given the default queue setup is daily[7]+1, weekly[4]+7 and monthly[3]+28.', action='append',
+                        default=['daily[7]+1', 'weekly[4]+7', 'monthly[3]+28'])
+    parser.add_argument('-x', '--exclude', help='Pattern in gitignore syntax of source entries to leave out of snapshots, e.g. cache/ or '
+                                                '*.tmp. Excluded directories are not entered and changes below them do not trigger snapshots. '
+                                                'This argument can be used multiple times.', action='append', default=[])
+    parser.add_argument('--exclude-from', help='File with exclude patterns in gitignore syntax, one per line.', action='append', default=[])
+    parser.add_argument('-i', '--incremental-scan', help='Keep a manifest of source directory times in the destination directory and only '
+                                                         'rescan changed directories. Requires files to be replaced rather than modified in '
+                                                         'place, which is the default behavior of rsync.', action='store_true')
+    parser.add_argument('--no-reap', help='Only move expired snapshots to trash and leave reclaiming their space to "psnapshot reap".',
+                        action='store_true')
+    parser.add_argument('--dedup', help='Relink files of the new snapshot that are identical to files of the previous snapshot but were '
+                                        'replaced by new inodes, e.g. by rsync after a touch.', action='store_true')
+    parser.add_argument('--catalog', help='Keep a catalog of file versions across all snapshots in the destination directory, updated '
+                                          'after each rotation, to be queried by "psnapshot history" and "psnapshot find".',
+                        action='store_true')
+    parser.add_argument('--archive-dir', help='Directory to archive snapshots expiring from the last queue to as compressed tar files, '
+                                              'instead of deleting them right away.')
+    parser.add_argument('--archive-compression', help='Compression of archives.', choices=sorted(COMPRESSIONS), default='xz')
+    parser.add_argument('-n', '--dry-run', help='Only print the snapshot that would be created and how queues would be rotated.',
+                        action='store_true')
+    add_reap_arguments(parser)
+    add_metrics_arguments(parser)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    exclude = list(args.exclude)
+    for path in args.exclude_from:
+        exclude.extend(ExcludeRules.from_file(path).patterns)
+
+    _logger.info('Storing {} in {}.'.format(args.srcdir, args.dstdir))
+    controller = SnapshotController(args.srcdir, args.dstdir, [Queue.from_textual_spec(spec) for spec in args.queue],
+                                    incremental_scan=args.incremental_scan,
+                                    reap=not args.no_reap,
+                                    reap_timeout=args.reap_timeout,
+                                    reap_rate=args.reap_rate,
+                                    report=args.report,
+                                    prometheus_textfile=args.prometheus_textfile,
+                                    dedup=args.dedup,
+                                    archive_dir=args.archive_dir,
+                                    archive_compression=args.archive_compression,
+                                    exclude=exclude,
+                                    catalog=args.catalog)
+    if not args.dry_run:
         controller.create_snapshot()
+        return
+
+    name, plan = controller.plan_snapshot()
+    if name is None:
+        print('No snapshot due.')
+        return
+    print('create {}'.format(name))
+    for line in plan.describe():
+        print(line)
+
+
+def make_controller(job):
+    return SnapshotController(job.srcdir, job.dstdir, [Queue.from_textual_spec(spec) for spec in job.queue_specs], **job.options)
+
+
+def run_job(job):
+    make_controller(job).create_snapshot()
+
+
+def run_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot run',
+                                     description='Runs all snapshot jobs of a configuration file concurrently, limiting concurrent jobs per '
+                                                 'destination device.')
+    parser.add_argument('config', help='INI style configuration file with one section per job, defining srcdir, dstdir and optionally queues as '
+                                       'whitespace separated queue specifications. Options in the DEFAULT section apply to all jobs.')
+    parser.add_argument('-j', '--max-jobs', help='Maximum number of concurrently running jobs.', type=int, default=8)
+    parser.add_argument('-d', '--per-device', help='Maximum number of concurrently running jobs per destination device.', type=int, default=1)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    jobs = load_jobs(args.config)
+    results = JobScheduler(run_job, max_jobs=args.max_jobs, per_device=args.per_device).run(jobs)
+
+    for line in format_summary(results):
+        _logger.info(line)
+
+    failed = [result for result in results if result.error is not None]
+    if failed:
+        raise JobError('{} of {} jobs failed.'.format(len(failed), len(results)))
+
+
+def daemon_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot daemon',
+                                     description='Runs snapshot jobs of a configuration file continuously, watching their source directories with '
+                                                 'inotify and creating snapshots as soon as they are due and the source has settled.')
+    parser.add_argument('config', help='Job configuration file, see "psnapshot run -h".')
+    parser.add_argument('-s', '--settle', help='Number of seconds a source must be unchanged before a snapshot is created.', type=float,
+                        default=300)
+    parser.add_argument('--scan-interval', help='Number of seconds between scans of sources that cannot be watched, e.g. because the '
+                                                'inotify watch limit is exceeded.', type=float, default=3600)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    daemon = Daemon(load_jobs(args.config), make_controller, settle=args.settle, scan_interval=args.scan_interval)
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: daemon.stopped.set())
+    daemon.run()
+
+
+def reap_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot reap', description='Reclaims space of expired snapshots moved to trash of a destination directory.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    add_reap_arguments(parser)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    _logger.info('Reaping trash of {}.'.format(args.dstdir))
+    Reaper(trash_path(args.dstdir), timeout=args.reap_timeout, rate=args.reap_rate).reap()
+
+
+def recover_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot recover',
+                                     description='Completes or rolls back a rotation of snapshot queues that was interrupted. Otherwise the next '
+                                                 'snapshot run completes it.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('--rollback', help='Restore snapshot names and deleted snapshots as before the interrupted rotation, as far as '
+                                           'their space has not been reclaimed yet.', action='store_true')
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    executor = RotationExecutor(args.dstdir)
+    if not (executor.rollback() if args.rollback else executor.resume()):
+        _logger.info('No interrupted rotation found in {}.'.format(args.dstdir))
+
+
+def replicate_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot replicate',
+                                     description='Mirrors snapshots of a destination directory to another volume. Only missing snapshots are '
+                                                 'copied, with files linked to mirrored files of the same inode, while snapshots moved '
+                                                 'between queues or expired are renamed or deleted on the mirror.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('mirror', help='Mirror directory, usually on another volume.')
+    parser.add_argument('--no-reap', help='Only move expired mirror snapshots to trash and leave reclaiming their space to "psnapshot reap".',
+                        action='store_true')
+    add_reap_arguments(parser)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    _logger.info('Replicating {} to {}.'.format(args.dstdir, args.mirror))
+    Replicator(args.dstdir, args.mirror).replicate()
+    if not args.no_reap:
+        Reaper(trash_path(args.mirror), timeout=args.reap_timeout, rate=args.reap_rate).reap()
+
+
+def restore_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot restore',
+                                     description='Restores a file or directory from a snapshot to a new target path, by hard links if the '
+                                                 'target is on the same file system and otherwise by copying.')
+    parser.add_argument('snapshot', help='Path to snapshot, or destination directory to restore from the newest snapshot holding the path.')
+    parser.add_argument('path', help='Path of file or directory relative to the snapshot root.')
+    parser.add_argument('target', help='Path to restore to, which must not exist.')
+    parser.add_argument('--at', help='With a destination directory, restore from the newest snapshot taken at or before this time, given '
+                                     'as YYYY-mm-dd or YYYY-mm-ddTHH:MM:SS.', type=datetime.datetime.fromisoformat)
+    parser.add_argument('--copy', help='Copy files even if they could be hard-linked. Linked files share their content with the snapshot, so '
+                                       'modifying them in place modifies the snapshot as well.', action='store_true')
+    parser.add_argument('-j', '--workers', help='Number of directories copied concurrently.', type=int, default=DEFAULT_WORKERS)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    try:
+        snapshot = Snapshot(os.path.normpath(args.snapshot))
+    except SnapshotDirError:
+        snapshot = find_snapshot(find_all_snapshots(args.snapshot), args.path, args.at)
+        _logger.info('Found {} in snapshot {}.'.format(args.path, snapshot.name))
+
+    Restorer(snapshot_path(snapshot, args.path), args.target, workers=args.workers, link=not args.copy).restore()
+
+
+def simulate_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot simulate',
+                                     description='Replays regular snapshot runs through the queue rotation in memory and prints which snapshots '
+                                                 'are retained, without touching any directory.')
+    parser.add_argument('-q', '--queue', help='Queue definition, see "psnapshot -h".', action='append', required=True)
+    parser.add_argument('--interval', help='Time between runs, with unit m, h, d or w.', type=parse_period, default='1d')
+    parser.add_argument('--years', help='Number of years to simulate.', type=float, default=3)
+    parser.add_argument('--start', help='Time of first run as YYYY-mm-dd.', type=lambda text: datetime.datetime.strptime(text, '%Y-%m-%d'),
+                        default='2000-01-01')
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    simulation = Simulation([Queue.from_textual_spec(spec) for spec in args.queue])
+    simulation.run(args.start, args.interval, int(datetime.timedelta(days=365 * args.years) / args.interval))
+
+    for line in simulation.summary():
+        print(line)
+
+
+def open_catalog(dstdir, workers):
+    """Returns file catalog of destination directory and current snapshots by timestamp, adding snapshots not catalogued yet."""
+    snapshots = find_all_snapshots(dstdir)
+    catalog = Catalog(state_path(dstdir, Catalog.FILENAME), workers=workers)
+    catalog.update(snapshots)
+    return catalog, {'{:%Y%m%d%H%M%S}'.format(snapshot.time): snapshot.name for snapshot in snapshots}
+
+
+def fsck_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot fsck',
+                                     description='Checks a destination directory for interrupted rotations, leftover trash, snapshots not '
+                                                 'matching the queue specifications, incomplete snapshots and files with corrupted link '
+                                                 'counts. All snapshot trees are walked concurrently.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('-q', '--queue', help='Queue definition, see "psnapshot -h". This argument can be used multiple times. If not given '
+                                              'the default queue setup is used.', action='append')
+    parser.add_argument('--repair', help='Resume an interrupted rotation, pass snapshots beyond the length of their queue on like rotation '
+                                         'does and reap the trash. Other problems are only reported.',
+                        action='store_true')
+    parser.add_argument('--no-reap', help='Only move snapshots to trash when repairing and leave reclaiming their space to "psnapshot reap".',
+                        action='store_true')
+    parser.add_argument('--archive-dir', help='Archive directory of the snapshot runs. Repairs then stage snapshots expiring from the last queue '
+                                              'to be archived by the next run, instead of deleting them.')
+    parser.add_argument('-j', '--workers', help='Number of directories listed concurrently.', type=int, default=DEFAULT_WORKERS)
+    add_reap_arguments(parser)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    queues = [Queue.from_textual_spec(spec) for spec in args.queue or Job.DEFAULT_QUEUE_SPECS.split()]
+    checker = ConsistencyChecker(args.dstdir, queues, workers=args.workers, archive_dir=args.archive_dir)
+    problems = checker.check()
+
+    for problem in problems:
+        print('{:<12} {:<40} {}'.format(problem.kind, problem.name, problem.message))
+    _logger.info('Checked {} files in {} snapshots, found {} problems.'.format(checker.files, checker.snapshots, len(problems)))
+
+    if not args.repair:
+        if problems:
+            raise ConsistencyError('Found {} problems in {}.'.format(len(problems), args.dstdir))
+        return
+
+    checker.repair()
+    repaired = REPAIRABLE
+    if args.no_reap:
+        repaired = repaired - {TRASH}
+    else:
+        Reaper(trash_path(args.dstdir), timeout=args.reap_timeout, rate=args.reap_rate).reap()
+    remaining = [problem for problem in problems if problem.kind not in repaired]
+    if remaining:
+        raise ConsistencyError('{} of {} problems in {} cannot be repaired.'.format(len(remaining), len(problems), args.dstdir))
+
+
+def history_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot history',
+                                     description='Lists all versions of a file across snapshots, from the file catalog of the destination '
+                                                 'directory. Snapshots not catalogued yet are added first.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('path', help='Path of file relative to the snapshot root.')
+    parser.add_argument('-j', '--workers', help='Number of threads listing snapshots not catalogued yet.', type=int, default=DEFAULT_WORKERS)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    catalog, names = open_catalog(args.dstdir, args.workers)
+    try:
+        versions = catalog.history(args.path)
+    finally:
+        catalog.close()
+
+    print('{:<19} {:>16} {:>9} {:<40} {:<40}'.format('modified', 'size', 'snapshots', 'first', 'last'))
+    for version in versions:
+        modified = datetime.datetime.fromtimestamp(version.mtime_ns / 1000000000)
+        print('{:%Y-%m-%d %H:%M:%S} {:>16} {:>9} {:<40} {:<40}'.format(modified, version.size, version.snapshots, names[version.first],
+                                                                     names[version.last]))
+
+
+def find_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot find',
+                                     description='Lists files of all snapshots matching a pattern, from the file catalog of the destination '
+                                                 'directory. Snapshots not catalogued yet are added first.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('pattern', help='Pattern in gitignore syntax, e.g. *.conf to match at any depth or /etc/*.conf to match at the '
+                                        'snapshot root.')
+    parser.add_argument('-j', '--workers', help='Number of threads listing snapshots not catalogued yet.', type=int, default=DEFAULT_WORKERS)
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    catalog, names = open_catalog(args.dstdir, args.workers)
+    try:
+        matches = catalog.find(args.pattern)
+    finally:
+        catalog.close()
+
+    for match in matches:
+        print('{}  {} versions in {} to {}'.format(match.path, match.versions, names[match.first], names[match.last]))
+
+
+def diff_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot diff',
+                                     description='Lists added (A), removed (D) and modified (M) entries between two snapshots. Unchanged files '
+                                                 'are detected by their shared inode without reading them.')
+    parser.add_argument('old', help='Path to older snapshot.')
+    parser.add_argument('new', help='Path to newer snapshot.')
+    parser.add_argument('-c', '--content', help='Compare contents of files on different inodes, only reporting actual modifications.',
+                        action='store_true')
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    for change in diff_trees(args.old, args.new, compare_contents=args.content):
+        print('{} {}{}'.format(change.status, change.path, os.sep if change.is_dir else ''))
+
+
+def usage_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot usage',
+                                     description='Lists bytes exclusively pinned by each snapshot, which are freed when it is deleted, and bytes '
+                                                 'shared with other snapshots or the source directory.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('--rescan', help='Rescan all snapshots instead of using cached results.', action='store_true')
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    snapshots = sorted(find_all_snapshots(args.dstdir), key=lambda s: s.time, reverse=True)
+    usage = snapshot_usage(args.dstdir, snapshots, rescan=args.rescan)
+
+    print('{:<40} {:>16} {:>16}'.format('snapshot', 'exclusive', 'shared'))
+    for snapshot, (exclusive, shared) in zip(snapshots, usage):
+        print('{:<40} {:>16} {:>16}'.format(snapshot.name, exclusive, shared))
+
+
+def verify_command(argv):
+    parser = argparse.ArgumentParser(prog='psnapshot verify',
+                                     description='Checks snapshots against checksum manifests kept in the destination directory, recording '
+                                                 'manifests of new snapshots. Files are hashed once per inode and hashes are cached, so only '
+                                                 'new inodes are read.')
+    parser.add_argument('dstdir', help='Destination directory, where queues of copies are stored.')
+    parser.add_argument('-j', '--workers', help='Number of processes hashing files.', type=int, default=os.cpu_count())
+    parser.add_argument('--rehash', help='Read all files again instead of using cached hashes, to detect silent corruption.',
+                        action='store_true')
+    add_log_level_argument(parser)
+    args = parse_arguments(parser, argv)
+
+    snapshots = sorted(find_all_snapshots(args.dstdir), key=lambda s: s.time, reverse=True)
+    verifier = Verifier(args.dstdir, workers=args.workers, rehash=args.rehash)
+    results = verifier.verify(snapshots)
+
+    damaged = 0
+    for snapshot, problems in zip(snapshots, results):
+        print('{:<40} {}'.format(snapshot.name, '{} problems'.format(len(problems)) if problems else 'ok'))
+        for problem in problems:
+            print('  {:<8} {}'.format(problem.kind, problem.path))
+        damaged += bool(problems)
+
+    _logger.info('Hashed {} files.'.format(verifier.hashed))
+    if damaged:
+        raise VerificationError('{} of {} snapshots differ from their checksum manifests.'.format(damaged, len(snapshots)))
+
+
+COMMANDS = {
+    'daemon': daemon_command,
+    'diff': diff_command,
+    'find': find_command,
+    'fsck': fsck_command,
+    'history': history_command,
+    'reap': reap_command,
+    'recover': recover_command,
+    'replicate': replicate_command,
+    'restore': restore_command,
+    'run': run_command,
+    'simulate': simulate_command,
+    'usage': usage_command,
+    'verify': verify_command,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    try:
+        if argv and argv[0] in COMMANDS:
+            COMMANDS[argv[0]](argv[1:])
+        else:
+            snapshot_command(argv)
         _logger.info('Done.')
     except Exception as ex:
         _logger.error('Failed: {}'.format(ex))
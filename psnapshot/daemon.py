@@ -0,0 +1,293 @@
+"""Long running snapshot creation driven by file system change notifications."""
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+from psnapshot.exclude import NO_EXCLUDES
+from psnapshot.scan import TreeScanner
+
+_logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatchLimitError(OSError):
+    """Raised if the kernel refuses to add more watches or inotify instances."""
+
+
+class Inotify:
+    """Minimal ctypes binding of Linux inotify."""
+
+    _libc = None
+
+    def __init__(self):
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self.fd = self._check(self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask):
+        """Watches path and returns watch descriptor."""
+        return self._check(self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def read_events(self):
+        """Returns list of pending events as tuples of watch descriptor, mask and name."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((wd, mask, name))
+
+    @staticmethod
+    def _check(result):
+        if result < 0:
+            code = ctypes.get_errno()
+            if code in (errno.ENOSPC, errno.EMFILE):
+                raise WatchLimitError(code, 'inotify limit exceeded')
+            raise OSError(code, os.strerror(code))
+        return result
+
+
+class SourceWatcher:
+    """Keeps track of the newest modification time in a source tree by watching all of its directories.
+
+    :ivar root: Path to watched source directory.
+    :ivar exclude: Exclude rules, excluded directories are not watched and changes of excluded files are ignored.
+    :ivar newest_ns: Newest modification time seen in nanoseconds, as computed by TreeScanner.
+    :ivar last_event: Monotonic time of last change seen.
+    """
+
+    DIR_MASK = IN_ONLYDIR | IN_DONT_FOLLOW | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_MODIFY
+
+    def __init__(self, root, exclude=NO_EXCLUDES):
+        self.root = root
+        self.exclude = exclude
+        self.newest_ns = 0
+        self.last_event = time.monotonic()
+
+        self._inotify = Inotify()
+        self._paths = {}
+        self._root_wd = None
+
+    def fileno(self):
+        return self._inotify.fileno()
+
+    def close(self):
+        self._inotify.close()
+
+    def start(self):
+        """Watches whole tree and scans it once, raises WatchLimitError if there are too many directories."""
+        # watches are added first, so changes during the initial scan are not lost:
+        self._root_wd = self._watch_tree(self.root)
+        self.newest_ns = TreeScanner(self.root, exclude=self.exclude).newest_mtime_ns()
+
+    def process_events(self):
+        """Updates newest modification time from pending change notifications."""
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.last_event = time.monotonic()
+                _logger.warning('Change notifications of {} overflowed, rescanning.'.format(self.root))
+                # directories created meanwhile are watched, too, existing watches are kept as they are:
+                self._watch_tree(self.root)
+                self.newest_ns = max(self.newest_ns, TreeScanner(self.root, exclude=self.exclude).newest_mtime_ns())
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+
+            dirpath = self._paths.get(wd)
+            if dirpath is None:
+                continue
+            relpath = os.path.relpath(dirpath, self.root)
+            if name and self.exclude and self.exclude.excluded(relpath, name, bool(mask & IN_ISDIR)):
+                continue
+            self.last_event = time.monotonic()
+
+            # like srcdir_time, the root directory's own time counts, but not that of subdirectories:
+            if wd == self._root_wd:
+                self._update(dirpath)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    path = os.path.join(dirpath, name)
+                    self._watch_tree(path)
+                    scanner = TreeScanner(path, include_root=False, exclude=self.exclude.below(os.path.join(relpath, name)))
+                    self.newest_ns = max(self.newest_ns, scanner.newest_mtime_ns())
+            elif name and not mask & (IN_DELETE | IN_MOVED_FROM):
+                self._update(os.path.join(dirpath, name))
+
+    def _update(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime > self.newest_ns:
+            self.newest_ns = mtime
+
+    def _watch_tree(self, path):
+        """Adds watches to directory and all directories below, returns watch descriptor of directory."""
+        top_wd = None
+        for dirpath, dirnames, _ in os.walk(path):
+            if self.exclude:
+                relpath = os.path.relpath(dirpath, self.root)
+                dirnames[:] = [name for name in dirnames if not self.exclude.excluded(relpath, name, True)]
+            wd = self._inotify.add_watch(dirpath, self.DIR_MASK)
+            self._paths[wd] = dirpath
+            if top_wd is None:
+                top_wd = wd
+        return top_wd
+
+
+class WatchedJob:
+    """State of a single job run by the daemon.
+
+    :ivar job: Job as read from configuration.
+    :ivar controller: Controller creating the job's snapshots.
+    :ivar watcher: Source watcher, None if job falls back to periodic scanning.
+    :ivar checked_ns: Newest source time for which snapshot creation was last considered.
+    :ivar next_scan: Monotonic time of next periodic scan.
+    :ivar due: Time at which a full period of the first queue has passed since its newest snapshot, None if unknown.
+    """
+
+    def __init__(self, job, controller):
+        self.job = job
+        self.controller = controller
+        self.watcher = None
+        self.checked_ns = None
+        self.next_scan = 0
+        self.due = None
+
+
+class Daemon:
+    """Creates snapshots as soon as the source of a job changed, a full period of its first queue has passed since the
+    newest snapshot and the source has been quiet for the settle time.
+
+    Jobs whose source tree cannot be watched, e.g. because the inotify watch limit is exceeded, are scanned
+    periodically instead.
+
+    :ivar settle: Number of seconds without changes before a snapshot is created.
+    :ivar scan_interval: Number of seconds between scans of jobs that cannot be watched.
+    :ivar poll: Maximum number of seconds between checks for due snapshots.
+    :ivar stopped: Event stopping the daemon when set.
+    """
+
+    def __init__(self, jobs, make_controller, settle=300, scan_interval=3600, poll=5):
+        self.jobs = [WatchedJob(job, make_controller(job)) for job in jobs]
+        self.settle = settle
+        self.scan_interval = scan_interval
+        self.poll = poll
+        self.stopped = threading.Event()
+
+    def run(self):
+        for watched in self.jobs:
+            self._start_watching(watched)
+
+        try:
+            while not self.stopped.is_set():
+                watchers = {w.watcher.fileno(): w for w in self.jobs if w.watcher}
+                if watchers:
+                    readable = select.select(list(watchers), [], [], self.poll)[0]
+                else:
+                    self.stopped.wait(self.poll)
+                    readable = []
+                for fd in readable:
+                    self._process_events(watchers[fd])
+
+                now = time.monotonic()
+                for watched in self.jobs:
+                    if self.stopped.is_set():
+                        break
+                    self._check(watched, now)
+        finally:
+            for watched in self.jobs:
+                if watched.watcher:
+                    watched.watcher.close()
+
+    def _start_watching(self, watched):
+        try:
+            watched.watcher = SourceWatcher(watched.job.srcdir, watched.controller.organizer.exclude)
+            watched.watcher.start()
+            _logger.info('Watching source of job {} for changes.'.format(watched.job))
+        except OSError as e:
+            self._fall_back(watched, e)
+
+    def _process_events(self, watched):
+        try:
+            watched.watcher.process_events()
+        except OSError as e:
+            self._fall_back(watched, e)
+
+    def _fall_back(self, watched, error):
+        _logger.warning('Cannot watch source of job {} ({}), scanning every {} seconds instead.'.format(watched.job, error, self.scan_interval))
+        if watched.watcher:
+            watched.watcher.close()
+            watched.watcher = None
+
+    def _check(self, watched, now):
+        """Creates snapshot of job if due."""
+        try:
+            if watched.watcher is None:
+                if now >= watched.next_scan:
+                    watched.next_scan = now + self.scan_interval
+                    watched.controller.create_snapshot()
+                return
+
+            watcher = watched.watcher
+            if watcher.newest_ns == watched.checked_ns or now - watcher.last_event < self.settle:
+                return
+            if watched.due is not None and datetime.datetime.now() < watched.due:
+                return
+
+            organizer = watched.controller.organizer
+            organizer.find_snapshots()
+            queue = organizer.queues[0]
+            newest = organizer.snapshots_time
+            # unlike runs started by cron, the daemon is never late, so it waits for the full period rather than
+            # the tolerance of the first queue, and checks the changed source again once it is due:
+            if newest is not None and datetime.datetime.now() < newest + queue.period:
+                watched.due = newest + queue.period
+                return
+            watched.due = None
+            watched.checked_ns = watcher.newest_ns
+
+            srcdir_time = organizer.time_from_ns(watcher.newest_ns)
+            if queue.snapshot_time_acceptable(srcdir_time):
+                _logger.info('Source of job {} changed and settled, creating snapshot.'.format(watched.job))
+                watched.controller.create_snapshot(srcdir_time=srcdir_time)
+        except Exception as e:
+            _logger.error('Job {} failed: {}'.format(watched.job, e))
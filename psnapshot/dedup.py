@@ -0,0 +1,131 @@
+"""Relinking of files a new snapshot holds on new inodes although their content is unchanged."""
+import errno
+import logging
+import os
+
+from psnapshot.state import state_path
+from psnapshot.verify import HashCache, hash_files, list_files
+from psnapshot.walk import DEFAULT_WORKERS
+
+_logger = logging.getLogger(__name__)
+
+
+class Deduplicator:
+    """Replaces files of a new snapshot by hard links to identical files of the previous snapshot.
+
+    Tools like rsync replace a file by a new one after a touch, even if its content did not change. The new snapshot
+    then links to the new inode, which every later snapshot keeps pinned in addition to the old one. Files on inodes
+    not found in the previous snapshot are matched by size first, then by content hash, using the hash cache of
+    psnapshot.verify. A file is only relinked to an inode with the same mode and owner, so the snapshot keeps showing
+    them as in the source, the older modification time is accepted.
+
+    Each file is replaced by a rename, so an interrupted pass leaves every file either relinked or untouched.
+
+    :ivar dstdir: Path to destination directory.
+    :ivar workers: Number of processes hashing files.
+    :ivar files: Number of files relinked by last pass.
+    :ivar bytes: Size of files relinked by last pass, reclaimed once no other snapshot or source file links the new inodes.
+    :ivar bytes_freed: Size of relinked files whose new inode had no other links, so they were reclaimed right away.
+    """
+
+    TEMP_FILENAME = 'dedup.tmp'
+
+    def __init__(self, dstdir, workers=DEFAULT_WORKERS):
+        self.dstdir = dstdir
+        self.workers = workers
+        self.files = 0
+        self.bytes = 0
+        self.bytes_freed = 0
+
+    def deduplicate(self, old_root, new_root):
+        """Relinks files of snapshot at new_root to identical files of the snapshot at old_root."""
+        old_files = list_files(old_root, self.workers)
+        new_files = list_files(new_root, self.workers)
+
+        old_inodes = {key[:2] for key in old_files.values()}
+        old_by_size = {}
+        for relpath, key in old_files.items():
+            # empty files take no space, so there is nothing to gain:
+            if key[2]:
+                old_by_size.setdefault(key[2], {}).setdefault(key, relpath)
+
+        candidates = [(relpath, key) for relpath, key in new_files.items() if key[:2] not in old_inodes and key[2] in old_by_size]
+        if not candidates:
+            return
+
+        paths = {}
+        old_by_digest = {}
+        for relpath, key in candidates:
+            paths.setdefault(key, os.path.join(new_root, relpath))
+            for old_key, old_relpath in old_by_size[key[2]].items():
+                paths.setdefault(old_key, os.path.join(old_root, old_relpath))
+        digests = self._digests(paths)
+        for size_keys in old_by_size.values():
+            for old_key in size_keys:
+                if old_key in digests:
+                    old_by_digest.setdefault(digests[old_key], old_key)
+
+        link_max = os.pathconf(old_root, 'PC_LINK_MAX')
+        touched_dirs = {}
+        for relpath, key in candidates:
+            # the file at the same path is preferred, if it is identical:
+            old_key = old_files.get(relpath)
+            if old_key is None or digests.get(old_key) != digests[key]:
+                old_key = old_by_digest.get(digests[key])
+            if old_key is None:
+                continue
+
+            path = os.path.join(new_root, relpath)
+            dirpath = os.path.dirname(path)
+            if dirpath not in touched_dirs:
+                touched_dirs[dirpath] = os.lstat(dirpath)
+            self._relink(paths[old_key], path, key, link_max)
+
+        # renames change modification times of directories, which mirror the source:
+        for dirpath, stat in touched_dirs.items():
+            os.utime(dirpath, ns=(stat.st_atime_ns, stat.st_mtime_ns), follow_symlinks=False)
+
+        _logger.info('Relinked {} files of {} bytes to identical files of previous snapshot, {} bytes freed right away.'.format(
+            self.files, self.bytes, self.bytes_freed))
+
+    def _digests(self, paths):
+        cache = HashCache(state_path(self.dstdir, HashCache.FILENAME))
+        try:
+            digests = cache.lookup(paths)
+            hashed = hash_files({key: path for key, path in paths.items() if key not in digests}, self.workers)
+            cache.store(hashed)
+            digests.update(hashed)
+        finally:
+            cache.close()
+        return digests
+
+    def _relink(self, old_path, path, key, link_max):
+        old_stat = os.lstat(old_path)
+        stat = os.lstat(path)
+        if (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) != key:
+            _logger.debug('Not relinking %s, which changed since it was hashed.', path)
+            return
+        if (old_stat.st_mode, old_stat.st_uid, old_stat.st_gid) != (stat.st_mode, stat.st_uid, stat.st_gid):
+            _logger.debug('Not relinking %s, which differs in mode or owner.', path)
+            return
+        if old_stat.st_nlink >= link_max:
+            _logger.debug('Not relinking %s, whose identical file has reached the link limit.', path)
+            return
+
+        temp_path = state_path(self.dstdir, self.TEMP_FILENAME)
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+        try:
+            os.link(old_path, temp_path)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            _logger.debug('Not relinking %s, whose identical file has reached the link limit.', path)
+            return
+        os.rename(temp_path, path)
+
+        self.files += 1
+        self.bytes += stat.st_size
+        if stat.st_nlink == 1:
+            self.bytes_freed += stat.st_size
+
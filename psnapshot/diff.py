@@ -0,0 +1,96 @@
+"""Comparison of snapshots based on inodes."""
+import collections
+import filecmp
+import os
+import stat as statmod
+
+ADDED = 'A'
+REMOVED = 'D'
+MODIFIED = 'M'
+
+Change = collections.namedtuple('Change', 'status path is_dir')
+Change.__doc__ = """Single difference between two trees, with path relative to their roots."""
+
+
+def diff_trees(old, new, compare_contents=False):
+    """Yields changes between two directory trees in depth-first order.
+
+    Files of successive snapshots that did not change are hard links to the same inode, so comparing device and inode
+    numbers is enough to find unchanged files. With compare_contents, files on different inodes are additionally
+    compared byte by byte and only reported if their contents differ.
+
+    Both trees are walked in lockstep, only the listings of the directories currently compared are held in memory.
+    """
+    stack = ['']
+    while stack:
+        relpath = stack.pop()
+        old_entries = _listdir(os.path.join(old, relpath))
+        new_entries = _listdir(os.path.join(new, relpath))
+
+        subdirs = []
+        for name, old_stat, new_stat in _merge(old_entries, new_entries):
+            path = os.path.join(relpath, name)
+            old_is_dir = old_stat is not None and statmod.S_ISDIR(old_stat.st_mode)
+            new_is_dir = new_stat is not None and statmod.S_ISDIR(new_stat.st_mode)
+
+            if old_stat is not None and new_stat is not None and old_is_dir == new_is_dir:
+                if old_is_dir:
+                    subdirs.append(path)
+                elif not _same_file(os.path.join(old, path), old_stat, os.path.join(new, path), new_stat, compare_contents):
+                    yield Change(MODIFIED, path, False)
+                continue
+
+            if old_stat is not None:
+                yield from _subtree(REMOVED, old, path, old_is_dir)
+            if new_stat is not None:
+                yield from _subtree(ADDED, new, path, new_is_dir)
+
+        # reversed to visit subdirectories in name order:
+        stack.extend(reversed(subdirs))
+
+
+def _listdir(dirpath):
+    """Returns list of names and status of entries in directory, sorted by name."""
+    with os.scandir(dirpath) as entries:
+        return sorted((entry.name, entry.stat(follow_symlinks=False)) for entry in entries)
+
+
+def _merge(old_entries, new_entries):
+    """Yields names with status in old and new listing, None where missing."""
+    i = j = 0
+    while i < len(old_entries) or j < len(new_entries):
+        old_name = old_entries[i][0] if i < len(old_entries) else None
+        new_name = new_entries[j][0] if j < len(new_entries) else None
+
+        if new_name is None or (old_name is not None and old_name < new_name):
+            yield old_name, old_entries[i][1], None
+            i += 1
+        elif old_name is None or new_name < old_name:
+            yield new_name, None, new_entries[j][1]
+            j += 1
+        else:
+            yield old_name, old_entries[i][1], new_entries[j][1]
+            i += 1
+            j += 1
+
+
+def _same_file(old_path, old_stat, new_path, new_stat, compare_contents):
+    if (old_stat.st_dev, old_stat.st_ino) == (new_stat.st_dev, new_stat.st_ino):
+        return True
+    if not compare_contents or old_stat.st_size != new_stat.st_size or statmod.S_IFMT(old_stat.st_mode) != statmod.S_IFMT(new_stat.st_mode):
+        return False
+    if statmod.S_ISLNK(old_stat.st_mode):
+        return os.readlink(old_path) == os.readlink(new_path)
+    if statmod.S_ISREG(old_stat.st_mode):
+        return filecmp.cmp(old_path, new_path, shallow=False)
+    return False
+
+
+def _subtree(status, root, relpath, is_dir):
+    """Yields change for entry and, for directories, all entries below it."""
+    yield Change(status, relpath, is_dir)
+    if not is_dir:
+        return
+
+    for name, stat in _listdir(os.path.join(root, relpath)):
+        yield from _subtree(status, root, os.path.join(relpath, name), statmod.S_ISDIR(stat.st_mode))
@@ -12,3 +12,27 @@ class DestinationDirError(Exception):
 
 class SnapshotDirError(Exception):
     pass
+
+
+class CloneError(Exception):
+    pass
+
+
+class JobConfigError(Exception):
+    pass
+
+
+class JobError(Exception):
+    pass
+
+
+class VerificationError(Exception):
+    pass
+
+
+class RestoreError(Exception):
+    pass
+
+
+class ConsistencyError(Exception):
+    pass
@@ -0,0 +1,131 @@
+"""Exclude rules for source trees in the syntax of gitignore files."""
+import itertools
+import re
+
+
+def translate(pattern):
+    """Returns regular expression matching relative paths, separated by slashes, against a gitignore pattern without
+    negation and trailing slash."""
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            content = pattern[i + 1:end]
+            if content.startswith('!'):
+                content = '^' + content[1:]
+            parts.append('[{}]'.format(content.replace('\\', '\\\\')))
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+
+    # patterns without slash match at any depth:
+    return ('' if anchored else '(?:.*/)?') + ''.join(parts)
+
+
+class ExcludeRules:
+    """Compiled exclude patterns in the syntax of gitignore files, matched against paths relative to the source root.
+
+    A leading slash or a slash within a pattern anchors it at the root, otherwise it matches at any depth. A trailing
+    slash restricts a pattern to directories. ``*`` and ``?`` do not match slashes, ``**`` does. Patterns starting
+    with ``!`` re-include what earlier patterns excluded, the last matching pattern wins. As with git, entries below an
+    excluded directory cannot be re-included, since excluded directories are never entered.
+
+    Consecutive patterns of the same kind are joined into a single regular expression, so matching a path costs a few
+    regular expression searches no matter how many patterns there are.
+
+    :ivar patterns: Patterns in order of precedence, lowest first.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = [p for p in (line.rstrip('\n') for line in patterns) if p.strip() and not p.startswith('#')]
+
+        # groups of consecutive patterns with same negation, with expressions for all entries and for directories only:
+        self._groups = []
+        rules = []
+        for pattern in self.patterns:
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            rules.append((negated, dir_only, translate(pattern.rstrip('/'))))
+
+        for negated, group in itertools.groupby(rules, key=lambda rule: rule[0]):
+            group = list(group)
+            self._groups.append((negated, self._compile([r for _, dir_only, r in group if not dir_only]),
+                                 self._compile([r for _, _, r in group])))
+        self._groups.reverse()
+
+    @staticmethod
+    def _compile(expressions):
+        if not expressions:
+            return None
+        return re.compile('(?:{})\\Z'.format('|'.join(expressions)), re.DOTALL)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as file:
+            return cls(file)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def below(self, relpath):
+        """Returns rules for the tree below directory at given relative path, to match paths relative to that directory."""
+        return _SubtreeRules(self, relpath) if relpath not in ('', '.') else self
+
+    def excluded(self, relpath, name, is_dir):
+        """Returns whether entry of given name in directory at relative path is excluded, the root being '' or '.'."""
+        if relpath.startswith('./'):
+            relpath = relpath[2:]
+        elif relpath == '.':
+            relpath = ''
+        path = relpath + '/' + name if relpath else name
+
+        for negated, any_expression, dir_expression in self._groups:
+            expression = dir_expression if is_dir else any_expression
+            if expression is not None and expression.match(path):
+                return not negated
+        return False
+
+
+class _SubtreeRules:
+    def __init__(self, rules, relpath):
+        self.rules = rules
+        self.relpath = relpath
+        self.patterns = rules.patterns
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def below(self, relpath):
+        return _SubtreeRules(self.rules, self.relpath + '/' + relpath) if relpath not in ('', '.') else self
+
+    def excluded(self, relpath, name, is_dir):
+        if relpath.startswith('./'):
+            relpath = relpath[2:]
+        elif relpath == '.':
+            relpath = ''
+        return self.rules.excluded(self.relpath + '/' + relpath if relpath else self.relpath, name, is_dir)
+
+
+NO_EXCLUDES = ExcludeRules()
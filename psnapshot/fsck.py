@@ -0,0 +1,208 @@
+"""Consistency check and repair of a destination directory."""
+import collections
+import copy
+import logging
+import os
+import stat as statmod
+
+from psnapshot.archive import staging_path
+from psnapshot.rotation import PlannedSnapshot, RotationExecutor, RotationPlan
+from psnapshot.snapshot import Organizer, chain_queues, scan_snapshots
+from psnapshot.state import STATE_DIRNAME
+from psnapshot.trash import trash_path
+from psnapshot.walk import DEFAULT_WORKERS, walk_parallel
+
+_logger = logging.getLogger(__name__)
+
+Problem = collections.namedtuple('Problem', 'kind name message')
+Problem.__doc__ = """Inconsistency found in a destination directory, name is the snapshot or folder concerned."""
+
+INTERRUPTED = 'interrupted'
+BUILD = 'build'
+TRASH = 'trash'
+STAGED = 'staged'
+UNMAPPED = 'unmapped'
+ORDER = 'order'
+SPACING = 'spacing'
+LENGTH = 'length'
+PARTIAL = 'partial'
+UNREADABLE = 'unreadable'
+LINK_COUNT = 'link-count'
+
+# kinds of problems ConsistencyChecker.repair takes care of, the trash is reaped by the caller:
+REPAIRABLE = frozenset([INTERRUPTED, TRASH, LENGTH])
+
+
+def _list_directory(item):
+    """Returns newest modification time of directory and its entries, and inode numbers and link counts of its files."""
+    index, root, relpath = item
+    newest = 0
+    files = []
+    subdirs = []
+    try:
+        path = os.path.join(root, relpath)
+        newest = os.stat(path).st_mtime_ns
+        with os.scandir(path) as entries:
+            for entry in entries:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime_ns > newest:
+                    newest = stat.st_mtime_ns
+                if statmod.S_ISDIR(stat.st_mode):
+                    subdirs.append((index, root, os.path.join(relpath, entry.name)))
+                elif statmod.S_ISREG(stat.st_mode):
+                    files.append((stat.st_ino, stat.st_nlink))
+    except OSError as e:
+        return (index, newest, files, '{}: {}'.format(os.path.join(relpath, '') or os.curdir, e)), subdirs
+    return (index, newest, files, None), subdirs
+
+
+class ConsistencyChecker:
+    """Checks a destination directory for leftovers of interrupted runs and for snapshots rotation would not produce.
+
+    Snapshot names are checked against the queue specifications for unknown queues, queues longer than specified,
+    snapshots out of order between queues and snapshots closer together than their queue's period. The trees of all
+    snapshots are walked concurrently on a thread pool. A file with fewer links than directory entries found for it in
+    the snapshots has a corrupted link count, which only the file system's own check can repair.
+
+    Snapshots are built in the state folder and only renamed into place when complete, so an incomplete snapshot is
+    the build folder left by an interrupted run, which the next run resumes. A tree none of whose entries is as new as
+    the snapshot's time, the time of the newest source file when it was created, is reported as possibly partial. This
+    is a hint only: the newest file may have been removed from the source before it was cloned, or relinked to an older
+    identical inode by psnapshot.dedup, so such snapshots are never deleted.
+
+    Repairs use the rotation paths: an interrupted rotation is resumed from its journal, then snapshots beyond the
+    length of their queue are pushed on to the next queue or expire, applied by RotationExecutor. Like in rotation,
+    snapshots expiring from the last queue are staged for archiving if there is an archive directory, to be archived
+    by the next run. Everything else is only reported.
+
+    :ivar dstdir: Path to destination directory.
+    :ivar queues: Queue specifications, their snapshots are not used.
+    :ivar workers: Number of directories listed concurrently.
+    :ivar archive_dir: Optional archive directory of the snapshot runs.
+    :ivar snapshots: Number of snapshots checked by the last check.
+    :ivar files: Number of files checked by the last check.
+    :ivar plan: Renames and deletions repairing the problems found by the last check.
+    """
+
+    def __init__(self, dstdir, queues, workers=DEFAULT_WORKERS, archive_dir=None):
+        self.dstdir = dstdir
+        self.queues = chain_queues(queues)
+        self.workers = workers
+        self.archive_dir = archive_dir
+        self.snapshots = 0
+        self.files = 0
+        self.plan = RotationPlan()
+
+    def check(self):
+        """Returns problems found, sorted by kind and name."""
+        problems = self._check_leftovers()
+
+        # the listing is taken afresh, an index written before a crash may be outdated:
+        snapshots, _ = scan_snapshots(self.dstdir)
+        self.snapshots = len(snapshots)
+        self._check_trees(snapshots, problems)
+
+        queue_by_name = {queue.name: queue for queue in self.queues}
+        mapped = []
+        for snapshot in snapshots:
+            if snapshot.queue_name in queue_by_name:
+                mapped.append(snapshot)
+            else:
+                problems.append(Problem(UNMAPPED, snapshot.name, 'belongs to no queue'))
+
+        queues = self._planned_queues(mapped, problems)
+        self._check_order(queues, problems)
+        self.plan = self._plan_repair(queues, problems)
+
+        return sorted(problems)
+
+    def repair(self):
+        """Resumes an interrupted rotation and applies the repair plan of the last check, checking again first if the
+        rotation changed snapshot names."""
+        executor = RotationExecutor(self.dstdir)
+        if executor.resume():
+            self.check()
+        if self.plan:
+            _logger.info('Repairing snapshots: {}.'.format(', '.join(self.plan.describe())))
+        executor.apply(self.plan)
+
+    def _check_leftovers(self):
+        problems = []
+        if RotationExecutor(self.dstdir).pending() is not None:
+            problems.append(Problem(INTERRUPTED, RotationExecutor.JOURNAL_FILENAME, 'rotation was interrupted'))
+        if os.path.isdir(os.path.join(self.dstdir, STATE_DIRNAME, Organizer.BUILD_DIRNAME)):
+            problems.append(Problem(BUILD, Organizer.BUILD_DIRNAME, 'incomplete snapshot, resumed by the next run'))
+        for folder, kind, message in ((trash_path(self.dstdir), TRASH, 'waiting to be reaped'),
+                                      (staging_path(self.dstdir), STAGED, 'waiting to be archived')):
+            try:
+                names = os.listdir(folder)
+            except FileNotFoundError:
+                continue
+            problems.extend(Problem(kind, name, message) for name in names)
+        return problems
+
+    def _check_trees(self, snapshots, problems):
+        """Walks all snapshot trees concurrently."""
+        newest = [0] * len(snapshots)
+        unreadable = set()
+        links = collections.Counter()
+        self.files = 0
+        roots = [(index, snapshot.dirpath, '') for index, snapshot in enumerate(snapshots)]
+        for index, newest_ns, files, error in walk_parallel(_list_directory, roots, self.workers, batch_size=16):
+            if newest_ns > newest[index]:
+                newest[index] = newest_ns
+            # counted by inode and link count together, so nothing but counting happens per file:
+            links.update(files)
+            self.files += len(files)
+            if error:
+                problems.append(Problem(UNREADABLE, snapshots[index].name, error))
+                unreadable.add(index)
+
+        for (ino, nlink), count in links.items():
+            if count > nlink:
+                problems.append(Problem(LINK_COUNT, 'inode {}'.format(ino), 'has {} links, but {} entries in snapshots'.format(nlink, count)))
+
+        # unreadable trees may just lack their newest entries in what could be read, they are reported as such:
+        for index, (snapshot, newest_ns) in enumerate(zip(snapshots, newest)):
+            if index not in unreadable and Organizer.time_from_ns(newest_ns) < snapshot.time:
+                problems.append(Problem(PARTIAL, snapshot.name, 'holds no entry as new as the snapshot, may be incomplete'))
+
+    def _planned_queues(self, snapshots, problems):
+        """Returns copies of queues holding stand-ins for given snapshots, newest first."""
+        queues = []
+        for queue in self.queues:
+            queue_copy = copy.copy(queue)
+            queue_copy.snapshots = sorted((PlannedSnapshot(s) for s in snapshots if s.queue_name == queue.name),
+                                          key=lambda s: s.time, reverse=True)
+            for newer, older in zip(list(queue_copy.snapshots), list(queue_copy.snapshots)[1:]):
+                if newer.time - older.time < queue.timedelta:
+                    problems.append(Problem(SPACING, older.name, 'is closer to {} than the period of queue {}'.format(newer.name, queue.name)))
+            queues.append(queue_copy)
+        return queues
+
+    @staticmethod
+    def _check_order(queues, problems):
+        for queue, next_queue in zip(queues, queues[1:]):
+            if queue.snapshots and next_queue.snapshots and next_queue.snapshots[0].time >= queue.snapshots[-1].time:
+                problems.append(Problem(ORDER, next_queue.snapshots[0].name, 'is not older than all snapshots of queue {}'.format(queue.name)))
+
+    def _plan_repair(self, queues, problems):
+        """Returns plan passing snapshots beyond the length of their queue on like rotation does."""
+        planned = []
+        carried = []
+        for queue in queues:
+            planned.extend(queue.snapshots)
+            if len(queue.snapshots) > queue.length:
+                problems.append(Problem(LENGTH, queue.name, 'holds {} snapshots, {} are specified'.format(len(queue.snapshots), queue.length)))
+            if carried:
+                carried = queue.push_snapshots(carried)
+            else:
+                while len(queue.snapshots) > queue.length:
+                    carried.append(queue.snapshots.pop())
+                carried.reverse()
+
+        # snapshots falling off the last queue expire:
+        for snapshot in carried:
+            snapshot.delete()
+        archive_queue_name = queues[-1].name if self.archive_dir and queues else None
+        return RotationPlan.from_snapshots(planned, archive_queue_name)
@@ -0,0 +1,74 @@
+"""Index of snapshot folders in a destination directory."""
+import logging
+import os
+import time
+
+from psnapshot.state import read_json, state_path, write_json
+
+_logger = logging.getLogger(__name__)
+
+
+class SnapshotIndex:
+    """Names of entries in a destination directory, valid as long as the directory's modification time is unchanged.
+
+    Renaming, adding or removing snapshot folders updates the modification time of the destination directory, so a
+    single stat tells whether the index is current. Changes within the file system's time resolution after the
+    directory was listed cannot be told apart this way, such indexes are verified by comparing names with a plain
+    directory listing.
+
+    :ivar dstdir: Path to destination directory.
+    :ivar mtime_ns: Modification time of destination directory when it was listed.
+    :ivar listed_ns: Time the destination directory was listed.
+    :ivar snapshots: Names of valid snapshot folders.
+    :ivar others: Names of all other entries.
+    """
+
+    VERSION = 1
+    FILENAME = 'index.json'
+    RACY_NS = 2 * 1000000000
+
+    def __init__(self, dstdir, mtime_ns, listed_ns, snapshots=(), others=()):
+        self.dstdir = dstdir
+        self.mtime_ns = mtime_ns
+        self.listed_ns = listed_ns
+        self.snapshots = list(snapshots)
+        self.others = list(others)
+
+    @classmethod
+    def prepare(cls, dstdir):
+        """Returns empty index to be filled by listing the destination directory right after this call."""
+        # the state folder must exist before taking the directory time, it is a folder of the destination itself:
+        os.makedirs(state_path(dstdir), exist_ok=True)
+        listed_ns = int(time.time() * 1000000000)
+        return cls(dstdir, os.stat(dstdir).st_mtime_ns, listed_ns)
+
+    @classmethod
+    def load(cls, dstdir):
+        """Returns index stored in destination directory, or None if there is no usable one."""
+        data = read_json(state_path(dstdir, cls.FILENAME))
+        try:
+            if data['version'] == cls.VERSION:
+                return cls(dstdir, data['mtime_ns'], data['listed_ns'], data['snapshots'], data['others'])
+        except (TypeError, KeyError):
+            pass
+        return None
+
+    def save(self):
+        data = {
+            'version': self.VERSION,
+            'mtime_ns': self.mtime_ns,
+            'listed_ns': self.listed_ns,
+            'snapshots': self.snapshots,
+            'others': self.others,
+        }
+        write_json(state_path(self.dstdir, self.FILENAME), data)
+
+    def is_current(self):
+        """Returns whether index still describes destination directory."""
+        if os.stat(self.dstdir).st_mtime_ns != self.mtime_ns:
+            return False
+        if self.mtime_ns < self.listed_ns - self.RACY_NS:
+            return True
+
+        _logger.debug('Snapshot index was recorded right after a change, verifying names.')
+        return sorted(os.listdir(self.dstdir)) == sorted(self.snapshots + self.others)
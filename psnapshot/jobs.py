@@ -0,0 +1,162 @@
+"""Configuration and concurrent scheduling of multiple snapshot jobs."""
+import collections
+import concurrent.futures
+import configparser
+import logging
+import os
+import time
+
+from psnapshot.archive import COMPRESSIONS
+from psnapshot.exceptions import JobConfigError
+
+_logger = logging.getLogger(__name__)
+
+JobResult = collections.namedtuple('JobResult', 'job duration error')
+JobResult.__doc__ = """Outcome of a single job run, error is None on success."""
+
+
+class Job:
+    """Snapshot job read from configuration file.
+
+    :ivar name: Name of the job, the section name in the configuration file.
+    :ivar srcdir: Path to source directory.
+    :ivar dstdir: Path to destination directory.
+    :ivar queue_specs: Textual queue specifications, see Queue.from_textual_spec.
+    :ivar options: Further keyword arguments for SnapshotController.
+    """
+
+    DEFAULT_QUEUE_SPECS = 'daily[7]+1 weekly[4]+7 monthly[3]+28'
+
+    def __init__(self, name, srcdir, dstdir, queue_specs, options=None):
+        self.name = name
+        self.srcdir = srcdir
+        self.dstdir = dstdir
+        self.queue_specs = queue_specs
+        self.options = options or {}
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def from_section(cls, section):
+        """Creates job from configuration file section."""
+        try:
+            options = {
+                'incremental_scan': section.getboolean('incremental_scan', False),
+                'reap': section.getboolean('reap', True),
+                'reap_timeout': section.getfloat('reap_timeout'),
+                'reap_rate': section.getfloat('reap_rate'),
+                'report': section.get('report'),
+                'prometheus_textfile': section.get('prometheus_textfile'),
+                'dedup': section.getboolean('dedup', False),
+                'archive_dir': section.get('archive_dir'),
+                'archive_compression': section.get('archive_compression', 'xz'),
+                'exclude': [line.strip() for line in section.get('exclude', '').splitlines() if line.strip()],
+                'catalog': section.getboolean('catalog', False),
+            }
+            if options['archive_compression'] not in COMPRESSIONS:
+                raise ValueError('archive_compression must be one of {}'.format(', '.join(sorted(COMPRESSIONS))))
+            return cls(section.name, section['srcdir'], section['dstdir'], section.get('queues', cls.DEFAULT_QUEUE_SPECS).split(), options)
+        except KeyError as e:
+            raise JobConfigError('Job {} misses option {}.'.format(section.name, e))
+        except ValueError as e:
+            raise JobConfigError('Job {} has invalid option: {}'.format(section.name, e))
+
+
+def load_jobs(path):
+    """Returns jobs defined in an INI style configuration file, one section per job.
+
+    Options of the DEFAULT section apply to all jobs. Each job defines ``srcdir`` and ``dstdir`` and optionally
+    ``queues`` as whitespace separated list of queue specifications, ``incremental_scan``, ``reap``, ``reap_timeout``,
+    ``reap_rate``, ``report``, ``prometheus_textfile``, ``dedup``, ``archive_dir``, ``archive_compression``,
+    ``exclude`` as exclude patterns in gitignore syntax, one per line, and ``catalog``.
+    """
+    parser = configparser.ConfigParser()
+    try:
+        if not parser.read(path):
+            raise JobConfigError('Configuration file {} cannot be read.'.format(path))
+    except configparser.Error as e:
+        raise JobConfigError('Configuration file {} is invalid: {}'.format(path, e))
+
+    jobs = [Job.from_section(parser[name]) for name in parser.sections()]
+    if not jobs:
+        raise JobConfigError('Configuration file {} defines no jobs.'.format(path))
+    return jobs
+
+
+class JobScheduler:
+    """Runs jobs concurrently, limiting the number of jobs writing to the same device.
+
+    Jobs are grouped by the device of their destination directory, the hard links of a snapshot always live there.
+    Jobs on different devices run in parallel, jobs on the same device only up to the given limit.
+
+    :ivar run_job: Callable running a single job.
+    :ivar max_jobs: Maximum number of jobs running at the same time.
+    :ivar per_device: Maximum number of jobs running at the same time on a single device.
+    """
+
+    def __init__(self, run_job, max_jobs=8, per_device=1):
+        self.run_job = run_job
+        self.max_jobs = max_jobs
+        self.per_device = per_device
+
+        # no job would ever start otherwise:
+        if max_jobs < 1 or per_device < 1:
+            raise JobConfigError('Numbers of concurrent jobs must be positive, not {} and {} per device.'.format(max_jobs, per_device))
+
+    def run(self, jobs):
+        """Runs all jobs and returns their results in order of the given jobs."""
+        waiting = [(job, self._device(job)) for job in jobs]
+        running = {}
+        busy = collections.Counter()
+        results = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            while waiting or running:
+                # start jobs in configuration order as long as their device has a free slot:
+                for job, device in list(waiting):
+                    if len(running) >= self.max_jobs:
+                        break
+                    if busy[device] < self.per_device:
+                        waiting.remove((job, device))
+                        busy[device] += 1
+                        running[executor.submit(self._run_job, job)] = device
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    busy[running.pop(future)] -= 1
+                    result = future.result()
+                    results[result.job] = result
+
+        return [results[job] for job in jobs]
+
+    @staticmethod
+    def _device(job):
+        try:
+            return os.stat(job.dstdir).st_dev
+        except OSError:
+            # the job itself reports the missing directory:
+            return None
+
+    def _run_job(self, job):
+        _logger.info('Starting job {}.'.format(job))
+        start = time.monotonic()
+        try:
+            self.run_job(job)
+            error = None
+        except Exception as e:
+            _logger.error('Job {} failed: {}'.format(job, e))
+            error = e
+        duration = time.monotonic() - start
+        _logger.info('Finished job {} after {:.1f} seconds.'.format(job, duration))
+
+        return JobResult(job, duration, error)
+
+
+def format_summary(results):
+    """Returns lines summarizing job results."""
+    lines = ['{:<24} {:>10} {}'.format('job', 'seconds', 'outcome')]
+    for result in results:
+        outcome = 'ok' if result.error is None else 'failed: {}'.format(result.error)
+        lines.append('{:<24} {:>10.1f} {}'.format(result.job.name, result.duration, outcome))
+    return lines
@@ -0,0 +1,133 @@
+"""Phase timing and counters of a snapshot run, exported as JSON report and Prometheus textfile."""
+import collections
+import contextlib
+import json
+import time
+
+from psnapshot.state import write_atomic
+
+PROMETHEUS_PREFIX = 'psnapshot'
+
+COUNTERS = collections.OrderedDict([
+    ('files_scanned', 'Number of source files whose modification time was read.'),
+    ('links_created', 'Number of hard links created for the new snapshot.'),
+    ('files_copied_reflink', 'Number of files that could not be hard-linked and were reflinked instead.'),
+    ('files_copied_copy_file_range', 'Number of files that could not be hard-linked and were copied by copy_file_range.'),
+    ('files_copied_buffered', 'Number of files that could not be hard-linked and were copied through a buffer.'),
+    ('files_copied_special', 'Number of FIFOs, sockets and devices that could not be hard-linked and were created anew.'),
+    ('files_deduplicated', 'Number of files of the new snapshot relinked to identical files of the previous snapshot.'),
+    ('bytes_deduplicated', 'Size of files of the new snapshot relinked to identical files of the previous snapshot.'),
+    ('renames', 'Number of snapshot folders renamed when moving between queues.'),
+    ('snapshots_expired', 'Number of snapshots moved to trash.'),
+    ('files_archived', 'Number of files of expired snapshots written to archives, without hard link entries.'),
+    ('bytes_archived', 'Size of file content of expired snapshots written to archives, before compression.'),
+    ('files_removed', 'Number of files removed from trash.'),
+    ('bytes_freed', 'Size of removed files that had no other hard links.'),
+])
+
+
+class RunMetrics:
+    """Wall time per phase and counters of a single run.
+
+    :ivar labels: Labels identifying the run in exported metrics, e.g. the destination directory.
+    :ivar phases: Wall time in seconds by phase name, in order of first use.
+    :ivar counters: Counter values by name, see COUNTERS.
+    :ivar start: Wall clock time the run started.
+    :ivar success: Whether the run completed, None while it is running.
+    """
+
+    enabled = True
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.start = time.time()
+        self.success = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Adds wall time spent in with-block to given phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def report(self):
+        """Returns run report as JSON compatible dictionary."""
+        return {
+            'labels': self.labels,
+            'start': self.start,
+            'success': self.success,
+            'seconds': sum(self.phases.values()),
+            'phases': self.phases,
+            'counters': {name: self.counters[name] for name in COUNTERS},
+        }
+
+    def write_report(self, path):
+        write_atomic(path, json.dumps(self.report(), indent=2).encode())
+
+    def prometheus_lines(self):
+        """Returns metrics in Prometheus text exposition format."""
+        labels = ','.join('{}="{}"'.format(key, _escape(value)) for key, value in sorted(self.labels.items()))
+
+        def sample(name, value, **extra):
+            pairs = [labels] if labels else []
+            pairs.extend('{}="{}"'.format(key, _escape(value)) for key, value in sorted(extra.items()))
+            return '{}_{}{{{}}} {}'.format(PROMETHEUS_PREFIX, name, ','.join(pairs), value)
+
+        lines = [
+            '# HELP {}_phase_seconds Wall time of phases of last run.'.format(PROMETHEUS_PREFIX),
+            '# TYPE {}_phase_seconds gauge'.format(PROMETHEUS_PREFIX),
+        ]
+        lines.extend(sample('phase_seconds', '{:.6f}'.format(seconds), phase=phase) for phase, seconds in self.phases.items())
+
+        for name, help_text in COUNTERS.items():
+            lines.append('# HELP {}_{} {}'.format(PROMETHEUS_PREFIX, name, help_text))
+            lines.append('# TYPE {}_{} gauge'.format(PROMETHEUS_PREFIX, name))
+            lines.append(sample(name, self.counters[name]))
+
+        lines.append('# HELP {}_last_run_timestamp_seconds Start time of last run.'.format(PROMETHEUS_PREFIX))
+        lines.append('# TYPE {}_last_run_timestamp_seconds gauge'.format(PROMETHEUS_PREFIX))
+        lines.append(sample('last_run_timestamp_seconds', '{:.3f}'.format(self.start)))
+        lines.append('# HELP {}_last_run_success Whether last run completed without error.'.format(PROMETHEUS_PREFIX))
+        lines.append('# TYPE {}_last_run_success gauge'.format(PROMETHEUS_PREFIX))
+        lines.append(sample('last_run_success', int(bool(self.success))))
+        return lines
+
+    def write_prometheus(self, path):
+        """Writes textfile for the node exporter's textfile collector, replacing it atomically as the collector requires."""
+        write_atomic(path, ''.join(line + '\n' for line in self.prometheus_lines()).encode())
+
+
+class NullMetrics:
+    """Drop-in for RunMetrics if metrics are disabled, doing nothing."""
+
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def count(self, name, value=1):
+        pass
+
+
+class _NullPhase:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+NULL_METRICS = NullMetrics()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,134 @@
+"""Parallel removal of directory trees."""
+import collections
+import logging
+import os
+import stat as statmod
+import threading
+
+from psnapshot.walk import DEFAULT_WORKERS, DIR_FLAGS, opened_directory, walk_parallel
+
+_logger = logging.getLogger(__name__)
+
+_DIR_FLAGS = DIR_FLAGS | os.O_NOFOLLOW
+_DIR_ACCESS = statmod.S_IRWXU
+
+# files with several links are remembered for this many removals, which covers removals of their links racing between
+# workers, later removals see the lowered link count:
+RECENT_LINKS = 4096
+
+
+class TreeRemover:
+    """Removes a directory tree, unlinking files of many directories concurrently.
+
+    Directories are read with ``os.scandir`` on directory descriptors and files are unlinked relative to them.
+    Directories are removed bottom-up once all files are gone. Read-only directories, which snapshots inherit from
+    their source, are made writable on the way.
+
+    :ivar path: Path to directory tree to remove.
+    :ivar workers: Number of directories processed concurrently.
+    :ivar tick: Optional callable invoked for every removed entry, returning False stops the removal.
+    :ivar files: Number of removed files.
+    :ivar bytes_freed: Approximate size of removed files that had no other hard links. Links of a file removed by
+        different workers at the same time are counted per inode, links removed by other processes are not noticed.
+    :ivar complete: Whether the tree has been removed completely.
+    """
+
+    def __init__(self, path, workers=DEFAULT_WORKERS, tick=None):
+        self.path = path
+        self.workers = workers
+        self.tick = tick
+        self.files = 0
+        self.bytes_freed = 0
+        self.complete = False
+
+        self._lock = threading.Lock()
+        self._links = collections.OrderedDict()
+        self._root_fd = None
+        self._stopped = False
+
+    def remove(self):
+        """Removes the tree and returns whether this was completed."""
+        root_stat = os.lstat(self.path)
+        if not statmod.S_ISDIR(root_stat.st_mode):
+            os.unlink(self.path)
+            self._account(1, root_stat.st_size if root_stat.st_nlink == 1 else 0)
+            self.complete = True
+            return True
+
+        if root_stat.st_mode & _DIR_ACCESS != _DIR_ACCESS:
+            os.chmod(self.path, root_stat.st_mode | _DIR_ACCESS)
+
+        self._root_fd = os.open(self.path, _DIR_FLAGS)
+        try:
+            dirs = []
+            for subdirs in walk_parallel(self._remove_files, ['.'], self.workers):
+                dirs.extend(subdirs)
+
+            if self._stopped:
+                return False
+
+            # children are discovered after their parents:
+            for relpath in reversed(dirs):
+                os.rmdir(relpath, dir_fd=self._root_fd)
+                if not self._continue():
+                    return False
+        finally:
+            os.close(self._root_fd)
+
+        os.rmdir(self.path)
+        self.complete = True
+        return True
+
+    def _remove_files(self, relpath):
+        """Unlinks all non-directories in a directory and returns its subdirectories."""
+        if self._stopped:
+            return [], []
+
+        subdirs = []
+        files = 0
+        bytes_freed = 0
+
+        try:
+            with opened_directory(relpath, self._root_fd, _DIR_FLAGS) as fd, os.scandir(fd) as entries:
+                for entry in entries:
+                    stat = entry.stat(follow_symlinks=False)
+                    if statmod.S_ISDIR(stat.st_mode):
+                        if stat.st_mode & _DIR_ACCESS != _DIR_ACCESS:
+                            os.chmod(entry.name, stat.st_mode | _DIR_ACCESS, dir_fd=fd)
+                        subdirs.append(os.path.join(relpath, entry.name))
+                    else:
+                        os.unlink(entry.name, dir_fd=fd)
+                        files += 1
+                        if stat.st_nlink == 1 or self._last_link(stat):
+                            bytes_freed += stat.st_size
+                        if not self._continue():
+                            break
+        finally:
+            self._account(files, bytes_freed)
+
+        return subdirs, subdirs
+
+    def _last_link(self, stat):
+        """Returns whether the removed link of a file with several links was its last one, seen by links removed since
+        its link count was taken."""
+        key = (stat.st_dev, stat.st_ino)
+        with self._lock:
+            removed, nlink = self._links.pop(key, (0, 0))
+            removed += 1
+            nlink = max(nlink, stat.st_nlink)
+            if removed == nlink:
+                return True
+            self._links[key] = (removed, nlink)
+            if len(self._links) > RECENT_LINKS:
+                self._links.popitem(last=False)
+        return False
+
+    def _account(self, files, bytes_freed):
+        with self._lock:
+            self.files += files
+            self.bytes_freed += bytes_freed
+
+    def _continue(self):
+        if self.tick and not self.tick():
+            self._stopped = True
+        return not self._stopped
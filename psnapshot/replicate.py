@@ -0,0 +1,231 @@
+"""Incremental replication of a destination directory to a mirror on another volume, preserving hard links."""
+import errno
+import logging
+import os
+import sqlite3
+import stat as statmod
+
+from psnapshot.clone import chown_if_permitted, copy_file, copy_special
+from psnapshot.exceptions import DestinationDirError
+from psnapshot.remove import TreeRemover
+from psnapshot.snapshot import find_all_snapshots
+from psnapshot.state import state_path
+from psnapshot.trash import move_to_trash
+from psnapshot.walk import DIR_FLAGS, DirectoryRecord, opened_directory
+
+_logger = logging.getLogger(__name__)
+
+
+def _timestamp(snapshot):
+    return '{:%Y%m%d%H%M%S}'.format(snapshot.time)
+
+
+class InodeMap:
+    """Persistent map from inodes of the destination directory to a path on the mirror holding the same file.
+
+    Mirror paths are stored as snapshot timestamp and path within the snapshot, so they stay valid when snapshots move
+    between queues. Each inode points to the newest mirror snapshot containing it, which expires last.
+
+    :ivar path: Path to SQLite database.
+    """
+
+    FILENAME = 'replica.sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS inodes (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, snapshot TEXT, '
+                         'relpath TEXT, PRIMARY KEY (dev, ino))')
+
+    def close(self):
+        self._db.close()
+
+    def commit(self):
+        self._db.commit()
+
+    def lookup(self, stat):
+        """Returns snapshot timestamp and relative path of the mirror file recorded for inode of given status, if the
+        inode still holds the file it held when recorded."""
+        row = self._db.execute('SELECT size, mtime_ns, snapshot, relpath FROM inodes WHERE dev = ? AND ino = ?',
+                               (stat.st_dev, stat.st_ino)).fetchone()
+        if row and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2], row[3]
+        return None
+
+    def record(self, stat, timestamp, relpath):
+        self._db.execute('INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?, ?, ?)',
+                         (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, timestamp, relpath))
+
+
+class Replicator:
+    """Mirrors the snapshots of a destination directory.
+
+    Snapshots are matched by time. Mirror snapshots that moved to another queue in the destination directory are
+    renamed, expired ones are moved to the mirror's trash once missing snapshots have been copied, to be reaped like in
+    the destination directory. Only missing snapshots are copied, oldest first. Their files are hard-linked to a mirror
+    file holding the same source inode if there is one, found by an InodeMap kept in the mirror's state folder, so
+    memory does not grow with the number of hard links. Other files are copied like TreeCloner does when it cannot
+    link, FIFOs and device files are created anew. Owners, permissions and times of all entries are kept, as far as
+    privileges allow.
+
+    Snapshots are copied into the mirror's state folder and renamed into place when complete. An incomplete copy left
+    by an interrupted run is removed and copied again.
+
+    :ivar dstdir: Path to destination directory replicated.
+    :ivar mirror: Path to mirror directory.
+    :ivar renamed: Number of mirror snapshots renamed.
+    :ivar expired: Number of mirror snapshots moved to trash.
+    :ivar created: Number of mirror snapshots copied.
+    :ivar links: Number of files hard-linked to files already on the mirror.
+    :ivar copies: Number of files copied or created anew.
+    :ivar bytes_copied: Size of files copied.
+    """
+
+    BUILD_DIRNAME = 'replicate'
+
+    def __init__(self, dstdir, mirror):
+        self.dstdir = dstdir
+        self.mirror = mirror
+        self.renamed = 0
+        self.expired = 0
+        self.created = 0
+        self.links = 0
+        self.copies = 0
+        self.bytes_copied = 0
+
+        self._map = None
+        self._names = {}
+        self._building = None
+
+        if not os.path.isdir(mirror):
+            raise DestinationDirError('Mirror directory {} does not exist.'.format(mirror))
+
+    def replicate(self):
+        sources = {_timestamp(snapshot): snapshot for snapshot in find_all_snapshots(self.dstdir)}
+        mirrored = {_timestamp(snapshot): snapshot for snapshot in find_all_snapshots(self.mirror)}
+
+        for timestamp, snapshot in mirrored.items():
+            source = sources.get(timestamp)
+            if source is None:
+                # still linked to until expired:
+                self._names[timestamp] = snapshot.name
+                continue
+            if source.name != snapshot.name:
+                _logger.info('Renaming mirror snapshot {} to {}.'.format(snapshot.name, source.name))
+                os.rename(snapshot.dirpath, os.path.join(self.mirror, source.name))
+                self.renamed += 1
+            self._names[timestamp] = source.name
+
+        self._map = InodeMap(state_path(self.mirror, InodeMap.FILENAME))
+        try:
+            for timestamp in sorted(sources):
+                if timestamp not in mirrored:
+                    self._copy_snapshot(sources[timestamp], timestamp)
+        finally:
+            self._map.close()
+
+        # expired last, so new snapshots can still link to their files:
+        for timestamp, snapshot in mirrored.items():
+            if timestamp not in sources:
+                _logger.info('Moving expired mirror snapshot {} to trash.'.format(snapshot.name))
+                move_to_trash(snapshot.dirpath)
+                self.expired += 1
+
+        _logger.info('Mirror updated: {} snapshots copied with {} links and {} copied files of {} bytes, {} renamed, {} expired.'.format(
+            self.created, self.links, self.copies, self.bytes_copied, self.renamed, self.expired))
+
+    def _copy_snapshot(self, snapshot, timestamp):
+        _logger.info('Copying snapshot {} to mirror.'.format(snapshot.name))
+        build_path = state_path(self.mirror, self.BUILD_DIRNAME)
+        if os.path.lexists(build_path):
+            _logger.info('Removing incomplete copy of an earlier run.')
+            TreeRemover(build_path).remove()
+        os.mkdir(build_path)
+        self._building = timestamp
+
+        src_root_fd = os.open(snapshot.dirpath, DIR_FLAGS)
+        try:
+            dst_root_fd = os.open(build_path, DIR_FLAGS)
+            try:
+                created = [DirectoryRecord.from_stat(os.curdir, os.stat(src_root_fd))]
+                backlog = [os.curdir]
+                while backlog:
+                    relpath = backlog.pop()
+                    subdirs = self._copy_directory(relpath, timestamp, src_root_fd, dst_root_fd)
+                    created.extend(subdirs)
+                    backlog.extend(record.relpath for record in subdirs)
+
+                # children are created after their parents, so this restores times bottom-up:
+                for record in reversed(created):
+                    chown_if_permitted(record.relpath, record.uid, record.gid, dst_root_fd)
+                    os.chmod(record.relpath, statmod.S_IMODE(record.mode), dir_fd=dst_root_fd)
+                    os.utime(record.relpath, ns=(record.atime_ns, record.mtime_ns), dir_fd=dst_root_fd)
+            finally:
+                os.close(dst_root_fd)
+        finally:
+            os.close(src_root_fd)
+
+        os.rename(build_path, os.path.join(self.mirror, snapshot.name))
+        # recorded paths are only valid once the snapshot is in place:
+        self._map.commit()
+        self._names[timestamp] = snapshot.name
+        self._building = None
+        self.created += 1
+
+    def _copy_directory(self, relpath, timestamp, src_root_fd, dst_root_fd):
+        """Copies files of a single directory and creates its subdirectories, returned as records of their source status."""
+        subdirs = []
+        with opened_directory(relpath, src_root_fd) as src_fd, opened_directory(relpath, dst_root_fd) as dst_fd:
+            with os.scandir(src_fd) as entries:
+                for entry in entries:
+                    stat = entry.stat(follow_symlinks=False)
+                    path = os.path.join(relpath, entry.name)
+                    if statmod.S_ISDIR(stat.st_mode):
+                        os.mkdir(entry.name, statmod.S_IRWXU, dir_fd=dst_fd)
+                        subdirs.append(DirectoryRecord.from_stat(path, stat))
+                    elif statmod.S_ISREG(stat.st_mode):
+                        if not self._link(entry.name, stat, dst_fd):
+                            copy_file(entry.name, src_fd, dst_fd)
+                            self.copies += 1
+                            self.bytes_copied += stat.st_size
+                        self._map.record(stat, timestamp, os.path.normpath(path))
+                    elif statmod.S_ISLNK(stat.st_mode):
+                        os.symlink(os.readlink(entry.name, dir_fd=src_fd), entry.name, dir_fd=dst_fd)
+                        chown_if_permitted(entry.name, stat.st_uid, stat.st_gid, dst_fd)
+                        os.utime(entry.name, ns=(stat.st_atime_ns, stat.st_mtime_ns), dir_fd=dst_fd, follow_symlinks=False)
+                    else:
+                        copy_special(stat, dst_fd, entry.name)
+                        self.copies += 1
+        return subdirs
+
+    def _link(self, name, stat, dst_fd):
+        """Links file to mirror file holding the same source inode, returns whether there is one that could be linked."""
+        location = self._map.lookup(stat)
+        if location is None:
+            return False
+        timestamp, relpath = location
+        if timestamp == self._building:
+            # linked within the snapshot being copied:
+            target = os.path.join(state_path(self.mirror, self.BUILD_DIRNAME), relpath)
+        elif timestamp in self._names:
+            target = os.path.join(self.mirror, self._names[timestamp], relpath)
+        else:
+            return False
+
+        try:
+            target_stat = os.stat(target, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        # copies keep size and modification time, so a mirror file changed since is not linked:
+        if (target_stat.st_size, target_stat.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return False
+
+        try:
+            os.link(target, name, dst_dir_fd=dst_fd)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            return False
+        self.links += 1
+        return True
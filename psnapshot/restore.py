@@ -0,0 +1,130 @@
+"""Restoring files and directory trees from snapshots."""
+import concurrent.futures
+import logging
+import os
+import time
+
+from psnapshot.clone import LINK_FALLBACK_ERRORS, TreeCloner, copy_file
+from psnapshot.exceptions import RestoreError
+from psnapshot.walk import DEFAULT_WORKERS, DIR_FLAGS
+
+_logger = logging.getLogger(__name__)
+
+# seconds between progress reports of a running restore:
+PROGRESS_INTERVAL = 5
+
+
+def snapshot_path(snapshot, path):
+    """Returns path of entry within snapshot, given by a path relative to the snapshot root, with or without leading slash."""
+    return os.path.join(snapshot.dirpath, os.path.normpath(path).lstrip(os.sep))
+
+
+def find_snapshot(snapshots, path, time=None):
+    """Returns newest snapshot holding an entry at given path, by default of all snapshots and otherwise of those taken
+    at or before the given time."""
+    candidates = sorted((s for s in snapshots if time is None or s.time <= time), key=lambda s: s.time, reverse=True)
+    for snapshot in candidates:
+        if os.path.lexists(snapshot_path(snapshot, path)):
+            return snapshot
+    raise RestoreError('No snapshot{} holds {}.'.format(' taken at or before {}'.format(time) if time else '', path))
+
+
+class Restorer:
+    """Restores a file or directory tree from a snapshot to a new target path.
+
+    If the target is on the snapshot's file system, files are hard-linked like TreeCloner does when creating snapshots,
+    so restoring takes no space and hardly any time. Then the restored files share their inode with the snapshot and
+    must be replaced rather than modified in place to keep the snapshot intact. Otherwise, or if linking is turned off,
+    files are copied along with their permissions, ownership and times, directories concurrently on a thread pool, see
+    copy_file, which creates FIFOs, sockets and devices anew instead of reading them. Symbolic links are restored as
+    links. Progress and throughput of a directory restore are logged periodically.
+
+    :ivar source: Path to file or directory within a snapshot.
+    :ivar target: Path to restore to, which must not exist yet.
+    :ivar workers: Number of directories restored concurrently.
+    :ivar link: Whether files are hard-linked if the target is on the same file system, otherwise they are copied.
+    :ivar interval: Seconds between progress reports.
+    :ivar linked: Whether files were hard-linked by the last restore.
+    :ivar files: Number of files restored.
+    :ivar bytes_copied: Size of files copied.
+    """
+
+    def __init__(self, source, target, workers=DEFAULT_WORKERS, link=True, interval=PROGRESS_INTERVAL):
+        self.source = source
+        self.target = target
+        self.workers = workers
+        self.link = link
+        self.interval = interval
+        self.linked = False
+        self.files = 0
+        self.bytes_copied = 0
+
+    def restore(self):
+        if not os.path.lexists(self.source):
+            raise RestoreError('Nothing to restore at {}.'.format(self.source))
+        if os.path.lexists(self.target):
+            raise RestoreError('Restore target {} exists already.'.format(self.target))
+
+        parent = os.path.dirname(os.path.abspath(self.target))
+        self.linked = self.link and os.lstat(self.source).st_dev == os.stat(parent).st_dev
+        _logger.info('Restoring {} to {} by {}.'.format(self.source, self.target, 'hard links' if self.linked else 'copying'))
+
+        start = time.monotonic()
+        if os.path.isdir(self.source) and not os.path.islink(self.source):
+            self._restore_tree()
+        else:
+            self._restore_file(parent)
+        self._report('Restored', time.monotonic() - start)
+
+    def _restore_tree(self):
+        cloner = TreeCloner(self.source, self.target, workers=self.workers, link=self.linked, symlinks=True)
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(cloner.clone)
+            while True:
+                try:
+                    future.result(timeout=self.interval)
+                    break
+                except concurrent.futures.TimeoutError:
+                    self._update(cloner)
+                    self._report('Progress:', time.monotonic() - start)
+        self._update(cloner)
+
+    def _update(self, cloner):
+        self.files = cloner.links + sum(cloner.copies.values())
+        self.bytes_copied = cloner.bytes_copied
+
+    def _restore_file(self, parent):
+        if os.path.islink(self.source):
+            os.symlink(os.readlink(self.source), self.target)
+            self.files = 1
+            return
+        if self.linked:
+            try:
+                os.link(self.source, self.target)
+                self.files = 1
+                return
+            except OSError as e:
+                if e.errno not in LINK_FALLBACK_ERRORS:
+                    raise
+                _logger.debug('Copying %s, cannot link it: %s', self.source, e)
+                self.linked = False
+
+        src_fd = os.open(os.path.dirname(os.path.abspath(self.source)), DIR_FLAGS)
+        try:
+            dst_fd = os.open(parent, DIR_FLAGS)
+            try:
+                copy_file(os.path.basename(self.source), src_fd, dst_fd, os.path.basename(self.target))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        self.files = 1
+        self.bytes_copied = os.stat(self.target).st_size
+
+    def _report(self, prefix, seconds):
+        if self.linked:
+            _logger.info('{} {} files linked after {:.1f} seconds.'.format(prefix, self.files, seconds))
+        else:
+            _logger.info('{} {} files of {} bytes copied after {:.1f} seconds, {:.1f} MiB/s.'.format(
+                prefix, self.files, self.bytes_copied, seconds, self.bytes_copied / 1024 / 1024 / max(seconds, 0.001)))
@@ -0,0 +1,196 @@
+"""Queue rotation planned in memory and applied by a journaled executor."""
+import logging
+import os
+
+from psnapshot.archive import staging_path
+from psnapshot.state import read_json, state_path, write_json
+from psnapshot.trash import move_to_trash, trash_name, trash_path
+
+_logger = logging.getLogger(__name__)
+
+
+class PlannedSnapshot:
+    """Stand-in for a snapshot while queues are rotated, recording moves and deletions instead of performing them.
+
+    :ivar snapshot: Snapshot represented.
+    :ivar original_name: Name of snapshot folder before rotation.
+    :ivar name: Name of snapshot folder after rotation so far, None if deleted.
+    :ivar queue_name: Name of queue after rotation so far, None if deleted.
+    :ivar deleted_from: Name of queue the snapshot was in when deleted, which for snapshots rejected by a queue is the
+        queue before it.
+    :ivar time: Time of snapshot.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.original_name = snapshot.name
+        self.name = snapshot.name
+        self.queue_name = snapshot.queue_name
+        self.deleted_from = None
+        self.time = snapshot.time
+
+    def __str__(self):
+        return self.name or self.original_name
+
+    def move(self, queue_name):
+        if self.queue_name != queue_name:
+            self.name = self.snapshot.build_name(queue_name, self.time)
+            self.queue_name = queue_name
+
+    def delete(self):
+        self.deleted_from = self.queue_name
+        self.name = None
+        self.queue_name = None
+
+    @property
+    def deleted(self):
+        return self.name is None
+
+
+class RotationPlan:
+    """Renames and deletions of snapshot folders resulting from pushing a new snapshot through the queues.
+
+    :ivar renames: Pairs of old and new folder name.
+    :ivar deletes: Folder names of snapshots to be moved to trash.
+    :ivar archives: Folder names of snapshots to be archived before they are moved to trash, see psnapshot.archive.
+    """
+
+    def __init__(self, renames=(), deletes=(), archives=()):
+        self.renames = list(renames)
+        self.deletes = list(deletes)
+        self.archives = list(archives)
+
+    def __bool__(self):
+        return bool(self.renames or self.deletes or self.archives)
+
+    @classmethod
+    def from_snapshots(cls, planned_snapshots, archive_queue_name=None):
+        """Returns plan leading from original to final state of given planned snapshots. Snapshots deleted from the
+        queue of given name are archived instead of deleted right away."""
+        plan = cls()
+        for planned in planned_snapshots:
+            if planned.deleted and archive_queue_name is not None and planned.deleted_from == archive_queue_name:
+                plan.archives.append(planned.original_name)
+            elif planned.deleted:
+                plan.deletes.append(planned.original_name)
+            elif planned.name != planned.original_name:
+                plan.renames.append((planned.original_name, planned.name))
+        return plan
+
+    def describe(self):
+        """Returns human readable lines, one per step in order of execution."""
+        lines = ['rename {} -> {}'.format(old, new) for old, new in self.renames]
+        lines.extend('delete {}'.format(name) for name in self.deletes)
+        lines.extend('archive {}'.format(name) for name in self.archives)
+        return lines
+
+
+class RotationExecutor:
+    """Applies rotation plans to a destination directory.
+
+    Before changing anything, the plan is written to a journal in the state folder, which is removed once the plan has
+    been applied. All steps are renames, either within the destination directory or into its trash, so whether a step
+    has been done can be told by which of its two names exists. An interrupted rotation is therefore resumed or rolled
+    back from the journal alone.
+
+    Renames are applied before deletions, so all remaining snapshots carry their final queue names as early as
+    possible. Snapshots to be archived are moved to the staging folder of psnapshot.archive instead of trash.
+
+    :ivar dstdir: Path to destination directory.
+    """
+
+    VERSION = 1
+    JOURNAL_FILENAME = 'rotation.json'
+
+    def __init__(self, dstdir):
+        self.dstdir = dstdir
+
+    @property
+    def journal_path(self):
+        return state_path(self.dstdir, self.JOURNAL_FILENAME)
+
+    def pending(self):
+        """Returns journal of an interrupted rotation, or None."""
+        journal = read_json(self.journal_path)
+        try:
+            if journal['version'] == self.VERSION:
+                return journal
+        except (TypeError, KeyError):
+            pass
+        return None
+
+    def apply(self, plan):
+        if not plan:
+            return
+
+        journal = {
+            'version': self.VERSION,
+            'renames': plan.renames,
+            # trash names are fixed up front to find deleted snapshots again when rolling back:
+            'deletes': [(name, trash_name(name)) for name in plan.deletes],
+            'archives': plan.archives,
+        }
+        write_json(self.journal_path, journal)
+        self._forward(journal)
+        os.unlink(self.journal_path)
+
+    def resume(self):
+        """Completes interrupted rotation, returns whether there was one."""
+        journal = self.pending()
+        if journal is None:
+            return False
+
+        _logger.warning('Resuming interrupted rotation of snapshots in {}.'.format(self.dstdir))
+        self._forward(journal)
+        os.unlink(self.journal_path)
+        return True
+
+    def rollback(self):
+        """Reverts interrupted rotation as far as its deleted snapshots have not been reaped, returns whether there was one."""
+        journal = self.pending()
+        if journal is None:
+            return False
+
+        _logger.warning('Rolling back interrupted rotation of snapshots in {}.'.format(self.dstdir))
+        for name in reversed(journal.get('archives', [])):
+            if not self._move(staging_path(self.dstdir, name), os.path.join(self.dstdir, name)):
+                if not os.path.lexists(os.path.join(self.dstdir, name)):
+                    _logger.error('Snapshot {} has already been archived and cannot be restored.'.format(name))
+        trashdir = trash_path(self.dstdir)
+        for name, trashed in reversed(journal['deletes']):
+            if not self._move(os.path.join(trashdir, trashed), os.path.join(self.dstdir, name)):
+                if not os.path.lexists(os.path.join(self.dstdir, name)):
+                    _logger.error('Snapshot {} has already been reaped from trash and cannot be restored.'.format(name))
+        for old, new in reversed(journal['renames']):
+            self._move(os.path.join(self.dstdir, new), os.path.join(self.dstdir, old))
+
+        os.unlink(self.journal_path)
+        return True
+
+    def _forward(self, journal):
+        for old, new in journal['renames']:
+            _logger.debug('Renaming snapshot %s to %s.', old, new)
+            if not self._move(os.path.join(self.dstdir, old), os.path.join(self.dstdir, new)):
+                if not os.path.lexists(os.path.join(self.dstdir, new)):
+                    _logger.warning('Snapshot {} vanished during rotation.'.format(old))
+        for name, trashed in journal['deletes']:
+            path = os.path.join(self.dstdir, name)
+            if os.path.lexists(path):
+                _logger.debug('Moving snapshot %s to trash.', name)
+                move_to_trash(path, trashed)
+        for name in journal.get('archives', []):
+            path = os.path.join(self.dstdir, name)
+            if os.path.lexists(path):
+                _logger.debug('Moving snapshot %s to archive staging folder.', name)
+                os.makedirs(staging_path(self.dstdir), exist_ok=True)
+                os.rename(path, staging_path(self.dstdir, name))
+
+    @staticmethod
+    def _move(src, dst):
+        """Renames src to dst unless this already happened, returns whether something was renamed."""
+        if not os.path.lexists(src):
+            return False
+        if os.path.lexists(dst):
+            raise FileExistsError('Cannot rename {} to existing {}.'.format(src, dst))
+        os.rename(src, dst)
+        return True
@@ -0,0 +1,191 @@
+"""Parallel scanning of source directory trees."""
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from psnapshot.exclude import NO_EXCLUDES
+from psnapshot.state import read_json, write_json
+from psnapshot.walk import DEFAULT_WORKERS, DIR_FLAGS, opened_directory, walk_parallel
+
+_logger = logging.getLogger(__name__)
+
+
+class Manifest:
+    """Directory times and newest file times of a tree as seen by a previous scan.
+
+    Changing the set of files in a directory updates the directory's modification time. As long as files are replaced
+    rather than rewritten in place, which is what rsync does by default, a directory whose own modification time and
+    inode did not change still has the same files and the same newest file time.
+
+    :ivar root: Path to root of scanned directory tree.
+    :ivar entries: Records ``[mtime_ns, inode, newest_file_mtime_ns, subdir_names]`` by path relative to root.
+    :ivar scan_ns: Time in nanoseconds when the recorded scan started.
+    :ivar exclude: Exclude patterns the scan applied, records are only valid for the same patterns.
+    """
+
+    VERSION = 1
+
+    # directories modified this close to the scan may have changed again within the file system's time resolution:
+    RACY_NS = 2 * 1000000000
+
+    def __init__(self, root, entries=None, scan_ns=0, exclude=()):
+        self.root = root
+        self.entries = entries or {}
+        self.scan_ns = scan_ns
+        self.exclude = list(exclude)
+
+    @classmethod
+    def load(cls, path, root, exclude=()):
+        """Returns manifest stored at path, or None if it is missing, unreadable or was recorded for another tree or
+        other exclude patterns."""
+        data = read_json(path)
+        try:
+            if data['version'] == cls.VERSION and data['root'] == root:
+                if data.get('exclude', []) == list(exclude):
+                    return cls(root, data['entries'], data['scan_ns'], exclude)
+                _logger.info('Exclude patterns changed since manifest {} was recorded, falling back to full scan.'.format(path))
+                return None
+        except (TypeError, KeyError):
+            pass
+
+        if data is not None:
+            _logger.warning('Manifest {} cannot be used, falling back to full scan.'.format(path))
+        return None
+
+    def save(self, path):
+        write_json(path, {'version': self.VERSION, 'root': self.root, 'scan_ns': self.scan_ns, 'exclude': self.exclude,
+                          'entries': self.entries})
+
+    def lookup(self, relpath, stat):
+        """Returns recorded newest file time and subdirectory names of directory, if it did not change since."""
+        entry = self.entries.get(relpath)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_ino and entry[0] < self.scan_ns - self.RACY_NS:
+            return entry[2], entry[3]
+        return None
+
+
+class TreeScanner:
+    """Finds the newest file modification time in a directory tree.
+
+    Directories are read with ``os.scandir`` in batches on a thread pool. Modification times are kept as integer
+    nanoseconds, conversion to other representations is left to the caller.
+
+    If a manifest of a previous scan is given, directories unchanged since are not read again. Then only directories
+    are stat'ed and the manifest is replaced by an updated one after a complete scan.
+
+    Excluded files are ignored and excluded directories are not entered, see psnapshot.exclude.
+
+    :ivar root: Path to root of scanned directory tree.
+    :ivar manifest: Optional manifest of previous scan.
+    :ivar exclude: Exclude rules.
+    :ivar workers: Number of threads reading directories concurrently.
+    :ivar batch_size: Number of directories read by a single task.
+    :ivar include_root: Whether the modification time of the root directory itself counts.
+    :ivar files: Number of files whose modification time was read by the last scan.
+    """
+
+    DEFAULT_BATCH_SIZE = 16
+
+    def __init__(self, root, manifest=None, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, include_root=True,
+                 exclude=NO_EXCLUDES):
+        self.root = root
+        self.manifest = manifest
+        self.exclude = exclude
+        self.include_root = include_root
+        self.workers = workers
+        self.batch_size = batch_size
+        self.files = 0
+
+        self._lock = threading.Lock()
+        self._root_fd = None
+
+    def newest_mtime_ns(self, limit_ns=None):
+        """Returns modification time in nanoseconds of the newest file in tree, by default including the root directory.
+
+        If a limit is given, scanning stops as soon as a time at or beyond the limit has been seen and that time is
+        returned instead of the overall maximum. This is enough to decide whether the tree changed since a given time.
+        """
+        scan_ns = int(time.time() * 1000000000)
+        self.files = 0
+        newest = os.stat(self.root).st_mtime_ns if self.include_root else 0
+        if limit_ns is not None and newest >= limit_ns:
+            return newest
+
+        # records of all directories are only kept if they go into a new manifest:
+        entries = {} if self.manifest is not None else None
+
+        self._root_fd = os.open(self.root, DIR_FLAGS)
+        try:
+            with contextlib.closing(walk_parallel(self._scan_directory, [''], self.workers, self.batch_size)) as results:
+                for relpath, entry in results:
+                    if entry is None:
+                        continue
+
+                    if entries is not None:
+                        entries[relpath] = entry
+                    if entry[2] > newest:
+                        newest = entry[2]
+                        if limit_ns is not None and newest >= limit_ns:
+                            _logger.debug('Found modification beyond limit, stopping scan early.')
+                            return newest
+        finally:
+            os.close(self._root_fd)
+
+        if self.manifest is not None:
+            self.manifest = Manifest(self.root, entries, scan_ns, self.exclude.patterns)
+
+        return newest
+
+    def _scan_directory(self, relpath):
+        """Returns manifest record of directory and relative paths of its subdirectories."""
+        with contextlib.ExitStack() as stack:
+            try:
+                fd = stack.enter_context(opened_directory(relpath or os.curdir, self._root_fd))
+            except FileNotFoundError:
+                _logger.debug('Directory %s vanished during scan.', relpath)
+                return (relpath, None), []
+
+            stat = os.fstat(fd)
+            known = self.manifest.lookup(relpath, stat) if self.manifest is not None else None
+            if known:
+                newest, subdirs = known
+            else:
+                newest, subdirs, files = self._read_directory(relpath, fd)
+                with self._lock:
+                    self.files += files
+
+        entry = [stat.st_mtime_ns, stat.st_ino, newest, subdirs]
+        return (relpath, entry), [os.path.join(relpath, name) for name in subdirs]
+
+    def _read_directory(self, relpath, fd):
+        """Returns newest file modification time in directory, the names of its subdirectories and the number of files."""
+        newest = 0
+        subdirs = []
+        files = 0
+        exclude = self.exclude
+
+        with os.scandir(fd) as entries:
+            for entry in entries:
+                is_dir = entry.is_dir()
+                if exclude and exclude.excluded(relpath, entry.name, is_dir):
+                    continue
+                if is_dir:
+                    # like os.walk, symbolic links to directories are not followed:
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
+                else:
+                    try:
+                        mtime = entry.stat().st_mtime_ns
+                    except FileNotFoundError:
+                        # a dangling symbolic link counts with its own time, a file removed meanwhile not at all:
+                        try:
+                            mtime = entry.stat(follow_symlinks=False).st_mtime_ns
+                        except FileNotFoundError:
+                            continue
+                    files += 1
+                    if mtime > newest:
+                        newest = mtime
+
+        return newest, subdirs, files
@@ -0,0 +1,90 @@
+"""Replay of snapshot runs through the queue rotation in memory, to size retention before queues are rolled out."""
+import logging
+
+from psnapshot.snapshot import Snapshot, chain_queues, rotate
+
+_logger = logging.getLogger(__name__)
+
+# queues log every accepted snapshot, which is no use for thousands of simulated runs:
+_queue_logger = logging.getLogger('psnapshot.snapshot')
+
+
+class SimulatedSnapshot:
+    """Snapshot without folder, moving and deleting only changes its queue."""
+
+    __slots__ = ('queue_name', 'time')
+
+    def __init__(self, queue_name, time):
+        self.queue_name = queue_name
+        self.time = time
+
+    def __str__(self):
+        return Snapshot.build_name(self.queue_name, self.time)
+
+    @property
+    def name(self):
+        return str(self)
+
+    def move(self, queue_name):
+        self.queue_name = queue_name
+
+    def delete(self):
+        self.queue_name = None
+
+
+class Simulation:
+    """Runs snapshot creation at regular intervals against queues holding simulated snapshots.
+
+    Each run is assumed to find a changed source, so a snapshot is created whenever the first queue accepts one.
+
+    :ivar queues: Simulated queues, initially empty.
+    :ivar runs: Number of runs simulated.
+    :ivar created: Number of snapshots created.
+    :ivar end: Time of last run.
+    """
+
+    def __init__(self, queues):
+        self.queues = chain_queues(queues)
+        self.runs = 0
+        self.created = 0
+        self.end = None
+
+    @property
+    def expired(self):
+        """Number of snapshots deleted so far."""
+        return self.created - sum(len(queue.snapshots) for queue in self.queues)
+
+    def run(self, start, interval, count):
+        """Simulates given number of runs, the first at start time."""
+        disabled = _queue_logger.disabled
+        _queue_logger.disabled = True
+        try:
+            first_queue = self.queues[0]
+            time = start
+            for _ in range(count):
+                if first_queue.snapshot_time_acceptable(time):
+                    rotate(self.queues, SimulatedSnapshot(first_queue.name, time))
+                    self.created += 1
+                self.end = time
+                time += interval
+        finally:
+            _queue_logger.disabled = disabled
+
+        self.runs += count
+
+    def summary(self):
+        """Returns lines describing retained snapshots per queue, ages relative to the last run."""
+        lines = ['{:<16} {:>9} {:>16} {:>16} {:>16}'.format('queue', 'retained', 'newest age', 'oldest age', 'max gap')]
+        for queue in self.queues:
+            snapshots = list(queue.snapshots)
+            if snapshots:
+                gaps = [newer.time - older.time for newer, older in zip(snapshots, snapshots[1:])]
+                lines.append('{:<16} {:>4}/{:<4} {:>16} {:>16} {:>16}'.format(
+                    queue.name, len(snapshots), queue.length, str(self.end - snapshots[0].time), str(self.end - snapshots[-1].time),
+                    str(max(gaps)) if gaps else '-'))
+            else:
+                lines.append('{:<16} {:>4}/{:<4} {:>16} {:>16} {:>16}'.format(queue.name, 0, queue.length, '-', '-', '-'))
+
+        lines.append('{} runs, {} snapshots created, {} expired, {} retained.'.format(self.runs, self.created, self.expired,
+                                                                                      self.created - self.expired))
+        return lines
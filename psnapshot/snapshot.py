@@ -1,10 +1,22 @@
 """Single snapshot."""
+import collections
+import copy
 import datetime
 import logging
 import os
 import re
-import shutil
-from psnapshot.exceptions import SnapshotDirError, SourceDirError, DestinationDirError, QueueSpecError
+from psnapshot.archive import ArchiveExporter, archive_filename, staging_path
+from psnapshot.catalog import Catalog
+from psnapshot.clone import TreeCloner
+from psnapshot.dedup import Deduplicator
+from psnapshot.exclude import NO_EXCLUDES
+from psnapshot.exceptions import SnapshotDirError, SourceDirError, DestinationDirError, QueueSpecError, CloneError
+from psnapshot.index import SnapshotIndex
+from psnapshot.metrics import NULL_METRICS
+from psnapshot.rotation import PlannedSnapshot, RotationExecutor, RotationPlan
+from psnapshot.scan import Manifest, TreeScanner
+from psnapshot.state import STATE_DIRNAME, state_path
+from psnapshot.trash import Reaper, move_to_trash, trash_name, trash_path
 
 _logger = logging.getLogger(__name__)
 
@@ -31,15 +43,28 @@ class Snapshot:
     def build_name(cls, queue_name, time):
         return cls.SNAPSHOT_NAME_FORMAT.format(queue=queue_name, time=time)
 
+    @classmethod
+    def from_index(cls, dirpath):
+        """Returns snapshot of directory known to exist and to have a valid name, without checking either."""
+        snapshot = cls.__new__(cls)
+        snapshot.dirpath = dirpath
+        snapshot.name = os.path.basename(dirpath)
+
+        queue_name, _, timestamp_text = snapshot.name.rpartition('-')
+        snapshot.queue_name = queue_name
+        snapshot.time = cls.parse_time(timestamp_text)
+        return snapshot
+
     @classmethod
     def parse_name(cls, name):
         m = cls.SNAPSHOT_NAME_PATTERN.match(name)
         if not m:
             raise SnapshotDirError('Snapshot directory name {} does not match naming pattern.'.format(name))
 
-        queue_name = m.group('queue')
+        return m.group('queue'), cls.parse_time(m.group('timestamptext'))
 
-        timestamp_text = m.group('timestamptext')
+    @classmethod
+    def parse_time(cls, timestamp_text):
         year = int(timestamp_text[0:4])
         month = int(timestamp_text[4:6])
         day = int(timestamp_text[6:8])
@@ -47,9 +72,7 @@ class Snapshot:
         minute = int(timestamp_text[10:12])
         second = int(timestamp_text[12:14])
 
-        time = datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second)
-
-        return queue_name, time
+        return datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second)
 
     def move(self, queue_name):
         """Moves this snapshot to given queue by renaming the directory if needed."""
@@ -58,7 +81,7 @@ class Snapshot:
             dstdir = os.path.dirname(self.dirpath)
             dirpath = os.path.join(dstdir, name)
 
-            _logger.debug('Renaming snapshot {old} to {new}.'.format(old=self.name, new=name))
+            _logger.debug('Renaming snapshot %s to %s.', self.name, name)
             os.rename(self.dirpath, dirpath)
 
             self.dirpath = dirpath
@@ -66,37 +89,72 @@ class Snapshot:
             self.queue_name = queue_name
 
     def delete(self):
-        """Deletes snapshot from disk."""
-        _logger.debug('Deleting snaphot {} from disk.'.format(self.name))
-        shutil.rmtree(self.dirpath)
+        """Deletes snapshot from disk by moving it to the trash, space is reclaimed later by Organizer.reap_trash."""
+        _logger.debug('Moving snaphot %s to trash.', self.name)
+        move_to_trash(self.dirpath)
         self.dirpath = None
         self.name = None
         self.queue_name = None
         self.time = None
 
 
+PERIOD_UNITS = {
+    'm': datetime.timedelta(minutes=1),
+    'h': datetime.timedelta(hours=1),
+    'd': datetime.timedelta(days=1),
+    'w': datetime.timedelta(weeks=1),
+}
+
+PERIOD_PATTERN = re.compile(r'^(?P<count>\d+)(?P<unit>[{}]?)$'.format(''.join(PERIOD_UNITS)))
+
+
+def parse_period(text):
+    """Returns time span of a textual period like 15m, 6h or 7d, a number without unit counts days."""
+    m = PERIOD_PATTERN.match(text)
+    if not m:
+        raise ValueError('Period {} cannot be parsed.'.format(text))
+    return int(m.group('count')) * PERIOD_UNITS[m.group('unit') or 'd']
+
+
 class Queue:
     """Ordered list of snapshots.
 
     :ivar name: Name of the queue.
-    :ivar delta: Number of days between two snapshots in this queue.
+    :ivar delta: Number of time units between two snapshots in this queue.
+    :ivar unit: Time unit of delta, one of m, h, d or w for minutes, hours, days and weeks.
     :ivar length: Number of snapshots in consolidated queue.
-    :ivar snapshots: List of snapshots currently in queue.
+    :ivar period: Time span between two snapshots in this queue.
+    :ivar timedelta: Minimum time span between two snapshots accepted in this queue.
+    :ivar snapshots: Snapshots currently in queue, newest first.
     """
 
-    QUEUE_TEXT_PATTERN = re.compile(r'^(?P<name>\w+)\[(?P<length>\d+)\]\+(?P<delta>\d+)$')
+    QUEUE_TEXT_PATTERN = re.compile(r'^(?P<name>\w+)\[(?P<length>\d+)\]\+(?P<delta>\d+)(?P<unit>[{}]?)$'.format(''.join(PERIOD_UNITS)))
+
+    # runs do not happen at exactly the same time of day, so snapshots are accepted a little early, see feed_from:
+    TOLERANCE = 0.4
+    MAX_TOLERANCE = datetime.timedelta(days=0.4)
 
-    def __init__(self, name, delta, length):
+    def __init__(self, name, delta, length, unit='d'):
         self.name = name
         self.delta = delta if not isinstance(delta, str) else int(delta)
+        self.unit = unit or 'd'
         self.length = length if not isinstance(length, str) else int(length)
 
         self.snapshots = []
-        self.timedelta = datetime.timedelta(days=self.delta - 0.4)
+        self.period = self.delta * PERIOD_UNITS[self.unit]
+        self.timedelta = self.period - min(self.MAX_TOLERANCE, self.TOLERANCE * self.period)
+
+    @property
+    def snapshots(self):
+        return self._snapshots
+
+    @snapshots.setter
+    def snapshots(self, snapshots):
+        self._snapshots = collections.deque(snapshots)
 
     @classmethod
     def from_textual_spec(cls, textspec):
-        """Creates a queue from a textual specification like daily[7]+1."""
+        """Creates a queue from a textual specification like daily[7]+1 or hourly[48]+1h."""
         if textspec:
             m = cls.QUEUE_TEXT_PATTERN.match(textspec)
             if m:
@@ -104,53 +162,137 @@ class Queue:
 
         raise AttributeError('textspec cannot be parsed.')
 
+    def feed_from(self, queue):
+        """Limits tolerance to a fraction of the period of the queue passing its snapshots on to this one. They arrive
+        that far apart, so a longer tolerance accepts a snapshot sooner than the period, e.g. one of an hourly queue
+        15 hours after the last one in a daily queue."""
+        self.timedelta = self.period - min(self.MAX_TOLERANCE, self.TOLERANCE * self.period, self.TOLERANCE * queue.period)
+
     def snapshot_time_acceptable(self, time):
         """Returns flag if given snapshot is old enough to be entered in this queue."""
-        return not self.snapshots or (time - self.snapshots[0].time >= self.timedelta)
+        return not self._snapshots or (time - self._snapshots[0].time >= self.timedelta)
 
     def push_snapshots(self, snapshots):
         """Pushes new snapshots to beginning of this queue and returns the snapshots falling off the other end."""
 
-        popped = []
+        if len(snapshots) == 1:
+            return self.push_snapshot(snapshots[0])
+
+        popped = collections.deque()
         for snapshot in reversed(snapshots):
-            popped[:0] = self.push_snapshot(snapshot)
-        return popped
+            popped.extendleft(reversed(self.push_snapshot(snapshot)))
+        return list(popped)
 
     def push_snapshot(self, snapshot):
         """Pushes a new snapshot to beginning of queue and returns the snapshots falling off the other end."""
 
         # snapshots are only accepted if the newest one is old enough with respect to specified delta time:
         if self.snapshot_time_acceptable(snapshot.time):
-            _logger.info('Accepting snapshot {s} in queue {q}.'.format(s=snapshot.name, q=self.name))
-            self.snapshots.insert(0, snapshot)
+            _logger.info('Accepting snapshot %s in queue %s.', snapshot, self.name)
+            self._snapshots.appendleft(snapshot)
             snapshot.move(self.name)
         else:
-            _logger.info('Snapshot {s} not accepted in queue {q}, deleting it.'.format(s=snapshot.name, q=self.name))
+            _logger.info('Snapshot %s not accepted in queue %s, deleting it.', snapshot, self.name)
             snapshot.delete()
 
         # cleanup old snapshots:
-        popped = self.snapshots[self.length:]
+        popped = []
+        while len(self._snapshots) > self.length:
+            popped.append(self._snapshots.pop())
         if popped:
-            _logger.info('Popping {n} snapshots from end of queue {q}'.format(n=len(popped), q=self.name))
-            self.snapshots = self.snapshots[:self.length]
+            _logger.info('Popping %d snapshots from end of queue %s', len(popped), self.name)
+            popped.reverse()
 
         return popped
 
 
+def chain_queues(queues):
+    """Ties tolerance of each queue to the queue before it, see Queue.feed_from, and returns the queues."""
+    for queue, next_queue in zip(queues, queues[1:]):
+        next_queue.feed_from(queue)
+    return queues
+
+
+def rotate(queues, snapshot):
+    """Pushes a new snapshot into first queue and propagates possible queue updates, snapshots popping from the last queue
+    are deleted."""
+    propagated_snapshots = (snapshot,)
+    for queue in queues:
+        if not propagated_snapshots:
+            return
+        propagated_snapshots = queue.push_snapshots(propagated_snapshots)
+
+    # snapshots popping from last queue are no longer required:
+    for popped in propagated_snapshots:
+        popped.delete()
+
+
+def find_all_snapshots(dstdir, save_index=True):
+    """Returns all snapshots in destination directory regardless of queue, using the snapshot index while it is current.
+    Otherwise the directory is scanned and, unless disabled, the index is replaced."""
+    index = SnapshotIndex.load(dstdir)
+    if index and index.is_current():
+        _logger.debug('Using snapshot index of destination directory.')
+        return [Snapshot.from_index(os.path.join(dstdir, name)) for name in index.snapshots]
+
+    _logger.debug('Snapshot index missing or outdated, scanning destination directory.')
+    if not save_index:
+        return scan_snapshots(dstdir)[0]
+    index = SnapshotIndex.prepare(dstdir)
+    snapshots, index.others = scan_snapshots(dstdir)
+    index.snapshots = [snapshot.name for snapshot in snapshots]
+    index.save()
+    return snapshots
+
+
+def scan_snapshots(dstdir):
+    """Returns snapshots found in destination directory and names of all other entries."""
+    snapshots = []
+    others = []
+
+    for entry in os.listdir(dstdir):
+        fullpath = os.path.join(dstdir, entry)
+        if os.path.isdir(fullpath):
+            try:
+                snapshots.append(Snapshot(fullpath))
+                continue
+            except SnapshotDirError:
+                _logger.debug('Destination folder contains directory %s that does not match naming convention. Skipped.', entry)
+        others.append(entry)
+
+    return snapshots, others
+
+
 class Organizer:
     """Management of snapshot queues.
 
     :ivar srcdir: Path to source directory of which snapshots are managed.
     :ivar dstdir: Path to directory where snapshot folders are stored.
     :ivar queues: Snapshot queues to be managed.
+    :ivar incremental_scan: Whether a manifest of the source tree is kept to only rescan changed directories.
+    :ivar unmapped_names: Names of snapshot folders found in destination directory that belong to no queue.
+    :ivar metrics: Phase timing and counters of the current run, see psnapshot.metrics.
+    :ivar archive_dir: Optional path to directory where snapshots expiring from the last queue are archived.
+    :ivar archive_compression: Compression of archives, xz or gz.
+    :ivar exclude: Exclude rules, excluded source entries neither count for the source time nor go into snapshots.
     """
 
-    def __init__(self, srcdir, dstdir, queues):
+    MANIFEST_FILENAME = 'manifest.json'
+    BUILD_DIRNAME = 'build'
+
+    def __init__(self, srcdir, dstdir, queues, incremental_scan=False, metrics=NULL_METRICS, archive_dir=None, archive_compression='xz',
+                 exclude=NO_EXCLUDES):
         self.srcdir = srcdir
         self.dstdir = dstdir
-        self.queues = queues
+        self.queues = chain_queues(queues)
+        self.incremental_scan = incremental_scan
+        self.metrics = metrics
+        self.archive_dir = archive_dir
+        self.archive_compression = archive_compression
+        self.exclude = exclude
 
         self.queue_by_name = {q.name: q for q in self.queues}
+        self.unmapped_names = []
 
         if not os.path.exists(srcdir):
             raise SourceDirError('Source directory {} does not exist.'.format(srcdir))
@@ -160,22 +302,30 @@ class Organizer:
             raise QueueSpecError('No snapshot queues defined.')
 
         for queue in self.queues:
-            _logger.debug('Queue {name}: delta = {delta} length = {length}'.format(name=queue.name, delta=queue.delta, length=queue.length))
+            _logger.debug('Queue {name}: delta = {delta}{unit} length = {length}'.format(name=queue.name, delta=queue.delta, unit=queue.unit,
+                                                                                         length=queue.length))
 
     @property
     def srcdir_time(self):
         """Time of newest file in source directory."""
-
-        # get the latest modification time of the directory tree:
-        newest_time = datetime.datetime.fromtimestamp(os.path.getmtime(self.srcdir))
-
-        for dirpath, _, filenames in os.walk(self.srcdir):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                time = datetime.datetime.fromtimestamp(os.path.getmtime(filepath))
-                newest_time = max(time, newest_time)
-
-        return self.rounded_to_seconds(newest_time)
+        return self.scan_srcdir()
+
+    def scan_srcdir(self, dry_run=False):
+        """Returns time of newest file in source directory. In a dry run, an updated manifest is not saved."""
+        with self.metrics.phase('scan'):
+            if not self.incremental_scan:
+                scanner = TreeScanner(self.srcdir, exclude=self.exclude)
+                newest_ns = scanner.newest_mtime_ns()
+            else:
+                path = state_path(self.dstdir, self.MANIFEST_FILENAME)
+                manifest = Manifest.load(path, self.srcdir, self.exclude.patterns) or Manifest(self.srcdir, exclude=self.exclude.patterns)
+                scanner = TreeScanner(self.srcdir, manifest=manifest, exclude=self.exclude)
+                newest_ns = scanner.newest_mtime_ns()
+                if not dry_run:
+                    scanner.manifest.save(path)
+
+        self.metrics.count('files_scanned', scanner.files)
+        return self.time_from_ns(newest_ns)
 
     @property
     def snapshots_time(self):
@@ -185,42 +335,52 @@ class Organizer:
         return queue.snapshots[0].time if queue.snapshots else None
 
     @classmethod
-    def rounded_to_seconds(cls, time):
-        return datetime.datetime(year=time.year,
-                                 month=time.month,
-                                 day=time.day,
-                                 hour=time.hour,
-                                 minute=time.minute,
-                                 second=time.second)
+    def time_from_ns(cls, time_ns):
+        """Converts a file system timestamp in nanoseconds to a local time rounded down to seconds."""
+        return datetime.datetime.fromtimestamp(time_ns // 1000000000)
 
-    def find_snapshots(self):
-        """Detects valid snapshot folders in destination directory."""
+    def find_snapshots(self, dry_run=False):
+        """Detects valid snapshot folders in destination directory, using the snapshot index while it is current. In a
+        dry run, an outdated index is not replaced."""
 
         for queue in self.queues:
             queue.snapshots = []
 
-        for entry in os.listdir(self.dstdir):
-            fullpath = os.path.join(self.dstdir, entry)
-            if os.path.isdir(fullpath):
-                try:
-                    snapshot = Snapshot(fullpath)
-                    queue = self.queue_by_name.get(snapshot.queue_name)
-                    if queue:
-                        _logger.debug('Found snapshot {s}, part of queue {q}.'.format(s=snapshot.name, q=queue.name))
-                        queue.snapshots.append(snapshot)
-                    else:
-                        queue_names = ', '.join(self.queue_by_name.keys())
-                        _logger.warning('Snapshot {s} cannot be mapped to any of these queues: {qs}. Skipped.'.format(s=snapshot, qs=queue_names))
-                except SnapshotDirError:
-                    _logger.debug('Destination folder contains directory {} that does not match naming convention. Skipped.'.format(entry))
+        snapshots = find_all_snapshots(self.dstdir, save_index=not dry_run)
+
+        self.unmapped_names = []
+        for snapshot in snapshots:
+            queue = self.queue_by_name.get(snapshot.queue_name)
+            if queue:
+                _logger.debug('Found snapshot %s, part of queue %s.', snapshot.name, queue.name)
+                queue.snapshots.append(snapshot)
+            else:
+                queue_names = ', '.join(self.queue_by_name.keys())
+                _logger.warning('Snapshot {s} cannot be mapped to any of these queues: {qs}. Skipped.'.format(s=snapshot, qs=queue_names))
+                self.unmapped_names.append(snapshot.name)
 
         # sort queues:
         for queue in self.queues:
             queue.snapshots = sorted(queue.snapshots, key=lambda s: s.time, reverse=True)
 
-    def create_snapshot(self):
-        """Returns a new snapshot of source directory."""
-        srcdir_time = self.srcdir_time
+    def save_index(self):
+        """Records the snapshots currently in queues as snapshot index, so the next run does not need to scan for them."""
+        index = SnapshotIndex.prepare(self.dstdir)
+        known_names = {snapshot.name for queue in self.queues for snapshot in queue.snapshots}
+        known_names.update(self.unmapped_names)
+
+        for name in os.listdir(self.dstdir):
+            if name in known_names:
+                index.snapshots.append(name)
+            else:
+                index.others.append(name)
+
+        index.save()
+
+    def create_snapshot(self, srcdir_time=None):
+        """Returns a new snapshot of source directory, using given time of newest source file if already known."""
+        if srcdir_time is None:
+            srcdir_time = self.srcdir_time
         _logger.debug('Source folder timestamp:      {0:%Y%m%d%H%M%S}.'.format(srcdir_time))
         if self.snapshots_time:
             _logger.debug('Destination folder timestamp: {0:%Y%m%d%H%M%S}.'.format(self.snapshots_time))
@@ -232,25 +392,150 @@ class Organizer:
         name = Snapshot.build_name(self.queues[0].name, srcdir_time)
         _logger.info('Creating hard-linked snapshot {} of source directory.'.format(name))
 
-        path = os.path.join(self.dstdir, name)
+        # built in the state folder, so an incomplete tree is never taken for a snapshot:
+        build_path = os.path.join(self.dstdir, STATE_DIRNAME, self.BUILD_DIRNAME)
+        os.makedirs(os.path.dirname(build_path), exist_ok=True)
+        resume = os.path.isdir(build_path)
+        if resume:
+            _logger.info('Resuming snapshot creation interrupted by an earlier run.')
 
+        cloner = TreeCloner(self.srcdir, build_path, resume=resume, exclude=self.exclude)
         try:
-            shutil.copytree(self.srcdir, path, copy_function=os.link)
-            _logger.debug('Hard-linked copy complete.')
+            with self.metrics.phase('clone'):
+                cloner.clone()
+            _logger.debug('Hard-linked copy complete, {} links in {} directories, {} files kept from earlier run.'.format(
+                cloner.links, cloner.directories, cloner.reused))
+            if cloner.copies:
+                _logger.warning('Copied {} files that could not be hard-linked: {}.'.format(
+                    sum(cloner.copies.values()), ', '.join('{} by {}'.format(n, method) for method, n in sorted(cloner.copies.items()))))
+
+            path = os.path.join(self.dstdir, name)
+            os.rename(build_path, path)
             return Snapshot(path)
-        except shutil.Error as e:
-            _logger.error('Creation of hard-linked tree copy failed: {}'.format(e))
-            _logger.debug('Trying to clean up invalid copy.')
-            shutil.rmtree(path, ignore_errors=True)
+        except CloneError as e:
+            _logger.error('Creation of hard-linked tree copy failed, keeping it to be resumed by next run: {}'.format(e))
             return None
+        finally:
+            self.metrics.count('links_created', cloner.links)
+            for method, count in cloner.copies.items():
+                self.metrics.count('files_copied_{}'.format(method), count)
+
+    def deduplicate(self, snapshot):
+        """Relinks files of a new snapshot to identical files of the latest snapshot in the first queue, see
+        psnapshot.dedup. Returns the number of bytes relinked."""
+        if not self.queues[0].snapshots:
+            return 0
+
+        deduplicator = Deduplicator(self.dstdir)
+        try:
+            deduplicator.deduplicate(self.queues[0].snapshots[0].dirpath, snapshot.dirpath)
+        finally:
+            self.metrics.count('files_deduplicated', deduplicator.files)
+            self.metrics.count('bytes_deduplicated', deduplicator.bytes)
+        return deduplicator.bytes
+
+    def update_catalog(self):
+        """Adds new snapshots to the file catalog of the destination directory and drops expired ones, see
+        psnapshot.catalog."""
+        # unmapped snapshots as well, like the history and find commands, so the catalog does not flip between both:
+        snapshots = [s for queue in self.queues for s in queue.snapshots]
+        snapshots.extend(Snapshot.from_index(os.path.join(self.dstdir, name)) for name in self.unmapped_names)
+        catalog = Catalog(state_path(self.dstdir, Catalog.FILENAME))
+        try:
+            catalog.update(snapshots)
+        finally:
+            catalog.close()
 
-    def push(self, snapshot):
-        """Pushes a new snapshot into first queue and propagates possible queue updates. Returns flag, whether new snapshot was added."""
+    def plan_push(self, snapshot):
+        """Returns plan of renames and deletions resulting from pushing a new snapshot into first queue and propagating
+        possible queue updates. Neither the queues nor any snapshot folder are changed."""
+        planned = {id(s): PlannedSnapshot(s) for s in [snapshot] + [s for queue in self.queues for s in queue.snapshots]}
 
-        propagated_snapshots = (snapshot,)
+        # queues are rotated as copies holding stand-ins for the snapshots:
+        queues = []
         for queue in self.queues:
-            propagated_snapshots = queue.push_snapshots(propagated_snapshots)
+            queue_copy = copy.copy(queue)
+            queue_copy.snapshots = [planned[id(s)] for s in queue.snapshots]
+            queues.append(queue_copy)
+
+        rotate(queues, planned[id(snapshot)])
+        archive_queue_name = self.queues[-1].name if self.archive_dir else None
+        return RotationPlan.from_snapshots(planned.values(), archive_queue_name), queues
+
+    def push(self, snapshot, dry_run=False):
+        """Pushes a new snapshot into first queue and propagates possible queue updates. Returns the plan applied, which
+        is only computed in a dry run."""
+        plan, queues = self.plan_push(snapshot)
+        if dry_run:
+            return plan
+
+        RotationExecutor(self.dstdir).apply(plan)
+        self.metrics.count('renames', len(plan.renames))
+        self.metrics.count('snapshots_expired', len(plan.deletes) + len(plan.archives))
+
+        for queue, rotated in zip(self.queues, queues):
+            queue.snapshots = [Snapshot.from_index(os.path.join(self.dstdir, s.name)) if s.name != s.original_name else s.snapshot
+                               for s in rotated.snapshots]
+        return plan
+
+    def plan_snapshot(self, srcdir_time=None):
+        """Returns name of the snapshot the next run would create and the resulting rotation plan, or None and an empty plan
+        if no snapshot is due. Neither snapshot folders nor bookkeeping files are changed."""
+        if srcdir_time is None:
+            srcdir_time = self.scan_srcdir(dry_run=True)
+        if not self.queues[0].snapshot_time_acceptable(srcdir_time):
+            return None, RotationPlan()
 
-        # snapshots popping from last queue are no longer required:
-        for snapshot in propagated_snapshots:
-            snapshot.delete()
+        name = Snapshot.build_name(self.queues[0].name, srcdir_time)
+        return name, self.push(Snapshot.from_index(os.path.join(self.dstdir, name)), dry_run=True)
+
+    def recover_rotation(self, rollback=False):
+        """Resumes or rolls back rotation interrupted by an earlier run, returns whether there was one."""
+        executor = RotationExecutor(self.dstdir)
+        return executor.rollback() if rollback else executor.resume()
+
+    def export_archives(self):
+        """Archives snapshots waiting in staging folder after expiring from the last queue, unless their archive exists.
+        Returns names of snapshots archived."""
+        try:
+            names = sorted(os.listdir(staging_path(self.dstdir)))
+        except FileNotFoundError:
+            return []
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archived = []
+        for name in names:
+            path = os.path.join(self.archive_dir, archive_filename(name, self.archive_compression))
+            if os.path.exists(path):
+                continue
+
+            _logger.info('Archiving expired snapshot {} to {}.'.format(name, path))
+            exporter = ArchiveExporter(path, self.archive_compression)
+            try:
+                exporter.export(staging_path(self.dstdir, name), name)
+            finally:
+                self.metrics.count('files_archived', exporter.files)
+                self.metrics.count('bytes_archived', exporter.bytes)
+            archived.append(name)
+        return archived
+
+    def trash_archived(self):
+        """Moves staged snapshots whose archive is complete to trash."""
+        try:
+            names = os.listdir(staging_path(self.dstdir))
+        except FileNotFoundError:
+            return
+
+        for name in names:
+            if self.archive_dir and os.path.exists(os.path.join(self.archive_dir, archive_filename(name, self.archive_compression))):
+                os.makedirs(trash_path(self.dstdir), exist_ok=True)
+                os.rename(staging_path(self.dstdir, name), os.path.join(trash_path(self.dstdir), trash_name(name)))
+
+    def reap_trash(self, timeout=None, rate=None):
+        """Reclaims space of deleted snapshots, returns whether the trash has been emptied."""
+        reaper = Reaper(trash_path(self.dstdir), timeout=timeout, rate=rate)
+        try:
+            return reaper.reap()
+        finally:
+            self.metrics.count('files_removed', reaper.removed)
+            self.metrics.count('bytes_freed', reaper.bytes_freed)
@@ -0,0 +1,48 @@
+"""Bookkeeping files kept next to the snapshots in the destination directory."""
+import json
+import logging
+import os
+import tempfile
+
+_logger = logging.getLogger(__name__)
+
+STATE_DIRNAME = '.psnapshot'
+
+
+def state_path(dstdir, *names):
+    """Returns path of a bookkeeping file in the state folder of given destination directory."""
+    return os.path.join(dstdir, STATE_DIRNAME, *names)
+
+
+def write_atomic(path, data):
+    """Atomically replaces file at given path by given bytes."""
+    dirpath = os.path.dirname(path)
+    os.makedirs(dirpath, exist_ok=True)
+
+    fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def write_json(path, data):
+    """Atomically replaces file at given path by JSON representation of data."""
+    write_atomic(path, json.dumps(data, separators=(',', ':')).encode())
+
+
+def read_json(path):
+    """Returns data read from JSON file, or None if file is missing or unreadable."""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        _logger.warning('Ignoring unreadable bookkeeping file {}: {}'.format(path, e))
+        return None
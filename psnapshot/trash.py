@@ -0,0 +1,102 @@
+"""Deferred deletion of snapshots via a trash folder in the destination directory."""
+import logging
+import os
+import threading
+import time
+import uuid
+
+from psnapshot.remove import TreeRemover
+from psnapshot.walk import DEFAULT_WORKERS
+
+_logger = logging.getLogger(__name__)
+
+TRASH_DIRNAME = '.trash'
+
+
+def trash_path(dstdir):
+    """Returns path of trash folder in given destination directory."""
+    return os.path.join(dstdir, TRASH_DIRNAME)
+
+
+def trash_name(name):
+    """Returns unique name in trash for given name, the same snapshot name may be expired more than once until trash is reaped."""
+    return '{}.{}'.format(name, uuid.uuid4().hex[:8])
+
+
+def move_to_trash(path, name=None):
+    """Moves file or directory to trash folder next to it under given or a new unique name, which only takes a rename."""
+    trashdir = trash_path(os.path.dirname(path))
+    os.makedirs(trashdir, exist_ok=True)
+    os.rename(path, os.path.join(trashdir, name or trash_name(os.path.basename(path))))
+
+
+class Reaper:
+    """Reclaims space of trashed snapshots.
+
+    Trash left behind by interrupted runs is reaped just the same, so reaping can be stopped at any time and resumed
+    later.
+
+    :ivar trashdir: Path to trash folder.
+    :ivar timeout: Optional number of seconds after which reaping stops, leaving the rest for a later run.
+    :ivar rate: Optional maximum number of files removed per second.
+    :ivar workers: Number of directories removed concurrently.
+    :ivar removed: Number of files removed so far.
+    :ivar bytes_freed: Approximate size of removed files that had no other hard links, see TreeRemover.
+    """
+
+    def __init__(self, trashdir, timeout=None, rate=None, workers=DEFAULT_WORKERS):
+        self.trashdir = trashdir
+        self.timeout = timeout
+        self.rate = rate
+        self.workers = workers
+        self.removed = 0
+        self.bytes_freed = 0
+
+        self._lock = threading.Lock()
+        self._ticks = 0
+        self._start = None
+
+    def reap(self):
+        """Removes content of trash folder and returns whether it has been emptied completely."""
+        self._start = time.monotonic()
+
+        try:
+            names = os.listdir(self.trashdir)
+        except FileNotFoundError:
+            return True
+
+        try:
+            for name in names:
+                _logger.info('Reclaiming {} from trash.'.format(name))
+                remover = TreeRemover(os.path.join(self.trashdir, name), workers=self.workers, tick=self._tick)
+                try:
+                    remover.remove()
+                finally:
+                    self.removed += remover.files
+                    self.bytes_freed += remover.bytes_freed
+
+                if not remover.complete:
+                    _logger.info('Reaping stopped after {} seconds, trash is not empty yet.'.format(self.timeout))
+                    return False
+        finally:
+            _logger.info('Removed {} files from trash, freeing {} bytes.'.format(self.removed, self.bytes_freed))
+
+        os.rmdir(self.trashdir)
+        return True
+
+    def _tick(self):
+        """Accounts for a removed entry, throttles to configured rate and returns whether reaping may continue."""
+        with self._lock:
+            self._ticks += 1
+            ticks = self._ticks
+        elapsed = time.monotonic() - self._start
+
+        if self.timeout is not None and elapsed >= self.timeout:
+            return False
+
+        if self.rate:
+            ahead = ticks / self.rate - elapsed
+            if ahead > 0:
+                time.sleep(ahead)
+
+        return True
@@ -0,0 +1,146 @@
+"""Disk space accounting of snapshots sharing hard-linked files."""
+import array
+import logging
+import os
+import stat as statmod
+import time
+
+from psnapshot.state import state_path, write_atomic
+from psnapshot.walk import DEFAULT_WORKERS, walk_parallel
+
+_logger = logging.getLogger(__name__)
+
+USAGE_DIRNAME = 'usage'
+
+
+class InodeTable:
+    """Inodes referenced by a single snapshot, stored as parallel arrays of unsigned integers.
+
+    Snapshots do not change once created, so a table is scanned once and cached in the state folder of the destination
+    directory. It is keyed by snapshot time, which is kept when snapshots move between queues.
+
+    :ivar inodes: Inode numbers.
+    :ivar sizes: File sizes.
+    :ivar counts: Number of links to inode inside the snapshot.
+    :ivar nlinks: Total number of links to inode at scan time.
+    :ivar scan_ns: Time of scan.
+    """
+
+    VERSION = 1
+    TYPECODE = 'Q'
+
+    def __init__(self, inodes, sizes, counts, nlinks, scan_ns):
+        self.inodes = inodes
+        self.sizes = sizes
+        self.counts = counts
+        self.nlinks = nlinks
+        self.scan_ns = scan_ns
+
+    @classmethod
+    def scan(cls, path, workers=DEFAULT_WORKERS):
+        """Returns table of all non-directory entries below given path."""
+        scan_ns = int(time.time() * 1000000000)
+        sizes = {}
+        counts = {}
+        nlinks = {}
+
+        for records in walk_parallel(cls._scan_directory, [path], workers):
+            for i in range(0, len(records), 3):
+                ino = records[i]
+                counts[ino] = counts.get(ino, 0) + 1
+                sizes[ino] = records[i + 1]
+                nlinks[ino] = records[i + 2]
+
+        inodes = array.array(cls.TYPECODE, sorted(counts))
+        return cls(inodes,
+                   array.array(cls.TYPECODE, (sizes[ino] for ino in inodes)),
+                   array.array(cls.TYPECODE, (counts[ino] for ino in inodes)),
+                   array.array(cls.TYPECODE, (nlinks[ino] for ino in inodes)),
+                   scan_ns)
+
+    @classmethod
+    def _scan_directory(cls, dirpath):
+        records = array.array(cls.TYPECODE)
+        subdirs = []
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                stat = entry.stat(follow_symlinks=False)
+                if statmod.S_ISDIR(stat.st_mode):
+                    subdirs.append(entry.path)
+                else:
+                    records.extend((stat.st_ino, stat.st_size, stat.st_nlink))
+        return records, subdirs
+
+    @classmethod
+    def load(cls, path):
+        """Returns table cached at given path, or None if there is no usable one."""
+        try:
+            with open(path, 'rb') as file:
+                header = array.array(cls.TYPECODE)
+                header.fromfile(file, 3)
+                if header[0] != cls.VERSION:
+                    return None
+
+                columns = []
+                for _ in range(4):
+                    column = array.array(cls.TYPECODE)
+                    column.fromfile(file, header[1])
+                    columns.append(column)
+                return cls(*columns, scan_ns=header[2])
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError) as e:
+            _logger.warning('Ignoring unreadable usage cache {}: {}'.format(path, e))
+            return None
+
+    def save(self, path):
+        header = array.array(self.TYPECODE, (self.VERSION, len(self.inodes), self.scan_ns))
+        write_atomic(path, b''.join(a.tobytes() for a in (header, self.inodes, self.sizes, self.counts, self.nlinks)))
+
+
+def snapshot_usage(dstdir, snapshots, rescan=False, workers=DEFAULT_WORKERS):
+    """Returns exclusive and shared bytes of each given snapshot.
+
+    Exclusive bytes belong to inodes whose links all live inside the snapshot, so they are freed when the snapshot is
+    deleted. Link counts are taken from the most recent scan of a snapshot containing the inode. They may be outdated
+    if other links were removed since, so exclusive sizes err towards being too small. Use rescan to refresh them.
+    """
+    usage_dir = state_path(dstdir, USAGE_DIRNAME)
+    tables = []
+    cache_names = set()
+
+    for snapshot in snapshots:
+        cache_name = '{:%Y%m%d%H%M%S}'.format(snapshot.time)
+        cache_names.add(cache_name)
+        cache_path = os.path.join(usage_dir, cache_name)
+
+        table = None if rescan else InodeTable.load(cache_path)
+        if table is None:
+            _logger.info('Scanning snapshot {} for disk usage.'.format(snapshot.name))
+            table = InodeTable.scan(snapshot.dirpath, workers)
+            table.save(cache_path)
+        tables.append(table)
+
+    # caches of expired snapshots:
+    for name in os.listdir(usage_dir) if os.path.isdir(usage_dir) else ():
+        if name not in cache_names:
+            os.unlink(os.path.join(usage_dir, name))
+
+    totals = {}
+    nlinks = {}
+    for table in sorted(tables, key=lambda t: t.scan_ns):
+        for ino, count, nlink in zip(table.inodes, table.counts, table.nlinks):
+            totals[ino] = totals.get(ino, 0) + count
+            nlinks[ino] = nlink
+
+    usage = []
+    for table in tables:
+        exclusive = shared = 0
+        for ino, size, count in zip(table.inodes, table.sizes, table.counts):
+            if count == totals[ino] and count >= nlinks[ino]:
+                exclusive += size
+            else:
+                shared += size
+        usage.append((exclusive, shared))
+
+    return usage
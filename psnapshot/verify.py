@@ -0,0 +1,235 @@
+"""Checksum manifests of snapshots, verified with file hashes memoized by inode."""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import sqlite3
+import stat as statmod
+
+from psnapshot.state import state_path, write_atomic
+from psnapshot.walk import DEFAULT_WORKERS, walk_parallel
+
+_logger = logging.getLogger(__name__)
+
+CHECKSUMS_DIRNAME = 'checksums'
+HASH_ALGORITHM = 'sha256'
+READ_SIZE = 1024 * 1024
+
+Problem = collections.namedtuple('Problem', 'kind path')
+Problem.__doc__ = """Difference between a snapshot and its checksum manifest, kind is one of missing, added or modified, or
+a malformed line of the manifest, given by its number instead of a path."""
+
+MISSING = 'missing'
+ADDED = 'added'
+MODIFIED = 'modified'
+MALFORMED = 'malformed'
+
+
+def hash_file(path):
+    """Returns hex digest of file content, run in worker processes."""
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_files(paths, workers=DEFAULT_WORKERS):
+    """Returns digests of files given as paths by key, hashed on a process pool."""
+    if not paths:
+        return {}
+    keys = list(paths)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(keys, executor.map(hash_file, [paths[key] for key in keys], chunksize=64)))
+
+
+class HashCache:
+    """Persistent file hashes keyed by device, inode, size and modification time.
+
+    All hard links to an inode share these, so a file is hashed once no matter in how many snapshots it appears. A
+    file rewritten in place gets a new size or modification time and thereby a new key.
+
+    Keys are looked up in batches joined against the table of hashes, and keys seen since opening the cache are
+    recorded in a temporary table, so neither takes memory for all files of a destination directory.
+
+    :ivar path: Path to SQLite database.
+    """
+
+    FILENAME = 'hashes.sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, '
+                         'PRIMARY KEY (dev, ino, size, mtime_ns))')
+        for table in ('wanted', 'seen'):
+            self._db.execute('CREATE TEMP TABLE {} (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                             'PRIMARY KEY (dev, ino, size, mtime_ns))'.format(table))
+
+    def close(self):
+        self._db.close()
+
+    def lookup(self, keys, seen_only=False):
+        """Returns known digests of given keys as dictionary, optionally only of keys marked as seen."""
+        with self._db:
+            self._db.execute('DELETE FROM wanted')
+            self._db.executemany('INSERT OR IGNORE INTO wanted VALUES (?, ?, ?, ?)', keys)
+            rows = self._db.execute('SELECT dev, ino, size, mtime_ns, digest FROM wanted JOIN hashes USING (dev, ino, size, mtime_ns)' +
+                                    (' JOIN seen USING (dev, ino, size, mtime_ns)' if seen_only else '')).fetchall()
+            self._db.execute('DELETE FROM wanted')
+        return {row[:4]: row[4] for row in rows}
+
+    def mark_seen(self, keys):
+        """Records given keys as seen, their hashes are kept by prune."""
+        with self._db:
+            self._db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?, ?, ?)', keys)
+
+    def store(self, digests):
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', (key + (digest,) for key, digest in digests.items()))
+
+    def prune(self):
+        """Removes all hashes of keys not marked as seen."""
+        with self._db:
+            self._db.execute('DELETE FROM hashes WHERE NOT EXISTS (SELECT 1 FROM seen WHERE seen.dev = hashes.dev AND seen.ino = hashes.ino '
+                             'AND seen.size = hashes.size AND seen.mtime_ns = hashes.mtime_ns)')
+
+
+def list_files(root, workers=DEFAULT_WORKERS):
+    """Returns hash keys of all regular files in tree by path relative to root."""
+    files = {}
+    for records in walk_parallel(_list_directory, [(root, '')], workers):
+        files.update(records)
+    return files
+
+
+def _list_directory(item):
+    root, relpath = item
+    records = []
+    subdirs = []
+    with os.scandir(os.path.join(root, relpath)) as entries:
+        for entry in entries:
+            stat = entry.stat(follow_symlinks=False)
+            path = os.path.join(relpath, entry.name)
+            if statmod.S_ISDIR(stat.st_mode):
+                subdirs.append((root, path))
+            elif statmod.S_ISREG(stat.st_mode):
+                records.append((path, (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)))
+    return records, subdirs
+
+
+def load_manifest(path, malformed=None):
+    """Returns digests by relative path of a checksum manifest in the format of sha256sum, or None if there is none.
+
+    Malformed lines are skipped, their numbers are appended to the given list.
+    """
+    digests = {}
+    try:
+        with open(path, encoding='utf-8', errors='surrogateescape') as file:
+            for number, line in enumerate(file, 1):
+                digest, separator, relpath = line.rstrip('\n').partition('  ')
+                if not (digest and separator and relpath):
+                    if malformed is not None:
+                        malformed.append(number)
+                    continue
+                digests[relpath] = digest
+    except FileNotFoundError:
+        return None
+    return digests
+
+
+def save_manifest(path, digests):
+    lines = ('{}  {}\n'.format(digest, relpath) for relpath, digest in sorted(digests.items()))
+    write_atomic(path, ''.join(lines).encode('utf-8', errors='surrogateescape'))
+
+
+def compare(manifest, digests):
+    """Returns problems of current digests of a snapshot compared to its manifest, sorted by path."""
+    problems = [Problem(MISSING, path) for path in manifest if path not in digests]
+    for path, digest in digests.items():
+        expected = manifest.get(path)
+        if expected is None:
+            problems.append(Problem(ADDED, path))
+        elif expected != digest:
+            problems.append(Problem(MODIFIED, path))
+    return sorted(problems, key=lambda p: p.path)
+
+
+class Verifier:
+    """Verifies snapshots of a destination directory against their checksum manifests, creating missing manifests.
+
+    Files are hashed on a process pool, each inode only once across all snapshots. Hashes are cached between runs, so
+    only new inodes are read unless a rehash is requested, which reads all files again to detect silent corruption.
+    Snapshots are verified one after the other, so only the files and manifest of a single snapshot are held in memory.
+
+    :ivar dstdir: Path to destination directory.
+    :ivar workers: Number of processes hashing files.
+    :ivar rehash: Whether cached hashes are ignored.
+    :ivar hashed: Number of files hashed by last verification.
+    """
+
+    def __init__(self, dstdir, workers=DEFAULT_WORKERS, rehash=False):
+        self.dstdir = dstdir
+        self.workers = workers
+        self.rehash = rehash
+        self.hashed = 0
+
+    def verify(self, snapshots):
+        """Returns problems found for each given snapshot, an empty list for intact snapshots and those verified the first time."""
+        checksums_dir = state_path(self.dstdir, CHECKSUMS_DIRNAME)
+        os.makedirs(checksums_dir, exist_ok=True)
+
+        self.hashed = 0
+        results = []
+        manifest_names = set()
+        cache = HashCache(state_path(self.dstdir, HashCache.FILENAME))
+        try:
+            for snapshot in snapshots:
+                _logger.info('Verifying snapshot {}.'.format(snapshot.name))
+                current = self._digests(cache, snapshot.dirpath, list_files(snapshot.dirpath))
+
+                # keyed by time, which is kept when snapshots move between queues:
+                manifest_name = '{:%Y%m%d%H%M%S}'.format(snapshot.time)
+                manifest_names.add(manifest_name)
+                manifest_path = os.path.join(checksums_dir, manifest_name)
+
+                malformed = []
+                manifest = load_manifest(manifest_path, malformed)
+                if manifest is None:
+                    _logger.info('Recording checksum manifest of snapshot {}.'.format(snapshot.name))
+                    save_manifest(manifest_path, current)
+                    results.append([])
+                else:
+                    results.append([Problem(MALFORMED, 'line {}'.format(number)) for number in malformed] + compare(manifest, current))
+
+            # hashes of files only held by expired snapshots:
+            cache.prune()
+        finally:
+            cache.close()
+
+        # manifests of expired snapshots:
+        for name in os.listdir(checksums_dir):
+            if name not in manifest_names:
+                os.unlink(os.path.join(checksums_dir, name))
+
+        return results
+
+    def _digests(self, cache, root, files):
+        """Returns digests of files of a snapshot by relative path, hashing each key neither cached nor hashed before once."""
+        # a rehash only uses hashes of its own:
+        digests = cache.lookup(files.values(), seen_only=self.rehash)
+        missing = {}
+        for relpath, key in files.items():
+            if key not in digests and key not in missing:
+                missing[key] = os.path.join(root, relpath)
+        _logger.info('Hashing {} of {} files.'.format(len(missing), len(files)))
+
+        hashed = hash_files(missing, self.workers)
+        self.hashed += len(hashed)
+        cache.store(hashed)
+        cache.mark_seen(files.values())
+        digests.update(hashed)
+
+        return {relpath: digests[key] for relpath, key in files.items()}
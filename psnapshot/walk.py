@@ -0,0 +1,83 @@
+"""Parallel traversal of directory trees."""
+import collections
+import concurrent.futures
+import contextlib
+import os
+
+DEFAULT_WORKERS = 8
+
+DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY
+
+
+class DirectoryRecord:
+    """Compact record of a directory kept during traversal, instead of a full ``os.stat_result``.
+
+    :ivar relpath: Path relative to root of traversed tree.
+    :ivar mode: File mode.
+    :ivar uid: Owner user id.
+    :ivar gid: Owner group id.
+    :ivar atime_ns: Access time in nanoseconds.
+    :ivar mtime_ns: Modification time in nanoseconds.
+    """
+
+    __slots__ = ('relpath', 'mode', 'uid', 'gid', 'atime_ns', 'mtime_ns')
+
+    def __init__(self, relpath, mode, uid, gid, atime_ns, mtime_ns):
+        self.relpath = relpath
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.atime_ns = atime_ns
+        self.mtime_ns = mtime_ns
+
+    @classmethod
+    def from_stat(cls, relpath, stat):
+        return cls(relpath, stat.st_mode, stat.st_uid, stat.st_gid, stat.st_atime_ns, stat.st_mtime_ns)
+
+
+@contextlib.contextmanager
+def opened_directory(relpath, root_fd, flags=DIR_FLAGS):
+    """Returns descriptor of directory relative to open root directory, closed when leaving the with-block.
+
+    Entries are read from the descriptor with ``os.scandir``, which streams them from the kernel in small chunks and
+    builds no paths for them. Together with system calls relative to the descriptor, memory does not grow with the
+    number of entries in a directory, as long as the caller only keeps records of the entries it needs later.
+    """
+    fd = os.open(relpath, flags, dir_fd=root_fd)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def walk_parallel(visit, roots, workers=DEFAULT_WORKERS, batch_size=1):
+    """Visits given roots and all directories discovered below them on a thread pool.
+
+    ``visit`` is called with a single directory and returns a result and the directories to be visited next. Results
+    are yielded in completion order. A bounded number of tasks is kept in flight, each visiting a batch of
+    directories, and no further tasks are started until the caller consumed the results of completed ones. Leaving the
+    generator early cancels all directories not visited yet, errors raised by ``visit`` are passed on to the caller.
+    """
+    backlog = collections.deque(roots)
+    pending = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while backlog or pending:
+                while backlog and len(pending) < 2 * workers:
+                    # depth first, which keeps the backlog short compared to visiting all siblings first:
+                    batch = [backlog.pop() for _ in range(min(batch_size, len(backlog)))]
+                    pending.add(executor.submit(_visit_batch, visit, batch))
+
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for result, children in future.result():
+                        backlog.extend(children)
+                        yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _visit_batch(visit, batch):
+    return [visit(item) for item in batch]
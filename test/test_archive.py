@@ -0,0 +1,80 @@
+import datetime
+import os
+import tarfile
+from unittest import mock
+
+import pytest
+from psnapshot.archive import ArchiveExporter, staging_path
+from psnapshot.control import SnapshotController
+from psnapshot.snapshot import Queue
+from psnapshot.trash import trash_path
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def prepare_tree(tmpdir):
+    root = tmpdir.mkdir('daily-20150101000000')
+    root.mkdir('sub')
+    write(str(root.join('file-A')), 'A' * 5000)
+    os.link(str(root.join('file-A')), str(root.join('sub', 'file-A')))
+    write(str(root.join('sub', 'file-B')), 'B')
+    os.symlink('file-A', str(root.join('link')))
+    return str(root)
+
+
+@pytest.mark.parametrize('compression', ['xz', 'gz'])
+def test_archive_exporter(tmpdir, compression):
+    root = prepare_tree(tmpdir)
+    path = str(tmpdir.join('archive.tar.' + compression))
+
+    exporter = ArchiveExporter(path, compression, queue_size=2)
+    exporter.export(root, 'daily-20150101000000')
+
+    assert (exporter.files, exporter.links, exporter.bytes) == (2, 1, 5001)
+    assert not os.path.exists(path + '.part')
+    with tarfile.open(path) as tar:
+        members = {member.name: member for member in tar.getmembers()}
+        assert sorted(members) == ['daily-20150101000000', 'daily-20150101000000/file-A', 'daily-20150101000000/link',
+                                   'daily-20150101000000/sub', 'daily-20150101000000/sub/file-A', 'daily-20150101000000/sub/file-B']
+        links = [member for member in members.values() if member.islnk()]
+        assert len(links) == 1
+        stored = [member for member in members.values() if member.isfile() and member.name.endswith('file-A')]
+        assert links[0].linkname == stored[0].name
+        assert tar.extractfile(stored[0]).read() == b'A' * 5000
+        assert members['daily-20150101000000/link'].linkname == 'file-A'
+
+
+def test_archive_exporter_error(tmpdir):
+    root = prepare_tree(tmpdir)
+    path = str(tmpdir.join('archive.tar.xz'))
+
+    with mock.patch.object(ArchiveExporter, '_put_content', side_effect=PermissionError()):
+        with pytest.raises(PermissionError):
+            ArchiveExporter(path).export(root, 'daily-20150101000000')
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+def test_controller_archives_expired_snapshot(tmpdir):
+    srcdir = tmpdir.mkdir('src')
+    dstdir = tmpdir.mkdir('dst')
+    archive_dir = str(tmpdir.join('archive'))
+    write(str(srcdir.join('file')), 'data')
+    controller = SnapshotController(str(srcdir), str(dstdir), [Queue('daily', 1, 1)], archive_dir=archive_dir, archive_compression='gz')
+
+    controller.create_snapshot(datetime.datetime(2015, 1, 1))
+    controller.create_snapshot(datetime.datetime(2015, 1, 2))
+
+    assert os.listdir(archive_dir) == ['daily-20150101000000.tar.gz']
+    with tarfile.open(os.path.join(archive_dir, 'daily-20150101000000.tar.gz')) as tar:
+        assert tar.getnames() == ['daily-20150101000000', 'daily-20150101000000/file']
+    # archived snapshot is trashed, to be reaped by the next run:
+    assert os.listdir(staging_path(str(dstdir))) == []
+    assert len(os.listdir(trash_path(str(dstdir)))) == 1
+
+    controller.create_snapshot(datetime.datetime(2015, 1, 2))
+    assert not os.path.exists(trash_path(str(dstdir)))
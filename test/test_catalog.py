@@ -0,0 +1,185 @@
+import datetime
+import os
+import sqlite3
+from unittest import mock
+
+import pytest
+
+from psnapshot.catalog import Catalog
+from psnapshot.control import SnapshotController, main, open_catalog
+from psnapshot.snapshot import Queue, Snapshot
+from psnapshot.state import state_path
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def add_snapshot(dstdir, name, previous=None, changes={}):
+    """Creates snapshot linking all files of previous snapshot, except for changed files written anew."""
+    snapshot = dstdir.mkdir(name)
+    if previous is not None:
+        for dirpath, _, filenames in os.walk(str(previous)):
+            relpath = os.path.relpath(dirpath, str(previous))
+            os.makedirs(os.path.join(str(snapshot), relpath), exist_ok=True)
+            for filename in filenames:
+                if os.path.normpath(os.path.join(relpath, filename)) not in changes:
+                    os.link(os.path.join(dirpath, filename), os.path.join(str(snapshot), relpath, filename))
+    for path, text in changes.items():
+        if text is not None:
+            os.makedirs(os.path.dirname(os.path.join(str(snapshot), path)), exist_ok=True)
+            write(os.path.join(str(snapshot), path), text)
+    return snapshot
+
+
+def snapshots(dstdir):
+    return [Snapshot(str(path)) for path in sorted(dstdir.listdir()) if not path.basename.startswith('.')]
+
+
+def prepare_dstdir(tmpdir):
+    dstdir = tmpdir.mkdir('dst')
+    first = add_snapshot(dstdir, 'daily-20150101000000', changes={'etc/app.conf': 'v1', 'data/a.txt': 'a'})
+    second = add_snapshot(dstdir, 'daily-20150102000000', first, changes={'etc/app.conf': 'v2', 'data/b.txt': 'b'})
+    add_snapshot(dstdir, 'daily-20150103000000', second, changes={'data/a.txt': None})
+    return dstdir
+
+
+def test_catalog_history(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    catalog = Catalog(state_path(str(dstdir), Catalog.FILENAME))
+    catalog.update(snapshots(dstdir))
+
+    history = catalog.history('/etc/app.conf')
+    assert [(v.size, v.first, v.last, v.snapshots) for v in history] == [(2, '20150101000000', '20150101000000', 1),
+                                                                        (2, '20150102000000', '20150103000000', 2)]
+    # a single row per version, not per snapshot:
+    assert catalog._db.execute('SELECT COUNT(*) FROM versions').fetchone()[0] == 4
+    assert catalog.added == 3
+    catalog.close()
+
+
+def test_catalog_expiry(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    catalog = Catalog(state_path(str(dstdir), Catalog.FILENAME))
+    catalog.update(snapshots(dstdir))
+
+    dstdir.join('daily-20150101000000').remove()
+    dstdir.join('daily-20150102000000').rename(dstdir.join('weekly-20150102000000'))
+    add_snapshot(dstdir, 'daily-20150104000000', dstdir.join('daily-20150103000000'))
+    catalog.update(snapshots(dstdir))
+
+    assert (catalog.added, catalog.expired) == (1, 1)
+    assert catalog.history('data/a.txt') == [('data/a.txt', 1, os.stat(str(dstdir.join('weekly-20150102000000', 'data', 'a.txt'))).st_mtime_ns,
+                                              '20150102000000', '20150102000000', 1)]
+    assert [(v.first, v.last, v.snapshots) for v in catalog.history('etc/app.conf')] == [('20150102000000', '20150104000000', 3)]
+    catalog.close()
+
+
+def test_catalog_rebuilds_for_older_snapshot(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    catalog = Catalog(state_path(str(dstdir), Catalog.FILENAME))
+    catalog.update(snapshots(dstdir)[1:])
+
+    catalog.update(snapshots(dstdir))
+
+    assert catalog.added == 3
+    assert catalog.timestamps() == ['20150101000000', '20150102000000', '20150103000000']
+    catalog.close()
+
+
+def test_catalog_add_recovers_from_failure(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    catalog = Catalog(state_path(str(dstdir), Catalog.FILENAME))
+    with mock.patch('psnapshot.catalog.list_files', return_value={'broken': None}):
+        with pytest.raises(TypeError):
+            catalog.update(snapshots(dstdir)[:1])
+
+    catalog.update(snapshots(dstdir))
+
+    assert catalog.timestamps() == ['20150101000000', '20150102000000', '20150103000000']
+    catalog.close()
+
+
+def test_catalog_find(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    catalog = Catalog(state_path(str(dstdir), Catalog.FILENAME))
+    catalog.update(snapshots(dstdir))
+
+    assert [(m.path, m.versions, m.first, m.last) for m in catalog.find('*.txt')] == [
+        ('data/a.txt', 1, '20150101000000', '20150102000000'), ('data/b.txt', 1, '20150102000000', '20150103000000')]
+    assert [m.path for m in catalog.find('/etc/*')] == ['etc/app.conf']
+    assert catalog.find('/*.txt') == []
+    catalog.close()
+
+
+def test_catalog_find_by_file_name(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    catalog = Catalog(state_path(str(dstdir), Catalog.FILENAME))
+    catalog.update(snapshots(dstdir))
+
+    assert [m.path for m in catalog.find('app.*')] == ['etc/app.conf']
+    assert [m.path for m in catalog.find('[!b].txt')] == ['data/a.txt']
+    assert [m.path for m in catalog.find('data/**')] == ['data/a.txt', 'data/b.txt']
+    assert [m.path for m in catalog.find('a[b')] == []
+    catalog.close()
+
+
+def test_catalog_adds_file_names_to_older_catalog(tmpdir):
+    path = state_path(str(tmpdir), Catalog.FILENAME)
+    os.makedirs(os.path.dirname(path))
+    db = sqlite3.connect(path)
+    with db:
+        db.execute('CREATE TABLE paths (id INTEGER PRIMARY KEY, path TEXT UNIQUE)')
+        db.execute('CREATE TABLE versions (path_id INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, first TEXT, last TEXT)')
+        db.execute("INSERT INTO paths VALUES (1, 'etc/app.conf')")
+        db.execute("INSERT INTO versions VALUES (1, 1, 2, 3, '20150101000000', '20150101000000')")
+    db.close()
+
+    catalog = Catalog(path)
+    assert [m.path for m in catalog.find('app.conf')] == ['etc/app.conf']
+    catalog.close()
+
+
+def test_controller_updates_catalog(tmpdir):
+    srcdir = tmpdir.mkdir('src')
+    dstdir = tmpdir.mkdir('dst')
+    write(str(srcdir.join('file')), 'data')
+    controller = SnapshotController(str(srcdir), str(dstdir), [Queue('daily', 1, 2)], catalog=True)
+
+    controller.create_snapshot(datetime.datetime(2015, 1, 1))
+    controller.create_snapshot(datetime.datetime(2015, 1, 2))
+    controller.create_snapshot(datetime.datetime(2015, 1, 3))
+
+    catalog = Catalog(state_path(str(dstdir), Catalog.FILENAME))
+    assert catalog.timestamps() == ['20150102000000', '20150103000000']
+    assert [(v.first, v.last) for v in catalog.history('file')] == [('20150102000000', '20150103000000')]
+    catalog.close()
+
+
+def test_controller_and_commands_catalog_same_snapshots(tmpdir):
+    srcdir = tmpdir.mkdir('src')
+    dstdir = tmpdir.mkdir('dst')
+    write(str(srcdir.join('file')), 'data')
+    add_snapshot(dstdir, 'old-20141231000000', changes={'file': 'old'})
+    controller = SnapshotController(str(srcdir), str(dstdir), [Queue('daily', 1, 2)], catalog=True)
+
+    controller.create_snapshot(datetime.datetime(2015, 1, 1))
+    catalog, names = open_catalog(str(dstdir), 1)
+
+    assert sorted(names.values()) == ['daily-20150101000000', 'old-20141231000000']
+    assert (catalog.added, catalog.expired) == (0, 0)
+    catalog.close()
+
+
+def test_history_and_find_commands(tmpdir, capsys):
+    dstdir = prepare_dstdir(tmpdir)
+
+    main(['history', str(dstdir), 'etc/app.conf'])
+    main(['find', str(dstdir), 'b.txt'])
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 4
+    assert lines[1].split()[-3:] == ['1', 'daily-20150101000000', 'daily-20150101000000']
+    assert lines[2].split()[-3:] == ['2', 'daily-20150102000000', 'daily-20150103000000']
+    assert lines[3] == 'data/b.txt  1 versions in daily-20150102000000 to daily-20150103000000'
@@ -0,0 +1,199 @@
+import errno
+import os
+from unittest import mock
+
+import pytest
+from psnapshot.clone import BUFFERED, COPY_FILE_RANGE, SPECIAL, TreeCloner, copy_file
+from psnapshot.exceptions import CloneError
+from psnapshot.exclude import ExcludeRules
+
+
+def make_file(path, text='data'):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def test_tree_cloner_links_files(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = os.path.join(str(tmpdir), 'dst')
+    os.makedirs(os.path.join(srcdir, 'a', 'b'))
+    os.mkdir(os.path.join(srcdir, 'empty'))
+    make_file(os.path.join(srcdir, 'file-1'))
+    make_file(os.path.join(srcdir, 'a', 'b', 'file-2'))
+    os.chmod(os.path.join(srcdir, 'a'), 0o750)
+    for dirpath in ('a/b', 'a', 'empty', ''):
+        os.utime(os.path.join(srcdir, dirpath), (1000, 2000))
+
+    cloner = TreeCloner(srcdir, dstdir, workers=2)
+    cloner.clone()
+
+    assert cloner.links == 2
+    assert cloner.directories == 3
+    for relpath in ('file-1', os.path.join('a', 'b', 'file-2')):
+        assert os.path.samefile(os.path.join(srcdir, relpath), os.path.join(dstdir, relpath))
+    assert os.listdir(os.path.join(dstdir, 'empty')) == []
+    assert os.stat(os.path.join(dstdir, 'a')).st_mode & 0o777 == 0o750
+    for dirpath in ('a/b', 'a', 'empty', ''):
+        assert os.stat(os.path.join(dstdir, dirpath)).st_mtime == 2000
+
+
+def test_tree_cloner_exclude(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = os.path.join(str(tmpdir), 'dst')
+    os.makedirs(os.path.join(srcdir, 'a', 'cache'))
+    make_file(os.path.join(srcdir, 'a', 'cache', 'file'))
+    make_file(os.path.join(srcdir, 'a', 'file.tmp'))
+    make_file(os.path.join(srcdir, 'a', 'file'))
+
+    cloner = TreeCloner(srcdir, dstdir, exclude=ExcludeRules(['cache/', '*.tmp']))
+    cloner.clone()
+
+    assert os.listdir(os.path.join(dstdir, 'a')) == ['file']
+    assert cloner.links == 1
+
+    # resumed copy drops entries excluded by now:
+    cloner = TreeCloner(srcdir, dstdir, resume=True, exclude=ExcludeRules(['a/']))
+    cloner.clone()
+    assert os.listdir(dstdir) == []
+
+
+def test_tree_cloner_existing_destination(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = str(tmpdir.mkdir('dst'))
+
+    with pytest.raises(FileExistsError):
+        TreeCloner(srcdir, dstdir).clone()
+
+
+def test_tree_cloner_dangling_symlink(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    os.symlink(os.path.join(srcdir, 'missing'), os.path.join(srcdir, 'link'))
+
+    with pytest.raises(CloneError):
+        TreeCloner(srcdir, os.path.join(str(tmpdir), 'dst')).clone()
+
+
+def test_tree_cloner_copies_files_at_link_limit(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = os.path.join(str(tmpdir), 'dst')
+    make_file(os.path.join(srcdir, 'hot'), 'hot data')
+    make_file(os.path.join(srcdir, 'cold'))
+    os.utime(os.path.join(srcdir, 'hot'), (1000, 2000))
+    os.chmod(os.path.join(srcdir, 'hot'), 0o640)
+
+    link = os.link
+
+    def limited_link(src, dst, **kwargs):
+        if src == 'hot':
+            raise OSError(errno.EMLINK, 'Too many links')
+        link(src, dst, **kwargs)
+
+    with mock.patch('psnapshot.clone.os.link', side_effect=limited_link):
+        cloner = TreeCloner(srcdir, dstdir)
+        cloner.clone()
+
+    assert cloner.links == 1
+    assert sum(cloner.copies.values()) == 1
+    assert cloner.bytes_copied == 8
+    assert os.path.samefile(os.path.join(srcdir, 'cold'), os.path.join(dstdir, 'cold'))
+    assert not os.path.samefile(os.path.join(srcdir, 'hot'), os.path.join(dstdir, 'hot'))
+    with open(os.path.join(dstdir, 'hot')) as file:
+        assert file.read() == 'hot data'
+    stat = os.stat(os.path.join(dstdir, 'hot'))
+    assert stat.st_mtime == 2000
+    assert stat.st_mode & 0o777 == 0o640
+
+
+def test_tree_cloner_copies_without_linking(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = os.path.join(str(tmpdir), 'dst')
+    os.mkdir(os.path.join(srcdir, 'a'))
+    make_file(os.path.join(srcdir, 'a', 'file'))
+
+    cloner = TreeCloner(srcdir, dstdir, link=False)
+    cloner.clone()
+
+    assert (cloner.links, sum(cloner.copies.values()), cloner.bytes_copied) == (0, 1, 4)
+    assert not os.path.samefile(os.path.join(srcdir, 'a', 'file'), os.path.join(dstdir, 'a', 'file'))
+
+
+def test_tree_cloner_fails_on_other_link_errors(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    make_file(os.path.join(srcdir, 'file'))
+
+    with mock.patch('psnapshot.clone.os.link', side_effect=OSError(errno.EACCES, 'Permission denied')):
+        with pytest.raises(CloneError):
+            TreeCloner(srcdir, os.path.join(str(tmpdir), 'dst')).clone()
+
+
+@pytest.mark.parametrize('range_error, expected', [(None, COPY_FILE_RANGE), (OSError(errno.EXDEV, 'Cross-device link'), BUFFERED)])
+def test_copy_file_falls_back(tmpdir, range_error, expected):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = str(tmpdir.mkdir('dst'))
+    make_file(os.path.join(srcdir, 'file'), 'x' * 100000)
+
+    src_fd = os.open(srcdir, os.O_RDONLY)
+    dst_fd = os.open(dstdir, os.O_RDONLY)
+    try:
+        with mock.patch('psnapshot.clone.fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'Operation not supported')):
+            if range_error:
+                with mock.patch('psnapshot.clone.os.copy_file_range', side_effect=range_error, create=True):
+                    method = copy_file('file', src_fd, dst_fd)
+            else:
+                method = copy_file('file', src_fd, dst_fd)
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+    assert method == expected
+    with open(os.path.join(dstdir, 'file')) as file:
+        assert file.read() == 'x' * 100000
+
+
+def test_copy_file_creates_fifo(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = str(tmpdir.mkdir('dst'))
+    os.mkfifo(os.path.join(srcdir, 'pipe'), 0o640)
+    os.utime(os.path.join(srcdir, 'pipe'), (1000, 2000))
+
+    src_fd = os.open(srcdir, os.O_RDONLY)
+    dst_fd = os.open(dstdir, os.O_RDONLY)
+    try:
+        assert copy_file('pipe', src_fd, dst_fd) == SPECIAL
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+    stat = os.stat(os.path.join(dstdir, 'pipe'))
+    assert stat.st_mode == os.stat(os.path.join(srcdir, 'pipe')).st_mode
+    assert stat.st_mtime == 2000
+
+
+def test_tree_cloner_resumes_incomplete_copy(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = os.path.join(str(tmpdir), 'dst')
+    os.mkdir(os.path.join(srcdir, 'a'))
+    for relpath in ('kept', 'replaced', 'missing', os.path.join('a', 'file')):
+        make_file(os.path.join(srcdir, relpath))
+
+    # interrupted copy with a current link, a stale link and entries whose source is gone:
+    os.makedirs(os.path.join(dstdir, 'a'))
+    os.makedirs(os.path.join(dstdir, 'gone-dir', 'sub'))
+    os.link(os.path.join(srcdir, 'kept'), os.path.join(dstdir, 'kept'))
+    os.link(os.path.join(srcdir, 'replaced'), os.path.join(dstdir, 'replaced'))
+    make_file(os.path.join(dstdir, 'gone'))
+    os.unlink(os.path.join(srcdir, 'replaced'))
+    make_file(os.path.join(srcdir, 'replaced'), 'new data')
+
+    with pytest.raises(FileExistsError):
+        TreeCloner(srcdir, dstdir).clone()
+
+    cloner = TreeCloner(srcdir, dstdir, resume=True)
+    cloner.clone()
+
+    assert cloner.reused == 1
+    assert cloner.links == 3
+    assert cloner.directories == 0
+    assert sorted(os.listdir(dstdir)) == ['a', 'kept', 'missing', 'replaced']
+    for relpath in ('kept', 'replaced', 'missing', os.path.join('a', 'file')):
+        assert os.path.samefile(os.path.join(srcdir, relpath), os.path.join(dstdir, relpath))
@@ -4,7 +4,9 @@ import os
 import shutil
 
 from psnapshot.control import SnapshotController
+from psnapshot.rotation import RotationExecutor
 from psnapshot.snapshot import Queue
+from psnapshot.state import state_path, write_json
 
 SRCDIR = os.path.join(os.path.dirname(__file__), 'resources', 'testsrcdir')
 DSTDIR = os.path.join(os.path.dirname(__file__), 'resources', 'testdstdir')
@@ -59,7 +61,8 @@ def test_controller_create_snapshot():
         c = SnapshotController(SRCDIR, DSTDIR, [Queue('queue1', 2, 3)])
         c.create_snapshot()
 
-    dirnames = os.listdir(DSTDIR)
+    # bookkeeping folders are hidden:
+    dirnames = [name for name in os.listdir(DSTDIR) if not name.startswith('.')]
     assert len(dirnames) == 3
     assert 'queue1-20150201000000' in dirnames
     assert 'queue1-20150107000000' in dirnames
@@ -90,3 +93,24 @@ def test_controller_create_snapshot():
     with open(os.path.join(DSTDIR, 'queue1-20150103000000', 'subdir', 'file-B')) as file:
         text = file.read()
         assert text == '150103'
+
+
+def test_controller_plan_snapshot_changes_nothing(tmpdir):
+    srcdir = tmpdir.mkdir('src')
+    dstdir = tmpdir.mkdir('dst')
+    srcdir.join('file').write('data')
+    dstdir.mkdir('queue1-20150101000000')
+    dstdir.mkdir('queue1-20150102000000')
+    executor = RotationExecutor(str(dstdir))
+    write_json(executor.journal_path, {'version': RotationExecutor.VERSION, 'deletes': [], 'archives': [],
+                                       'renames': [('queue1-20150101000000', 'queue2-20150101000000')]})
+    state = sorted(os.listdir(state_path(str(dstdir))))
+
+    controller = SnapshotController(str(srcdir), str(dstdir), [Queue('queue1', 1, 2), Queue('queue2', 7, 2)], incremental_scan=True)
+    name, plan = controller.plan_snapshot()
+
+    assert name.startswith('queue1-')
+    assert plan.renames == [('queue1-20150101000000', 'queue2-20150101000000')]
+    assert executor.pending() is not None
+    assert sorted(os.listdir(str(dstdir))) == ['.psnapshot', 'queue1-20150101000000', 'queue1-20150102000000']
+    assert sorted(os.listdir(state_path(str(dstdir)))) == state
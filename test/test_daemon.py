@@ -0,0 +1,156 @@
+import datetime
+import os
+import sys
+from unittest import mock
+
+import pytest
+from psnapshot.daemon import IN_Q_OVERFLOW, Daemon, SourceWatcher, WatchLimitError
+from psnapshot.exclude import ExcludeRules
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+
+
+def write(path, mtime):
+    with open(path, 'w') as file:
+        file.write('data')
+    os.utime(path, (mtime, mtime))
+
+
+@linux_only
+def test_source_watcher_tracks_newest(tmpdir):
+    root = str(tmpdir)
+    write(os.path.join(root, 'file'), 1000)
+    os.utime(root, (500, 500))
+
+    watcher = SourceWatcher(root)
+    try:
+        watcher.start()
+        assert watcher.newest_ns == 1000 * 1000000000
+
+        os.mkdir(os.path.join(root, 'subdir'))
+        write(os.path.join(root, 'subdir', 'file'), 2000)
+        os.utime(root, (500, 500))
+        watcher.process_events()
+        assert watcher.newest_ns == 2000 * 1000000000
+
+        # new subdirectory is watched, too:
+        write(os.path.join(root, 'subdir', 'other'), 3000)
+        watcher.process_events()
+        assert watcher.newest_ns == 3000 * 1000000000
+    finally:
+        watcher.close()
+
+
+@linux_only
+def test_source_watcher_watches_new_directories_after_overflow(tmpdir):
+    root = str(tmpdir)
+    write(os.path.join(root, 'file'), 1000)
+    os.utime(root, (500, 500))
+
+    watcher = SourceWatcher(root)
+    try:
+        watcher.start()
+        os.mkdir(os.path.join(root, 'subdir'))
+        os.utime(root, (500, 500))
+        # the creation of the directory is lost in the overflow:
+        watcher._inotify.read_events()
+        with mock.patch.object(watcher._inotify, 'read_events', return_value=[(-1, IN_Q_OVERFLOW, '')]):
+            watcher.process_events()
+
+        write(os.path.join(root, 'subdir', 'file'), 3000)
+        watcher.process_events()
+        assert watcher.newest_ns == 3000 * 1000000000
+    finally:
+        watcher.close()
+
+
+@linux_only
+def test_source_watcher_ignores_excluded(tmpdir):
+    root = str(tmpdir)
+    os.mkdir(os.path.join(root, 'cache'))
+    write(os.path.join(root, 'file'), 1000)
+    os.utime(root, (500, 500))
+
+    watcher = SourceWatcher(root, ExcludeRules(['cache/', '*.tmp']))
+    try:
+        watcher.start()
+        write(os.path.join(root, 'cache', 'file'), 2000)
+        write(os.path.join(root, 'file.tmp'), 2000)
+        os.mkdir(os.path.join(root, 'sub'))
+        os.mkdir(os.path.join(root, 'sub', 'cache'))
+        write(os.path.join(root, 'sub', 'cache', 'file'), 2000)
+        os.utime(os.path.join(root, 'sub'), (500, 500))
+        os.utime(root, (500, 500))
+        watcher.process_events()
+        assert watcher.newest_ns == 1000 * 1000000000
+    finally:
+        watcher.close()
+
+
+def make_daemon(settle=10):
+    job = mock.MagicMock()
+    controller = mock.MagicMock()
+    controller.organizer.time_from_ns = lambda ns: datetime.datetime.fromtimestamp(ns // 1000000000)
+    controller.organizer.snapshots_time = None
+    controller.organizer.queues[0].period = datetime.timedelta(days=1)
+    daemon = Daemon([job], lambda j: controller, settle=settle, scan_interval=100)
+    return daemon, daemon.jobs[0], controller
+
+
+def test_daemon_creates_snapshot_when_due_and_settled():
+    daemon, watched, controller = make_daemon()
+    watched.watcher = mock.MagicMock(newest_ns=2000 * 1000000000, last_event=100)
+    controller.organizer.queues[0].snapshot_time_acceptable = mock.MagicMock(return_value=True)
+
+    # source not settled yet:
+    daemon._check(watched, 105)
+    assert not controller.create_snapshot.called
+
+    daemon._check(watched, 111)
+    controller.create_snapshot.assert_called_once_with(srcdir_time=datetime.datetime.fromtimestamp(2000))
+
+    # nothing changed since:
+    daemon._check(watched, 200)
+    assert controller.create_snapshot.call_count == 1
+
+
+def test_daemon_skips_snapshot_not_due():
+    daemon, watched, controller = make_daemon()
+    watched.watcher = mock.MagicMock(newest_ns=2000 * 1000000000, last_event=100)
+    controller.organizer.queues[0].snapshot_time_acceptable = mock.MagicMock(return_value=False)
+
+    daemon._check(watched, 200)
+    assert not controller.create_snapshot.called
+
+
+def test_daemon_waits_for_full_period():
+    daemon, watched, controller = make_daemon()
+    watched.watcher = mock.MagicMock(newest_ns=2000 * 1000000000, last_event=100)
+    controller.organizer.queues[0].snapshot_time_acceptable = mock.MagicMock(return_value=True)
+    newest = datetime.datetime.now() - datetime.timedelta(hours=20)
+    controller.organizer.snapshots_time = newest
+
+    # accepted by the tolerance of the queue, but a day has not passed yet:
+    daemon._check(watched, 200)
+    assert not controller.create_snapshot.called
+    assert watched.due == newest + datetime.timedelta(days=1)
+
+    watched.due = datetime.datetime.now()
+    controller.organizer.snapshots_time = newest - datetime.timedelta(hours=5)
+    daemon._check(watched, 300)
+    controller.create_snapshot.assert_called_once_with(srcdir_time=datetime.datetime.fromtimestamp(2000))
+
+
+@mock.patch('psnapshot.daemon.SourceWatcher')
+def test_daemon_falls_back_to_periodic_scan(mock_watcher):
+    mock_watcher.return_value.start = mock.MagicMock(side_effect=WatchLimitError(28, 'limit'))
+    daemon, watched, controller = make_daemon()
+
+    daemon._start_watching(watched)
+    assert watched.watcher is None
+    mock_watcher.return_value.close.assert_called_once_with()
+
+    daemon._check(watched, 1000)
+    daemon._check(watched, 1050)
+    daemon._check(watched, 1100)
+    assert controller.create_snapshot.call_count == 2
@@ -0,0 +1,89 @@
+import datetime
+import os
+from unittest import mock
+
+from psnapshot.control import SnapshotController
+from psnapshot.dedup import Deduplicator
+from psnapshot.snapshot import Queue
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def prepare_snapshots(tmpdir):
+    """Previous snapshot and new one, whose files were all rewritten."""
+    dstdir = tmpdir.mkdir('dst')
+    old = dstdir.mkdir('daily-20150101000000')
+    new = dstdir.mkdir('daily-20150102000000')
+
+    for snapshot, changed in ((old, 'old'), (new, 'new')):
+        snapshot.mkdir('sub')
+        write(str(snapshot.join('sub', 'same')), 'same')
+        write(str(snapshot.join('changed')), changed)
+        write(str(snapshot.join('empty')), '')
+    write(str(old.join('renamed-before')), 'renamed')
+    write(str(new.join('renamed-after')), 'renamed')
+    os.utime(str(new.join('sub')), ns=(10 ** 18, 10 ** 18))
+
+    return str(dstdir), str(old), str(new)
+
+
+def test_deduplicate(tmpdir):
+    dstdir, old, new = prepare_snapshots(tmpdir)
+    deduplicator = Deduplicator(dstdir, workers=2)
+
+    deduplicator.deduplicate(old, new)
+
+    assert os.path.samefile(os.path.join(old, 'sub', 'same'), os.path.join(new, 'sub', 'same'))
+    assert os.path.samefile(os.path.join(old, 'renamed-before'), os.path.join(new, 'renamed-after'))
+    assert not os.path.samefile(os.path.join(old, 'changed'), os.path.join(new, 'changed'))
+    assert not os.path.samefile(os.path.join(old, 'empty'), os.path.join(new, 'empty'))
+    assert (deduplicator.files, deduplicator.bytes, deduplicator.bytes_freed) == (2, 11, 11)
+    assert os.stat(os.path.join(new, 'sub')).st_mtime_ns == 10 ** 18
+    assert not os.path.lexists(os.path.join(dstdir, '.psnapshot', Deduplicator.TEMP_FILENAME))
+
+    # hashes are cached and nothing is left to relink:
+    deduplicator = Deduplicator(dstdir, workers=2)
+    with mock.patch('psnapshot.dedup.hash_files', return_value={}) as mock_hash_files:
+        deduplicator.deduplicate(old, new)
+    mock_hash_files.assert_called_once_with({}, 2)
+    assert deduplicator.files == 0
+
+
+def test_deduplicate_keeps_mode(tmpdir):
+    dstdir, old, new = prepare_snapshots(tmpdir)
+    os.chmod(os.path.join(new, 'sub', 'same'), 0o600)
+    os.chmod(os.path.join(old, 'sub', 'same'), 0o644)
+
+    Deduplicator(dstdir, workers=2).deduplicate(old, new)
+
+    assert not os.path.samefile(os.path.join(old, 'sub', 'same'), os.path.join(new, 'sub', 'same'))
+
+
+def test_deduplicate_link_limit(tmpdir):
+    dstdir, old, new = prepare_snapshots(tmpdir)
+    deduplicator = Deduplicator(dstdir, workers=2)
+
+    with mock.patch('os.pathconf', return_value=1):
+        deduplicator.deduplicate(old, new)
+
+    assert deduplicator.files == 0
+    assert not os.path.samefile(os.path.join(old, 'sub', 'same'), os.path.join(new, 'sub', 'same'))
+
+
+def test_controller_deduplicates_new_snapshot(tmpdir):
+    srcdir = tmpdir.mkdir('src')
+    dstdir = tmpdir.mkdir('dst')
+    write(str(srcdir.join('file')), 'data')
+    controller = SnapshotController(str(srcdir), str(dstdir), [Queue('daily', 1, 3)], dedup=True)
+    controller.create_snapshot(datetime.datetime(2015, 1, 1))
+
+    # rewritten with same content, like rsync does after a touch:
+    os.unlink(str(srcdir.join('file')))
+    write(str(srcdir.join('file')), 'data')
+    controller.create_snapshot(datetime.datetime(2015, 1, 2))
+
+    assert os.path.samefile(str(dstdir.join('daily-20150101000000', 'file')), str(dstdir.join('daily-20150102000000', 'file')))
+    assert not os.path.samefile(str(srcdir.join('file')), str(dstdir.join('daily-20150102000000', 'file')))
@@ -0,0 +1,61 @@
+import os
+import shutil
+
+from psnapshot.diff import diff_trees, Change, ADDED, REMOVED, MODIFIED
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def prepare_snapshots(tmpdir):
+    old = str(tmpdir.join('old'))
+    os.makedirs(os.path.join(old, 'gone'))
+    os.makedirs(os.path.join(old, 'kept'))
+    os.makedirs(os.path.join(old, 'type'))
+    write(os.path.join(old, 'gone', 'file'), 'a')
+    write(os.path.join(old, 'kept', 'same'), 'b')
+    write(os.path.join(old, 'kept', 'rewritten'), 'c')
+    write(os.path.join(old, 'kept', 'changed'), 'd')
+    write(os.path.join(old, 'type', 'file'), 'e')
+
+    new = str(tmpdir.join('new'))
+    os.makedirs(os.path.join(new, 'kept'))
+    os.makedirs(os.path.join(new, 'added'))
+    os.link(os.path.join(old, 'kept', 'same'), os.path.join(new, 'kept', 'same'))
+    shutil.copy(os.path.join(old, 'kept', 'rewritten'), os.path.join(new, 'kept', 'rewritten'))
+    write(os.path.join(new, 'kept', 'changed'), 'x')
+    write(os.path.join(new, 'added', 'file'), 'f')
+    write(os.path.join(new, 'type'), 'g')
+
+    return old, new
+
+
+def test_diff_trees_by_inode(tmpdir):
+    old, new = prepare_snapshots(tmpdir)
+
+    assert list(diff_trees(old, new)) == [
+        Change(ADDED, 'added', True),
+        Change(ADDED, os.path.join('added', 'file'), False),
+        Change(REMOVED, 'gone', True),
+        Change(REMOVED, os.path.join('gone', 'file'), False),
+        Change(REMOVED, 'type', True),
+        Change(REMOVED, os.path.join('type', 'file'), False),
+        Change(ADDED, 'type', False),
+        Change(MODIFIED, os.path.join('kept', 'changed'), False),
+        Change(MODIFIED, os.path.join('kept', 'rewritten'), False),
+    ]
+
+
+def test_diff_trees_by_content(tmpdir):
+    old, new = prepare_snapshots(tmpdir)
+
+    modified = [c.path for c in diff_trees(old, new, compare_contents=True) if c.status == MODIFIED]
+    assert modified == [os.path.join('kept', 'changed')]
+
+
+def test_diff_trees_identical(tmpdir):
+    old, _ = prepare_snapshots(tmpdir)
+
+    assert list(diff_trees(old, old)) == []
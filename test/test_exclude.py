@@ -0,0 +1,41 @@
+import pytest
+from psnapshot.exclude import NO_EXCLUDES, ExcludeRules
+
+
+@pytest.mark.parametrize('relpath, name, is_dir, excluded', [
+    ('', 'x.tmp', False, True),
+    ('./a/b', 'x.tmp', False, True),
+    ('a', 'keep.tmp', False, False),
+    ('a', 'cache', True, True),
+    ('a', 'cache', False, False),
+    ('', 'build', True, True),
+    ('a', 'build', True, False),
+    ('a/b/c', 'z', False, True),
+    ('a', 'z', False, True),
+    ('b', 'z', False, False),
+    ('.', 'file-[1]', False, True),
+    ('.', 'file-2', False, False),
+    ('.', 'src', True, False),
+])
+def test_exclude_rules(relpath, name, is_dir, excluded):
+    rules = ExcludeRules(['# comment', '', '*.tmp', 'cache/', '/build', '!keep.tmp', 'a/**/z', 'file-\\[1]'])
+
+    assert rules.excluded(relpath, name, is_dir) == excluded
+
+
+def test_exclude_rules_below():
+    rules = ExcludeRules(['/a/b/cache', 'x[!0-9]'])
+
+    assert rules.below('a').excluded('b', 'cache', True)
+    assert rules.below('a').below('b').excluded('.', 'cache', True)
+    assert not rules.below('b').excluded('b', 'cache', True)
+    assert rules.below('a').excluded('', 'xy', False)
+    assert not rules.below('a').excluded('', 'x1', False)
+
+
+def test_exclude_rules_from_file(tmpdir):
+    path = tmpdir.join('exclude')
+    path.write('*.tmp\n\n# comment\ncache/\n')
+
+    assert ExcludeRules.from_file(str(path)).patterns == ['*.tmp', 'cache/']
+    assert not NO_EXCLUDES
@@ -0,0 +1,176 @@
+import os
+import time
+from unittest import mock
+
+import pytest
+from psnapshot.archive import staging_path
+from psnapshot.control import SnapshotController, fsck_command
+from psnapshot.exceptions import ConsistencyError
+from psnapshot.fsck import (INTERRUPTED, LENGTH, LINK_COUNT, ORDER, PARTIAL, SPACING, STAGED, TRASH, UNMAPPED, UNREADABLE, ConsistencyChecker)
+from psnapshot.rotation import RotationExecutor
+from psnapshot.snapshot import Queue, Snapshot
+from psnapshot.state import write_json
+from psnapshot.trash import trash_path
+
+
+def make_snapshot(dstdir, name, complete=True):
+    """Creates snapshot whose newest file is as old as the snapshot, or older if the tree is to be partial."""
+    snapshot = dstdir.mkdir(name)
+    snapshot.join('file').write(name)
+    seconds = time.mktime(Snapshot.parse_name(name)[1].timetuple()) - (0 if complete else 3600)
+    for path in (snapshot.join('file'), snapshot):
+        os.utime(str(path), (seconds, seconds))
+    return snapshot
+
+
+def snapshot_names(dstdir):
+    return sorted(name for name in os.listdir(str(dstdir)) if not name.startswith('.'))
+
+
+def kinds(problems):
+    return [(problem.kind, problem.name) for problem in problems]
+
+
+QUEUES = ['daily[2]+1', 'weekly[2]+7']
+
+
+def queues():
+    return [Queue.from_textual_spec(spec) for spec in QUEUES]
+
+
+def test_consistent(tmpdir):
+    for name in ('daily-20150110000000', 'daily-20150109000000', 'weekly-20150108000000', 'weekly-20150101000000'):
+        make_snapshot(tmpdir, name)
+
+    checker = ConsistencyChecker(str(tmpdir), queues(), workers=2)
+
+    assert checker.check() == []
+    assert (checker.snapshots, checker.files) == (4, 4)
+    assert not checker.plan
+
+
+def test_queue_length_repair(tmpdir):
+    for name in ('daily-20150110000000', 'daily-20150109000000', 'daily-20150108000000', 'daily-20150107000000',
+                 'weekly-20150101000000'):
+        make_snapshot(tmpdir, name)
+
+    checker = ConsistencyChecker(str(tmpdir), queues())
+    assert kinds(checker.check()) == [(LENGTH, 'daily')]
+    assert checker.plan.describe() == ['rename daily-20150108000000 -> weekly-20150108000000', 'delete daily-20150107000000']
+
+    checker.repair()
+
+    assert snapshot_names(tmpdir) == ['daily-20150109000000', 'daily-20150110000000', 'weekly-20150101000000', 'weekly-20150108000000']
+    assert len(os.listdir(trash_path(str(tmpdir)))) == 1
+    assert ConsistencyChecker(str(tmpdir), queues()).check() == [(TRASH, os.listdir(trash_path(str(tmpdir)))[0], 'waiting to be reaped')]
+
+
+def test_queue_length_repair_archives_expired(tmpdir):
+    for name in ('daily-20150122000000', 'daily-20150121000000', 'weekly-20150115000000', 'weekly-20150108000000',
+                 'weekly-20150101000000'):
+        make_snapshot(tmpdir, name)
+
+    checker = ConsistencyChecker(str(tmpdir), queues(), archive_dir=str(tmpdir.join('archive')))
+    assert kinds(checker.check()) == [(LENGTH, 'weekly')]
+    assert checker.plan.describe() == ['archive weekly-20150101000000']
+
+    checker.repair()
+
+    assert os.listdir(staging_path(str(tmpdir))) == ['weekly-20150101000000']
+    assert kinds(ConsistencyChecker(str(tmpdir), queues()).check()) == [(STAGED, 'weekly-20150101000000')]
+
+
+def test_partial_reported_only(tmpdir):
+    make_snapshot(tmpdir, 'daily-20150110000000')
+    make_snapshot(tmpdir, 'daily-20150109000000', complete=False)
+
+    checker = ConsistencyChecker(str(tmpdir), queues())
+    assert kinds(checker.check()) == [(PARTIAL, 'daily-20150109000000')]
+    assert not checker.plan
+    checker.repair()
+
+    assert snapshot_names(tmpdir) == ['daily-20150109000000', 'daily-20150110000000']
+
+
+def test_deduplicated_snapshot_kept(tmpdir):
+    srcdir = tmpdir.mkdir('src')
+    dstdir = tmpdir.mkdir('dst')
+    srcdir.join('file').write('data')
+    os.utime(str(srcdir.join('file')), (1000000000, 1000000000))
+    os.utime(str(srcdir), (1000000000, 1000000000))
+    controller = SnapshotController(str(srcdir), str(dstdir), [Queue('daily', 1, 7)], dedup=True)
+    controller.create_snapshot()
+
+    # replaced by a new inode with the same content and a newer time, like rsync -a does after a touch:
+    srcdir.join('file.tmp').write('data')
+    os.utime(str(srcdir.join('file.tmp')), (1100000000, 1100000000))
+    os.rename(str(srcdir.join('file.tmp')), str(srcdir.join('file')))
+    os.utime(str(srcdir), (1000000000, 1000000000))
+    controller.create_snapshot()
+
+    checker = ConsistencyChecker(str(dstdir), [Queue('daily', 1, 7)])
+    assert [kind for kind, _ in kinds(checker.check())] == [PARTIAL]
+    assert not checker.plan
+
+
+def test_reported_only(tmpdir):
+    for name in ('daily-20150110000000', 'daily-20150109120000', 'weekly-20150112000000', 'hourly-20150101000000'):
+        make_snapshot(tmpdir, name)
+
+    checker = ConsistencyChecker(str(tmpdir), queues())
+
+    assert kinds(checker.check()) == [(ORDER, 'weekly-20150112000000'), (SPACING, 'daily-20150109120000'),
+                                      (UNMAPPED, 'hourly-20150101000000')]
+    assert not checker.plan
+
+
+def test_link_count(tmpdir):
+    make_snapshot(tmpdir, 'daily-20150110000000')
+    newest_ns = os.stat(str(tmpdir.join('daily-20150110000000'))).st_mtime_ns
+
+    with mock.patch('psnapshot.fsck.walk_parallel', return_value=[(0, newest_ns, [(7, 1), (7, 1), (8, 2)], None)]):
+        problems = ConsistencyChecker(str(tmpdir), queues()).check()
+
+    assert kinds(problems) == [(LINK_COUNT, 'inode 7')]
+
+
+def test_unreadable_tree_not_partial(tmpdir):
+    make_snapshot(tmpdir, 'daily-20150110000000', complete=False)
+
+    with mock.patch('psnapshot.fsck.walk_parallel', return_value=[(0, 0, [], 'sub/: Permission denied')]):
+        problems = ConsistencyChecker(str(tmpdir), queues()).check()
+
+    assert kinds(problems) == [(UNREADABLE, 'daily-20150110000000')]
+
+
+def test_interrupted_rotation_repair(tmpdir):
+    for name in ('daily-20150110000000', 'daily-20150109000000', 'daily-20150108000000'):
+        make_snapshot(tmpdir, name)
+    executor = RotationExecutor(str(tmpdir))
+    write_json(executor.journal_path, {'version': RotationExecutor.VERSION, 'renames': [('daily-20150108000000', 'weekly-20150108000000')],
+                                       'deletes': [], 'archives': []})
+
+    checker = ConsistencyChecker(str(tmpdir), queues())
+    assert (INTERRUPTED, RotationExecutor.JOURNAL_FILENAME) in kinds(checker.check())
+    checker.repair()
+
+    assert executor.pending() is None
+    assert snapshot_names(tmpdir) == ['daily-20150109000000', 'daily-20150110000000', 'weekly-20150108000000']
+    assert checker.check() == []
+
+
+def test_fsck_command(tmpdir):
+    for name in ('daily-20150110000000', 'daily-20150109000000', 'daily-20150108000000'):
+        make_snapshot(tmpdir, name)
+    make_snapshot(tmpdir, 'hourly-20150101000000')
+    args = [str(tmpdir), '-q', 'daily[2]+1', '-q', 'hourly[1]+1h']
+
+    with pytest.raises(ConsistencyError):
+        fsck_command(args)
+    fsck_command(args + ['--repair'])
+
+    assert snapshot_names(tmpdir) == ['daily-20150109000000', 'daily-20150110000000', 'hourly-20150108000000']
+    assert not os.path.exists(trash_path(str(tmpdir)))
+    with mock.patch.object(RotationExecutor, 'apply') as apply:
+        fsck_command(args)
+    apply.assert_not_called()
@@ -0,0 +1,56 @@
+import os
+
+from psnapshot.index import SnapshotIndex
+
+
+def make_index(dstdir):
+    index = SnapshotIndex.prepare(dstdir)
+    index.snapshots = sorted(name for name in os.listdir(dstdir) if name.startswith('queue'))
+    index.others = sorted(name for name in os.listdir(dstdir) if not name.startswith('queue'))
+    index.save()
+    return index
+
+
+def test_snapshot_index_roundtrip(tmpdir):
+    dstdir = str(tmpdir)
+    os.mkdir(os.path.join(dstdir, 'queue-20150101000000'))
+    os.mkdir(os.path.join(dstdir, 'other'))
+    make_index(dstdir)
+
+    index = SnapshotIndex.load(dstdir)
+    assert index.snapshots == ['queue-20150101000000']
+    assert index.others == ['.psnapshot', 'other']
+    assert index.is_current()
+
+
+def test_snapshot_index_outdated(tmpdir):
+    dstdir = str(tmpdir)
+    os.mkdir(os.path.join(dstdir, 'queue-20150101000000'))
+    make_index(dstdir)
+    os.utime(dstdir, (1000, 1000))
+    index = make_index(dstdir)
+    assert index.is_current()
+
+    # old directory time, outdated index is detected by a single stat:
+    os.rename(os.path.join(dstdir, 'queue-20150101000000'), os.path.join(dstdir, 'queue-20150102000000'))
+    assert not SnapshotIndex.load(dstdir).is_current()
+
+
+def test_snapshot_index_racy_verified_by_names(tmpdir):
+    dstdir = str(tmpdir)
+    os.mkdir(os.path.join(dstdir, 'queue-20150101000000'))
+    index = make_index(dstdir)
+    assert index.is_current()
+
+    # simulate a change within time resolution of file system:
+    os.rename(os.path.join(dstdir, 'queue-20150101000000'), os.path.join(dstdir, 'queue-20150102000000'))
+    os.utime(dstdir, ns=(index.mtime_ns, index.mtime_ns))
+    assert not SnapshotIndex.load(dstdir).is_current()
+
+
+def test_snapshot_index_missing_or_corrupt(tmpdir):
+    dstdir = str(tmpdir)
+    assert SnapshotIndex.load(dstdir) is None
+
+    tmpdir.mkdir('.psnapshot').join('index.json').write('[]')
+    assert SnapshotIndex.load(dstdir) is None
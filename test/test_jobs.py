@@ -0,0 +1,77 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+from psnapshot.exceptions import JobConfigError
+from psnapshot.jobs import Job, JobScheduler, format_summary, load_jobs
+
+
+def test_load_jobs(tmpdir):
+    config = tmpdir.join('jobs.ini')
+    config.write('[DEFAULT]\n'
+                 'queues = daily[7]+1 weekly[4]+7\n'
+                 'reap_timeout = 60\n'
+                 '[first]\n'
+                 'srcdir = /src/first\n'
+                 'dstdir = /dst/first\n'
+                 '[second]\n'
+                 'srcdir = /src/second\n'
+                 'dstdir = /dst/second\n'
+                 'queues = hourly[24]+1\n'
+                 'incremental_scan = yes\n')
+
+    first, second = load_jobs(str(config))
+
+    assert first.name == 'first'
+    assert first.srcdir == '/src/first'
+    assert first.queue_specs == ['daily[7]+1', 'weekly[4]+7']
+    assert first.options == {'incremental_scan': False, 'reap': True, 'reap_timeout': 60.0, 'reap_rate': None,
+                             'report': None, 'prometheus_textfile': None, 'dedup': False,
+                             'archive_dir': None, 'archive_compression': 'xz', 'exclude': [], 'catalog': False}
+    assert second.queue_specs == ['hourly[24]+1']
+    assert second.options['incremental_scan']
+
+
+def test_load_jobs_invalid(tmpdir):
+    with pytest.raises(JobConfigError):
+        load_jobs(str(tmpdir.join('missing.ini')))
+
+    config = tmpdir.join('jobs.ini')
+    config.write('[first]\nsrcdir = /src/first\n')
+    with pytest.raises(JobConfigError):
+        load_jobs(str(config))
+
+
+def test_job_scheduler_limits_jobs_per_device():
+    jobs = [Job('a1', None, '/a/1', []), Job('a2', None, '/a/2', []), Job('b1', None, '/b/1', []), Job('fail', None, '/b/2', [])]
+
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def run_job(job):
+        with lock:
+            running.append(job)
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(job)
+        if job.name == 'fail':
+            raise ValueError('boom')
+
+    with mock.patch.object(JobScheduler, '_device', side_effect=lambda job: job.dstdir[1]):
+        results = JobScheduler(run_job, per_device=1).run(jobs)
+
+    assert [r.job.name for r in results] == ['a1', 'a2', 'b1', 'fail']
+    assert [r.error is None for r in results] == [True, True, True, False]
+    assert max(max_running) == 2
+    assert 'failed: boom' in format_summary(results)[-1]
+
+
+def test_job_scheduler_rejects_no_concurrent_jobs():
+    with pytest.raises(JobConfigError):
+        JobScheduler(mock.sentinel.RUN_JOB, max_jobs=0)
+
+    with pytest.raises(JobConfigError):
+        JobScheduler(mock.sentinel.RUN_JOB, per_device=0)
@@ -0,0 +1,73 @@
+import json
+import os
+
+from psnapshot.control import SnapshotController
+from psnapshot.metrics import NULL_METRICS, RunMetrics
+from psnapshot.snapshot import Queue
+
+
+def test_run_metrics_accumulates_phases_and_counters():
+    metrics = RunMetrics({'dstdir': '/dst'})
+
+    with metrics.phase('scan'):
+        pass
+    with metrics.phase('scan'):
+        pass
+    metrics.count('links_created', 3)
+    metrics.count('links_created')
+
+    assert list(metrics.phases) == ['scan']
+    assert metrics.phases['scan'] >= 0
+    report = metrics.report()
+    assert report['counters']['links_created'] == 4
+    assert report['counters']['bytes_freed'] == 0
+    assert report['labels'] == {'dstdir': '/dst'}
+
+
+def test_run_metrics_prometheus_lines():
+    metrics = RunMetrics({'dstdir': '/dst/"quoted"'})
+    with metrics.phase('clone'):
+        pass
+    metrics.count('renames', 2)
+    metrics.success = True
+
+    lines = metrics.prometheus_lines()
+    assert 'psnapshot_renames{dstdir="/dst/\\"quoted\\""} 2' in lines
+    assert 'psnapshot_last_run_success{dstdir="/dst/\\"quoted\\""} 1' in lines
+    assert any(line.startswith('psnapshot_phase_seconds{dstdir="/dst/\\"quoted\\"",phase="clone"} ') for line in lines)
+    assert '# TYPE psnapshot_bytes_freed gauge' in lines
+
+
+def test_null_metrics_ignores_everything():
+    with NULL_METRICS.phase('scan'):
+        NULL_METRICS.count('links_created', 5)
+    assert not NULL_METRICS.enabled
+
+
+def test_controller_writes_report_and_textfile(tmpdir):
+    srcdir = str(tmpdir.mkdir('src'))
+    dstdir = str(tmpdir.mkdir('dst'))
+    os.mkdir(os.path.join(srcdir, 'subdir'))
+    for path in ('file-A', os.path.join('subdir', 'file-B')):
+        with open(os.path.join(srcdir, path), 'w') as file:
+            file.write('data')
+
+    report = str(tmpdir.join('report.json'))
+    textfile = str(tmpdir.join('psnapshot.prom'))
+    queues = [Queue('daily', 1, 1), Queue('weekly', 7, 1)]
+    os.mkdir(os.path.join(dstdir, 'daily-20000101000000'))
+
+    SnapshotController(srcdir, dstdir, queues, report=report, prometheus_textfile=textfile).create_snapshot()
+
+    with open(report) as file:
+        data = json.load(file)
+    assert data['success']
+    assert list(data['phases']) == ['find', 'scan', 'clone', 'rotate', 'reap', 'index']
+    assert data['counters'] == {'files_scanned': 2, 'links_created': 2, 'files_copied_reflink': 0, 'files_copied_copy_file_range': 0,
+                                'files_copied_buffered': 0, 'files_copied_special': 0, 'files_deduplicated': 0, 'bytes_deduplicated': 0, 'renames': 1, 'snapshots_expired': 0, 'files_archived': 0,
+                                'bytes_archived': 0, 'files_removed': 0, 'bytes_freed': 0}
+
+    with open(textfile) as file:
+        lines = file.read().splitlines()
+    assert 'psnapshot_links_created{{dstdir="{}"}} 2'.format(dstdir) in lines
+    assert 'psnapshot_last_run_success{{dstdir="{}"}} 1'.format(dstdir) in lines
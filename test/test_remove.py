@@ -0,0 +1,68 @@
+import os
+from unittest import mock
+
+from psnapshot.remove import TreeRemover
+
+
+def prepare_tree(root):
+    os.makedirs(os.path.join(root, 'a', 'b'))
+    with open(os.path.join(root, 'a', 'b', 'single'), 'w') as file:
+        file.write('12345')
+    with open(os.path.join(root, 'a', 'shared'), 'w') as file:
+        file.write('123')
+    os.link(os.path.join(root, 'a', 'shared'), os.path.join(root, 'shared-link'))
+    os.symlink('a', os.path.join(root, 'dirlink'))
+    os.chmod(os.path.join(root, 'a', 'b'), 0o555)
+
+
+def test_tree_remover(tmpdir):
+    root = str(tmpdir.join('tree'))
+    prepare_tree(root)
+
+    remover = TreeRemover(root, workers=2)
+    assert remover.remove()
+    assert remover.complete
+    assert not os.path.exists(root)
+    assert remover.files == 4
+    # only the second unlinked copy of the shared file frees space, symbolic link counts with its own size:
+    assert remover.bytes_freed == 5 + 3 + 1
+
+
+def test_tree_remover_counts_only_last_link(tmpdir):
+    root = str(tmpdir.join('tree'))
+    os.mkdir(root)
+    with open(os.path.join(root, 'file'), 'w') as file:
+        file.write('123')
+    os.link(os.path.join(root, 'file'), str(tmpdir.join('outside')))
+
+    remover = TreeRemover(root)
+    assert remover.remove()
+    assert remover.files == 1
+    assert remover.bytes_freed == 0
+
+
+def test_tree_remover_counts_links_removed_concurrently(tmpdir):
+    remover = TreeRemover(str(tmpdir))
+    stat = mock.Mock(st_dev=1, st_ino=2, st_nlink=2)
+
+    # both links were seen with two links before either was removed:
+    assert not remover._last_link(stat)
+    assert remover._last_link(stat)
+    assert not remover._links
+
+    # a file with a link outside the tree is never freed:
+    assert not remover._last_link(mock.Mock(st_dev=1, st_ino=3, st_nlink=3))
+    assert not remover._last_link(mock.Mock(st_dev=1, st_ino=3, st_nlink=2))
+
+
+def test_tree_remover_stopped(tmpdir):
+    root = str(tmpdir.join('tree'))
+    prepare_tree(root)
+
+    remover = TreeRemover(root, tick=lambda: False)
+    assert not remover.remove()
+    assert not remover.complete
+    assert os.path.exists(root)
+
+    assert TreeRemover(root).remove()
+    assert not os.path.exists(root)
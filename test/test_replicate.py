@@ -0,0 +1,118 @@
+import os
+import shutil
+import stat as statmod
+
+import pytest
+from psnapshot.exceptions import DestinationDirError
+from psnapshot.replicate import Replicator
+from psnapshot.state import state_path
+from psnapshot.trash import trash_path
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def snapshot_names(dstdir):
+    return sorted(name for name in os.listdir(dstdir) if not name.startswith('.'))
+
+
+def prepare_dstdir(tmpdir):
+    """Two snapshots sharing file-A, which is also linked twice within the first."""
+    dstdir = tmpdir.mkdir('dst')
+    first = dstdir.mkdir('daily-20150101000000')
+    second = dstdir.mkdir('daily-20150102000000')
+
+    first.mkdir('sub')
+    write(str(first.join('file-A')), 'A')
+    os.link(str(first.join('file-A')), str(first.join('sub', 'file-A')))
+    write(str(first.join('file-B')), 'B')
+    os.link(str(first.join('file-A')), str(second.join('file-A')))
+    write(str(second.join('file-C')), 'C')
+    os.utime(str(first.join('sub')), ns=(10 ** 18, 10 ** 18))
+    return dstdir
+
+
+def test_replicate(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    mirror = tmpdir.mkdir('mirror')
+
+    replicator = Replicator(str(dstdir), str(mirror))
+    replicator.replicate()
+
+    assert snapshot_names(str(mirror)) == ['daily-20150101000000', 'daily-20150102000000']
+    assert (replicator.created, replicator.copies, replicator.links, replicator.bytes_copied) == (2, 3, 2, 3)
+    assert os.path.samefile(str(mirror.join('daily-20150101000000', 'file-A')), str(mirror.join('daily-20150101000000', 'sub', 'file-A')))
+    assert os.path.samefile(str(mirror.join('daily-20150101000000', 'file-A')), str(mirror.join('daily-20150102000000', 'file-A')))
+    assert not os.path.samefile(str(dstdir.join('daily-20150101000000', 'file-A')), str(mirror.join('daily-20150101000000', 'file-A')))
+    assert mirror.join('daily-20150102000000', 'file-C').read() == 'C'
+    assert os.stat(str(mirror.join('daily-20150101000000', 'sub'))).st_mtime_ns == 10 ** 18
+
+
+def test_replicate_special_files_and_symlinks(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    snapshot = dstdir.join('daily-20150101000000')
+    os.mkfifo(str(snapshot.join('pipe')))
+    os.symlink('file-B', str(snapshot.join('link')))
+    os.utime(str(snapshot.join('link')), (1000, 1000), follow_symlinks=False)
+    mirror = tmpdir.mkdir('mirror')
+
+    Replicator(str(dstdir), str(mirror)).replicate()
+
+    assert statmod.S_ISFIFO(os.lstat(str(mirror.join('daily-20150101000000', 'pipe'))).st_mode)
+    assert os.readlink(str(mirror.join('daily-20150101000000', 'link'))) == 'file-B'
+    assert os.lstat(str(mirror.join('daily-20150101000000', 'link'))).st_mtime == 1000
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='changing owners requires root')
+def test_replicate_owners(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    snapshot = dstdir.join('daily-20150101000000')
+    os.symlink('file-B', str(snapshot.join('link')))
+    for name in ('sub', 'link'):
+        os.chown(str(snapshot.join(name)), 1234, 1234, follow_symlinks=False)
+    mirror = tmpdir.mkdir('mirror')
+
+    Replicator(str(dstdir), str(mirror)).replicate()
+
+    for name in ('sub', 'link'):
+        stat = os.lstat(str(mirror.join('daily-20150101000000', name)))
+        assert (stat.st_uid, stat.st_gid) == (1234, 1234)
+
+
+def test_replicate_rotation(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    mirror = tmpdir.mkdir('mirror')
+    Replicator(str(dstdir), str(mirror)).replicate()
+
+    # rotated: first snapshot moved to another queue, second expired and a new one sharing file-A:
+    os.rename(str(dstdir.join('daily-20150101000000')), str(dstdir.join('weekly-20150101000000')))
+    shutil.rmtree(str(dstdir.join('daily-20150102000000')))
+    third = dstdir.mkdir('daily-20150103000000')
+    os.link(str(dstdir.join('weekly-20150101000000', 'file-A')), str(third.join('file-A')))
+
+    replicator = Replicator(str(dstdir), str(mirror))
+    replicator.replicate()
+
+    assert snapshot_names(str(mirror)) == ['daily-20150103000000', 'weekly-20150101000000']
+    assert (replicator.renamed, replicator.expired, replicator.created, replicator.copies, replicator.links) == (1, 1, 1, 0, 1)
+    assert os.path.samefile(str(mirror.join('weekly-20150101000000', 'file-A')), str(mirror.join('daily-20150103000000', 'file-A')))
+    assert len(os.listdir(trash_path(str(mirror)))) == 1
+
+
+def test_replicate_removes_incomplete_copy(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    mirror = tmpdir.mkdir('mirror')
+    build_path = state_path(str(mirror), Replicator.BUILD_DIRNAME)
+    os.makedirs(os.path.join(build_path, 'stale'))
+
+    Replicator(str(dstdir), str(mirror)).replicate()
+
+    assert not os.path.exists(build_path)
+    assert sorted(os.listdir(str(mirror.join('daily-20150101000000')))) == ['file-A', 'file-B', 'sub']
+
+
+def test_replicate_missing_mirror(tmpdir):
+    with pytest.raises(DestinationDirError):
+        Replicator(str(tmpdir), str(tmpdir.join('missing')))
@@ -0,0 +1,147 @@
+import datetime
+import os
+import stat as statmod
+from unittest import mock
+
+import pytest
+from psnapshot.control import main
+from psnapshot.exceptions import RestoreError
+from psnapshot.restore import Restorer, find_snapshot, snapshot_path
+from psnapshot.snapshot import Snapshot
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def prepare_dstdir(tmpdir):
+    dstdir = tmpdir.mkdir('dst')
+    for name, text in (('daily-20150101000000', 'old'), ('daily-20150102000000', 'new')):
+        snapshot = dstdir.mkdir(name)
+        snapshot.mkdir('sub')
+        write(str(snapshot.join('sub', 'file')), text)
+        os.symlink('file', str(snapshot.join('sub', 'link')))
+    write(str(dstdir.join('daily-20150101000000', 'only-old')), 'gone')
+    return dstdir
+
+
+def test_find_snapshot(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    snapshots = [Snapshot(str(path)) for path in dstdir.listdir()]
+
+    assert find_snapshot(snapshots, 'sub/file').name == 'daily-20150102000000'
+    assert find_snapshot(snapshots, '/sub/file', datetime.datetime(2015, 1, 1, 12)).name == 'daily-20150101000000'
+    assert find_snapshot(snapshots, 'only-old').name == 'daily-20150101000000'
+    with pytest.raises(RestoreError):
+        find_snapshot(snapshots, 'sub/file', datetime.datetime(2014, 1, 1))
+    assert snapshot_path(snapshots[0], '/sub/file') == os.path.join(snapshots[0].dirpath, 'sub', 'file')
+
+
+def test_restorer_links_tree(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    source = str(dstdir.join('daily-20150102000000', 'sub'))
+    target = str(tmpdir.join('restored'))
+
+    restorer = Restorer(source, target, workers=2)
+    restorer.restore()
+
+    assert restorer.linked
+    assert restorer.files == 1
+    assert os.readlink(os.path.join(target, 'link')) == 'file'
+    assert os.path.samefile(os.path.join(source, 'file'), os.path.join(target, 'file'))
+
+
+def test_restorer_copies_tree(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    source = str(dstdir.join('daily-20150102000000', 'sub'))
+    os.utime(os.path.join(source, 'file'), ns=(10 ** 18, 10 ** 18))
+    target = str(tmpdir.join('restored'))
+
+    restorer = Restorer(source, target, workers=2, link=False, interval=0.001)
+    restorer.restore()
+
+    assert not restorer.linked
+    assert (restorer.files, restorer.bytes_copied) == (1, 3)
+    assert not os.path.samefile(os.path.join(source, 'file'), os.path.join(target, 'file'))
+    assert tmpdir.join('restored', 'file').read() == 'new'
+    assert os.stat(os.path.join(target, 'file')).st_mtime_ns == 10 ** 18
+
+
+def test_restorer_copies_special_files(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    source = str(dstdir.join('daily-20150102000000', 'sub'))
+    os.mkfifo(os.path.join(source, 'pipe'))
+    target = str(tmpdir.join('restored'))
+
+    Restorer(source, target, link=False).restore()
+
+    assert statmod.S_ISFIFO(os.stat(os.path.join(target, 'pipe')).st_mode)
+    assert os.readlink(os.path.join(target, 'link')) == 'file'
+    assert tmpdir.join('restored', 'file').read() == 'new'
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='changing owners requires root')
+def test_restorer_copies_owners(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    source = str(dstdir.join('daily-20150102000000'))
+    for path in (source, os.path.join(source, 'sub'), os.path.join(source, 'sub', 'link')):
+        os.chown(path, 1234, 1234, follow_symlinks=False)
+    os.utime(os.path.join(source, 'sub', 'link'), (1000, 1000), follow_symlinks=False)
+    target = str(tmpdir.join('restored'))
+
+    Restorer(source, target, link=False).restore()
+
+    for path in (target, os.path.join(target, 'sub'), os.path.join(target, 'sub', 'link')):
+        stat = os.lstat(path)
+        assert (stat.st_uid, stat.st_gid) == (1234, 1234)
+    assert os.lstat(os.path.join(target, 'sub', 'link')).st_mtime == 1000
+
+
+def test_restorer_across_devices(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    source = str(dstdir.join('daily-20150101000000', 'sub', 'file'))
+    target = str(tmpdir.join('restored'))
+    real_stat = os.stat
+
+    def other_device(path, **kwargs):
+        stat = real_stat(path, **kwargs)
+        return mock.Mock(st_dev=stat.st_dev + 1) if path == str(tmpdir) else stat
+
+    with mock.patch('os.stat', side_effect=other_device):
+        restorer = Restorer(source, target)
+        restorer.restore()
+
+    assert not restorer.linked
+    assert tmpdir.join('restored').read() == 'old'
+    assert not os.path.samefile(source, target)
+
+
+def test_restorer_symlink(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    target = str(tmpdir.join('restored'))
+
+    Restorer(str(dstdir.join('daily-20150101000000', 'sub', 'link')), target).restore()
+
+    assert os.readlink(target) == 'file'
+
+
+def test_restorer_refuses_existing_target(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+    with pytest.raises(RestoreError):
+        Restorer(str(dstdir.join('daily-20150101000000', 'sub')), str(dstdir.join('daily-20150102000000', 'sub'))).restore()
+    with pytest.raises(RestoreError):
+        Restorer(str(dstdir.join('daily-20150101000000', 'missing')), str(tmpdir.join('restored'))).restore()
+
+
+def test_restore_command(tmpdir):
+    dstdir = prepare_dstdir(tmpdir)
+
+    main(['restore', str(dstdir), 'sub/file', str(tmpdir.join('latest'))])
+    main(['restore', str(dstdir), 'sub/file', str(tmpdir.join('older')), '--at', '2015-01-01T12:00:00'])
+    main(['restore', str(dstdir.join('daily-20150102000000')), 'sub', str(tmpdir.join('copied')), '--copy'])
+
+    assert tmpdir.join('latest').read() == 'new'
+    assert tmpdir.join('older').read() == 'old'
+    assert tmpdir.join('copied', 'file').read() == 'new'
+    assert not os.path.samefile(str(dstdir.join('daily-20150102000000', 'sub', 'file')), str(tmpdir.join('copied', 'file')))
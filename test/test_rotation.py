@@ -0,0 +1,83 @@
+import os
+from unittest import mock
+
+import pytest
+from psnapshot.archive import staging_path
+from psnapshot.rotation import RotationExecutor, RotationPlan
+from psnapshot.state import write_json
+from psnapshot.trash import trash_path
+
+
+def prepare_dstdir(dstdir, *names):
+    for name in names:
+        os.mkdir(os.path.join(dstdir, name))
+
+
+def snapshot_names(dstdir):
+    return sorted(name for name in os.listdir(dstdir) if not name.startswith('.'))
+
+
+PLAN = RotationPlan([('daily-20150101000000', 'weekly-20150101000000')], ['weekly-20141101000000'])
+
+
+def test_rotation_executor_apply(tmpdir):
+    dstdir = str(tmpdir)
+    prepare_dstdir(dstdir, 'daily-20150101000000', 'weekly-20141101000000')
+
+    executor = RotationExecutor(dstdir)
+    executor.apply(PLAN)
+
+    assert snapshot_names(dstdir) == ['weekly-20150101000000']
+    assert len(os.listdir(trash_path(dstdir))) == 1
+    assert executor.pending() is None
+
+
+def test_rotation_executor_resume(tmpdir):
+    dstdir = str(tmpdir)
+    prepare_dstdir(dstdir, 'daily-20150101000000', 'weekly-20141101000000')
+
+    executor = RotationExecutor(dstdir)
+    # interrupted right after the first rename:
+    with mock.patch('psnapshot.rotation.move_to_trash', side_effect=KeyboardInterrupt()):
+        with pytest.raises(KeyboardInterrupt):
+            executor.apply(PLAN)
+    assert snapshot_names(dstdir) == ['weekly-20141101000000', 'weekly-20150101000000']
+    assert executor.pending()
+
+    executor = RotationExecutor(dstdir)
+    assert executor.resume()
+    assert snapshot_names(dstdir) == ['weekly-20150101000000']
+    assert executor.pending() is None
+    assert not executor.resume()
+
+
+def test_rotation_executor_rollback(tmpdir):
+    dstdir = str(tmpdir)
+    prepare_dstdir(dstdir, 'daily-20150101000000', 'weekly-20141101000000')
+
+    executor = RotationExecutor(dstdir)
+    executor.apply(PLAN)
+    # journal as left behind by a run interrupted after the last step:
+    trashed = os.listdir(trash_path(dstdir))[0]
+    write_json(executor.journal_path, {'version': 1, 'renames': PLAN.renames, 'deletes': [('weekly-20141101000000', trashed)]})
+
+    assert executor.rollback()
+    assert snapshot_names(dstdir) == ['daily-20150101000000', 'weekly-20141101000000']
+    assert os.listdir(trash_path(dstdir)) == []
+    assert executor.pending() is None
+
+
+def test_rotation_executor_archives(tmpdir):
+    dstdir = str(tmpdir)
+    prepare_dstdir(dstdir, 'weekly-20141101000000')
+    plan = RotationPlan(archives=['weekly-20141101000000'])
+
+    executor = RotationExecutor(dstdir)
+    executor.apply(plan)
+    assert snapshot_names(dstdir) == []
+    assert os.listdir(staging_path(dstdir)) == ['weekly-20141101000000']
+
+    write_json(executor.journal_path, {'version': 1, 'renames': [], 'deletes': [], 'archives': plan.archives})
+    assert executor.rollback()
+    assert snapshot_names(dstdir) == ['weekly-20141101000000']
+    assert plan.describe() == ['archive weekly-20141101000000']
@@ -0,0 +1,115 @@
+import os
+
+from psnapshot.exclude import ExcludeRules
+from psnapshot.scan import Manifest, TreeScanner
+
+
+def make_file(path, mtime):
+    with open(path, 'w') as file:
+        file.write('data')
+    os.utime(path, (mtime, mtime))
+
+
+def prepare_tree(root):
+    os.makedirs(os.path.join(root, 'a', 'b'))
+    os.mkdir(os.path.join(root, 'c'))
+    make_file(os.path.join(root, 'file-1'), 1000)
+    make_file(os.path.join(root, 'a', 'file-2'), 2000)
+    make_file(os.path.join(root, 'a', 'b', 'file-3'), 5000)
+    make_file(os.path.join(root, 'c', 'file-4'), 3000)
+    for dirpath in ('a/b', 'a', 'c', ''):
+        os.utime(os.path.join(root, dirpath), (500, 500))
+
+
+def test_tree_scanner_newest(tmpdir):
+    root = str(tmpdir)
+    prepare_tree(root)
+
+    assert TreeScanner(root).newest_mtime_ns() == 5000 * 1000000000
+    assert TreeScanner(root, workers=1, batch_size=1).newest_mtime_ns() == 5000 * 1000000000
+
+
+def test_tree_scanner_empty_dir_uses_root_time(tmpdir):
+    root = str(tmpdir)
+    os.utime(root, (1234, 1234))
+
+    assert TreeScanner(root).newest_mtime_ns() == 1234 * 1000000000
+
+
+def test_tree_scanner_limit(tmpdir):
+    root = str(tmpdir)
+    prepare_tree(root)
+
+    newest = TreeScanner(root).newest_mtime_ns(limit_ns=1500 * 1000000000)
+    assert newest >= 1500 * 1000000000
+
+    assert TreeScanner(root).newest_mtime_ns(limit_ns=6000 * 1000000000) == 5000 * 1000000000
+
+
+def test_tree_scanner_exclude(tmpdir):
+    root = str(tmpdir)
+    prepare_tree(root)
+
+    scanner = TreeScanner(root, exclude=ExcludeRules(['/a/b/', 'file-4']))
+    assert scanner.newest_mtime_ns() == 2000 * 1000000000
+    assert scanner.files == 2
+
+
+def test_tree_scanner_symlinked_dir_not_followed(tmpdir):
+    root = str(tmpdir.mkdir('root'))
+    other = str(tmpdir.mkdir('other'))
+    make_file(os.path.join(other, 'file'), 9000)
+    make_file(os.path.join(root, 'file'), 1000)
+    os.symlink(other, os.path.join(root, 'link'))
+    os.utime(root, (500, 500))
+
+    assert TreeScanner(root).newest_mtime_ns() == 1000 * 1000000000
+
+
+def test_tree_scanner_dangling_symlink(tmpdir):
+    root = str(tmpdir)
+    prepare_tree(root)
+    os.symlink('missing', os.path.join(root, 'a', 'dangling'))
+    os.utime(os.path.join(root, 'a', 'dangling'), (1500, 1500), follow_symlinks=False)
+    os.utime(os.path.join(root, 'a'), (500, 500))
+
+    scanner = TreeScanner(root)
+    assert scanner.newest_mtime_ns() == 5000 * 1000000000
+    assert scanner.files == 5
+
+
+def test_tree_scanner_manifest_skips_unchanged_dirs(tmpdir):
+    root = str(tmpdir.mkdir('root'))
+    prepare_tree(root)
+    path = str(tmpdir.join('manifest.json'))
+
+    scanner = TreeScanner(root, manifest=Manifest(root))
+    assert scanner.newest_mtime_ns() == 5000 * 1000000000
+    assert set(scanner.manifest.entries) == {'', 'a', os.path.join('a', 'b'), 'c'}
+    scanner.manifest.save(path)
+
+    # in-place modification keeps directory time and is not seen:
+    os.utime(os.path.join(root, 'c', 'file-4'), (7000, 7000))
+    assert TreeScanner(root, manifest=Manifest.load(path, root)).newest_mtime_ns() == 5000 * 1000000000
+
+    # a replaced file changes its directory:
+    make_file(os.path.join(root, 'c', 'file-5'), 8000)
+    os.utime(os.path.join(root, 'c'), (600, 600))
+    assert TreeScanner(root, manifest=Manifest.load(path, root)).newest_mtime_ns() == 8000 * 1000000000
+
+
+def test_manifest_load_invalid(tmpdir):
+    path = tmpdir.join('manifest.json')
+    assert Manifest.load(str(path), 'root') is None
+
+    path.write('{corrupt')
+    assert Manifest.load(str(path), 'root') is None
+
+    Manifest('other', {}, 0).save(str(path))
+    assert Manifest.load(str(path), 'root') is None
+    assert Manifest.load(str(path), 'other').root == 'other'
+
+    # records depend on exclude patterns:
+    Manifest('root', {}, 0, ['cache/']).save(str(path))
+    assert Manifest.load(str(path), 'root') is None
+    assert Manifest.load(str(path), 'root', ['cache/']).exclude == ['cache/']
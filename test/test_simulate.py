@@ -0,0 +1,38 @@
+import datetime
+
+from psnapshot.simulate import Simulation
+from psnapshot.snapshot import Queue
+
+
+def test_simulation_retains_queue_lengths():
+    simulation = Simulation([Queue.from_textual_spec('hourly[24]+1h'), Queue.from_textual_spec('daily[7]+1')])
+    simulation.run(datetime.datetime(2015, 1, 1), datetime.timedelta(minutes=30), 30 * 48)
+
+    hourly, daily = simulation.queues
+    assert simulation.runs == 30 * 48
+    assert simulation.created == 30 * 24
+    assert len(hourly.snapshots) == 24
+    assert len(daily.snapshots) == 7
+    assert simulation.expired == simulation.created - 31
+    assert hourly.snapshots[0].time == datetime.datetime(2015, 1, 30, 23, 0)
+    assert all(s.queue_name == 'daily' for s in daily.snapshots)
+
+
+def test_simulation_summary():
+    simulation = Simulation([Queue.from_textual_spec('daily[2]+1'), Queue.from_textual_spec('weekly[2]+7')])
+    simulation.run(datetime.datetime(2015, 1, 1), datetime.timedelta(days=1), 3)
+
+    lines = simulation.summary()
+    assert lines[1].split() == ['daily', '2/2', '0:00:00', '1', 'day,', '0:00:00', '1', 'day,', '0:00:00']
+    assert lines[2].split()[:2] == ['weekly', '1/2']
+    assert lines[-1] == '3 runs, 3 snapshots created, 0 expired, 3 retained.'
+
+
+def test_simulation_keeps_daily_gaps_near_a_day_fed_by_hourly_queue():
+    simulation = Simulation([Queue.from_textual_spec('hourly[48]+1h'), Queue.from_textual_spec('daily[14]+1')])
+    simulation.run(datetime.datetime(2015, 1, 1), datetime.timedelta(minutes=15), 30 * 96)
+
+    daily = list(simulation.queues[1].snapshots)
+    gaps = [newer.time - older.time for newer, older in zip(daily, daily[1:])]
+    assert len(daily) == 14
+    assert all(datetime.timedelta(hours=23.5) <= gap <= datetime.timedelta(hours=24.5) for gap in gaps)
@@ -1,10 +1,10 @@
 import datetime
-import shutil
 from unittest import mock
 
 import pytest
-from psnapshot.exceptions import SnapshotDirError, SourceDirError, DestinationDirError, QueueSpecError
-from psnapshot.snapshot import Snapshot, Organizer, Queue
+from psnapshot.exclude import NO_EXCLUDES
+from psnapshot.exceptions import SnapshotDirError, SourceDirError, DestinationDirError, QueueSpecError, CloneError
+from psnapshot.snapshot import Snapshot, Organizer, Queue, chain_queues, parse_period
 
 
 @mock.patch('psnapshot.snapshot.os')
@@ -72,16 +72,15 @@ def test_snapshot_move(mock_os):
 
 
 @mock.patch('psnapshot.snapshot.os')
-@mock.patch('psnapshot.snapshot.shutil')
-def test_snapshot_delete(mock_shutil, mock_os):
+@mock.patch('psnapshot.snapshot.move_to_trash')
+def test_snapshot_delete(mock_move_to_trash, mock_os):
     prepare_os_with_directory_list(mock_os)
     mock_os.rename = mock.MagicMock()
-    mock_shutil.rmtree = mock.MagicMock()
 
     s = Snapshot('queue1-20151029073630')
     s.delete()
 
-    mock_shutil.rmtree.assert_called_once_with('queue1-20151029073630')
+    mock_move_to_trash.assert_called_once_with('queue1-20151029073630')
     assert not s.dirpath
     assert not s.name
     assert not s.time
@@ -106,13 +105,46 @@ def test_queue_from_textual_spec():
         Queue.from_textual_spec(None)
 
 
+def test_queue_from_textual_spec_sub_day():
+    q = Queue.from_textual_spec('hourly[48]+1h')
+    assert q.name == 'hourly'
+    assert q.length == 48
+    assert q.period == datetime.timedelta(hours=1)
+    assert q.timedelta == datetime.timedelta(minutes=36)
+
+    q = Queue.from_textual_spec('15min[96]+15m')
+    assert q.name == '15min'
+    assert q.period == datetime.timedelta(minutes=15)
+
+    # tolerance is capped for long periods:
+    q = Queue.from_textual_spec('weekly[4]+1w')
+    assert q.timedelta == datetime.timedelta(days=6.6)
+    assert Queue.from_textual_spec('weekly[4]+7').timedelta == q.timedelta
+
+
+def test_chain_queues_limits_tolerance_to_feeding_period():
+    hourly, daily, weekly = chain_queues([Queue.from_textual_spec('hourly[24]+1h'), Queue.from_textual_spec('daily[7]+1'),
+                                          Queue.from_textual_spec('weekly[4]+1w')])
+    assert hourly.timedelta == datetime.timedelta(minutes=36)
+    assert daily.timedelta == datetime.timedelta(hours=23, minutes=36)
+    assert weekly.timedelta == datetime.timedelta(days=6.6)
+
+
+def test_parse_period():
+    assert parse_period('15m') == datetime.timedelta(minutes=15)
+    assert parse_period('2') == datetime.timedelta(days=2)
+
+    with pytest.raises(ValueError):
+        parse_period('1y')
+
+
 def test_queue_push_snapshot_first():
     mock_snapshot = mock.MagicMock()
 
     q = Queue(mock.sentinel.NAME, 1, 1)
     popped = q.push_snapshot(mock_snapshot)
 
-    assert q.snapshots == [mock_snapshot]
+    assert list(q.snapshots) == [mock_snapshot]
     mock_snapshot.move.assert_called_once_with(mock.sentinel.NAME)
     assert not mock_snapshot.delete.called
     assert not popped
@@ -129,7 +161,7 @@ def test_queue_push_snapshot_too_recent():
 
     popped = q.push_snapshot(mock_snapshot2)
 
-    assert q.snapshots == [mock_snapshot1]
+    assert list(q.snapshots) == [mock_snapshot1]
     assert not mock_snapshot1.delete.called
     assert mock_snapshot2.delete.called
     assert not popped
@@ -146,7 +178,7 @@ def test_queue_push_snapshot_accepted():
 
     popped = q.push_snapshot(mock_snapshot2)
 
-    assert q.snapshots == [mock_snapshot2, mock_snapshot1]
+    assert list(q.snapshots) == [mock_snapshot2, mock_snapshot1]
     assert not mock_snapshot1.delete.called
     assert not mock_snapshot2.delete.called
     assert not popped
@@ -163,7 +195,7 @@ def test_queue_push_snapshot_accepted_rounded():
 
     popped = q.push_snapshot(mock_snapshot2)
 
-    assert q.snapshots == [mock_snapshot2, mock_snapshot1]
+    assert list(q.snapshots) == [mock_snapshot2, mock_snapshot1]
     assert not mock_snapshot1.delete.called
     assert not mock_snapshot2.delete.called
     assert not popped
@@ -182,7 +214,7 @@ def test_queue_push_snapshot_length_exceeded():
 
     popped = q.push_snapshot(mock_snapshot3)
 
-    assert q.snapshots == [mock_snapshot3, mock_snapshot2]
+    assert list(q.snapshots) == [mock_snapshot3, mock_snapshot2]
     assert not mock_snapshot1.delete.called
     assert not mock_snapshot2.delete.called
     assert not mock_snapshot3.delete.called
@@ -202,7 +234,7 @@ def test_queue_push_snapshots():
 
     popped = q.push_snapshots([mock_snapshot3, mock_snapshot2])
 
-    assert q.snapshots == [mock_snapshot3]
+    assert list(q.snapshots) == [mock_snapshot3]
     assert not mock_snapshot1.delete.called
     assert not mock_snapshot2.delete.called
     assert not mock_snapshot3.delete.called
@@ -219,9 +251,20 @@ def prepare_os_with_directory_list(mock_os, *files):
     mock_os.path.join = mock.MagicMock(side_effect=lambda *args: args[-1])
 
 
+def prepare_index(mock_index, *names):
+    """Helper to set up snapshot index mock, which is missing unless snapshot names are given."""
+    if names:
+        mock_index.load.return_value.snapshots = names
+        mock_index.load.return_value.is_current = mock.MagicMock(return_value=True)
+    else:
+        mock_index.load.return_value = None
+
+
+@mock.patch('psnapshot.snapshot.SnapshotIndex')
 @mock.patch('psnapshot.snapshot.os')
-def test_organizer_find_snapshots_none(mock_os):
+def test_organizer_find_snapshots_none(mock_os, mock_index):
     prepare_os_with_directory_list(mock_os)
+    prepare_index(mock_index)
 
     queue = Queue(mock.sentinel.QUEUE_NAME, 1, mock.sentinel.QUEUE_LENGTH)
 
@@ -231,9 +274,11 @@ def test_organizer_find_snapshots_none(mock_os):
     assert len(queue.snapshots) == 0
 
 
+@mock.patch('psnapshot.snapshot.SnapshotIndex')
 @mock.patch('psnapshot.snapshot.os')
-def test_organizer_find_snapshots_wrong_name(mock_os):
+def test_organizer_find_snapshots_wrong_name(mock_os, mock_index):
     prepare_os_with_directory_list(mock_os, 'not-matching-name')
+    prepare_index(mock_index)
 
     queue = Queue(mock.sentinel.QUEUE_NAME, 1, mock.sentinel.QUEUE_LENGTH)
 
@@ -244,9 +289,11 @@ def test_organizer_find_snapshots_wrong_name(mock_os):
     mock_os.path.isdir.assert_called_once_with('not-matching-name')
 
 
+@mock.patch('psnapshot.snapshot.SnapshotIndex')
 @mock.patch('psnapshot.snapshot.os')
-def test_organizer_find_snapshots_unknown_queue(mock_os):
+def test_organizer_find_snapshots_unknown_queue(mock_os, mock_index):
     prepare_os_with_directory_list(mock_os, 'queueX-20150201100907')
+    prepare_index(mock_index)
 
     queue = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
 
@@ -256,9 +303,11 @@ def test_organizer_find_snapshots_unknown_queue(mock_os):
     assert len(queue.snapshots) == 0
 
 
+@mock.patch('psnapshot.snapshot.SnapshotIndex')
 @mock.patch('psnapshot.snapshot.os')
-def test_organizer_find_snapshots_ordered(mock_os):
+def test_organizer_find_snapshots_ordered(mock_os, mock_index):
     prepare_os_with_directory_list(mock_os, 'queue1-20150201100907', 'not-matching-name', 'queue1-20150201100908', 'queue1-20150201100906')
+    prepare_index(mock_index)
 
     queue = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
 
@@ -272,9 +321,11 @@ def test_organizer_find_snapshots_ordered(mock_os):
     assert queue.snapshots[2].name == 'queue1-20150201100906'
 
 
+@mock.patch('psnapshot.snapshot.SnapshotIndex')
 @mock.patch('psnapshot.snapshot.os')
-def test_organizer_find_snapshots_multiple_queues(mock_os):
+def test_organizer_find_snapshots_multiple_queues(mock_os, mock_index):
     prepare_os_with_directory_list(mock_os, 'queue1-20150201100907', 'queue2-20150201100906', 'queueX-20150201100908')
+    prepare_index(mock_index)
 
     queue1 = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
     queue2 = Queue('queue2', 1, mock.sentinel.QUEUE_LENGTH)
@@ -288,13 +339,53 @@ def test_organizer_find_snapshots_multiple_queues(mock_os):
     assert queue2.snapshots[0].name == 'queue2-20150201100906'
 
 
-@mock.patch('psnapshot.snapshot.shutil')
+def prepare_scanner(mock_scanner, time):
+    """Helper to set up tree scanner mock returning given time as newest modification."""
+    mock_scanner.return_value.newest_mtime_ns = mock.MagicMock(return_value=int(time.timestamp() * 1000000000))
+
+
+@mock.patch('psnapshot.snapshot.SnapshotIndex')
 @mock.patch('psnapshot.snapshot.os')
-def test_link_source_ok(mock_os, mock_shutil):
-    mock_shutil.copytree = mock.MagicMock(return_value=mock.sentinel.NEW_DESTINATION_PATH)
-    mock_shutil.Error = shutil.Error
+def test_organizer_find_snapshots_rebuilds_index(mock_os, mock_index):
+    prepare_os_with_directory_list(mock_os, 'queue1-20150201100907', 'not-matching-name')
+    prepare_index(mock_index)
+    mock_os.path.isdir = mock.MagicMock(side_effect=lambda p: p != 'not-matching-name')
+
+    organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (Queue('queue1', 1, 1),))
+    organizer.find_snapshots()
+
+    index = mock_index.prepare.return_value
+    mock_index.prepare.assert_called_once_with(mock.sentinel.DSTDIR)
+    assert index.snapshots == ['queue1-20150201100907']
+    assert index.others == ['not-matching-name']
+    index.save.assert_called_once_with()
+
+
+@mock.patch('psnapshot.snapshot.SnapshotIndex')
+@mock.patch('psnapshot.snapshot.os')
+def test_organizer_find_snapshots_from_index(mock_os, mock_index):
     prepare_os_with_directory_list(mock_os)
-    mock_os.path.getmtime = mock.MagicMock(return_value=datetime.datetime(2015, 1, 1).timestamp())
+    prepare_index(mock_index, 'queue1-20150201100907', 'queueX-20150201100909', 'queue1-20150201100908')
+
+    queue = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
+
+    organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (queue,))
+    organizer.find_snapshots()
+
+    assert [s.name for s in queue.snapshots] == ['queue1-20150201100908', 'queue1-20150201100907']
+    assert queue.snapshots[0].time == datetime.datetime(2015, 2, 1, 10, 9, 8)
+    assert organizer.unmapped_names == ['queueX-20150201100909']
+    assert not mock_os.listdir.called
+    assert not mock_os.path.isdir.called
+
+
+@mock.patch('psnapshot.snapshot.TreeCloner')
+@mock.patch('psnapshot.snapshot.TreeScanner')
+@mock.patch('psnapshot.snapshot.os')
+def test_link_source_ok(mock_os, mock_scanner, mock_cloner):
+    prepare_os_with_directory_list(mock_os)
+    prepare_scanner(mock_scanner, datetime.datetime(2015, 1, 1))
+    mock_os.path.isdir = mock.MagicMock(return_value=False)
 
     queue1 = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
     queue2 = Queue('queue2', 1, mock.sentinel.QUEUE_LENGTH)
@@ -302,57 +393,53 @@ def test_link_source_ok(mock_os, mock_shutil):
     organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (queue1, queue2))
     snapshot = organizer.create_snapshot()
 
-    mock_shutil.copytree.assert_called_once_with(mock.sentinel.SRCDIR, mock.ANY, copy_function=mock.sentinel.OS_LINK)
+    # built under temporary name and renamed once complete:
+    mock_cloner.assert_called_once_with(mock.sentinel.SRCDIR, 'build', resume=False, exclude=NO_EXCLUDES)
+    mock_cloner.return_value.clone.assert_called_once_with()
+    mock_os.rename.assert_called_once_with('build', 'queue1-20150101000000')
     assert snapshot
     assert snapshot.name == 'queue1-20150101000000'
 
 
-@mock.patch('psnapshot.snapshot.shutil')
+@mock.patch('psnapshot.snapshot.TreeCloner')
+@mock.patch('psnapshot.snapshot.TreeScanner')
 @mock.patch('psnapshot.snapshot.os')
-def test_link_source_error(mock_os, mock_shutil):
-    mock_shutil.copytree = mock.MagicMock(side_effect=shutil.Error)
-    mock_shutil.Error = shutil.Error
-    mock_shutil.rmtree = mock.MagicMock()
+def test_link_source_resumed(mock_os, mock_scanner, mock_cloner):
     prepare_os_with_directory_list(mock_os)
-    mock_os.path.getmtime = mock.MagicMock(return_value=datetime.datetime(2015, 1, 1).timestamp())
+    prepare_scanner(mock_scanner, datetime.datetime(2015, 1, 1))
 
-    queue1 = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
-    queue2 = Queue('queue2', 1, mock.sentinel.QUEUE_LENGTH)
-
-    organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (queue1, queue2))
+    organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (Queue('queue1', 1, 1),))
     snapshot = organizer.create_snapshot()
 
-    mock_shutil.copytree.assert_called_once_with(mock.sentinel.SRCDIR, mock.ANY, copy_function=mock.sentinel.OS_LINK)
-    mock_shutil.rmtree.assert_called_once_with('queue1-20150101000000', ignore_errors=mock.ANY)
-    assert not snapshot
+    mock_cloner.assert_called_once_with(mock.sentinel.SRCDIR, 'build', resume=True, exclude=NO_EXCLUDES)
+    assert snapshot.name == 'queue1-20150101000000'
 
 
+@mock.patch('psnapshot.snapshot.TreeCloner')
+@mock.patch('psnapshot.snapshot.TreeScanner')
 @mock.patch('psnapshot.snapshot.os')
-def test_organizer_srcdir_time_empty_dir(mock_os):
+def test_link_source_error(mock_os, mock_scanner, mock_cloner):
+    mock_cloner.return_value.clone = mock.MagicMock(side_effect=CloneError)
     prepare_os_with_directory_list(mock_os)
-    mock_os.path.getmtime = mock.MagicMock(return_value=datetime.datetime(2015, 1, 2, 3, 4, 5, 6).timestamp())
-    mock_os.walk = mock.MagicMock(return_value=[])
+    prepare_scanner(mock_scanner, datetime.datetime(2015, 1, 1))
 
     queue1 = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
     queue2 = Queue('queue2', 1, mock.sentinel.QUEUE_LENGTH)
 
     organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (queue1, queue2))
+    snapshot = organizer.create_snapshot()
 
-    assert organizer.srcdir_time == datetime.datetime(2015, 1, 2, 3, 4, 5)
-    mock_os.path.getmtime.assert_called_once_with(mock.sentinel.SRCDIR)
+    # incomplete tree is kept for the next run:
+    mock_cloner.return_value.clone.assert_called_once_with()
+    assert not mock_os.rename.called
+    assert not snapshot
 
 
+@mock.patch('psnapshot.snapshot.TreeScanner')
 @mock.patch('psnapshot.snapshot.os')
-def test_organizer_srcdir_time(mock_os):
+def test_organizer_srcdir_time(mock_os, mock_scanner):
     prepare_os_with_directory_list(mock_os)
-    mock_os.walk = mock.MagicMock(return_value=[(mock.sentinel.SRCDIR, [], (mock.sentinel.FILE1, mock.sentinel.FILE2))])
-
-    time = {
-        mock.sentinel.SRCDIR: datetime.datetime(2015, 1, 2),
-        mock.sentinel.FILE1: datetime.datetime(2015, 2, 3),
-        mock.sentinel.FILE2: datetime.datetime(2015, 3, 4, 10, 20, 30, 40),
-    }
-    mock_os.path.getmtime = mock.MagicMock(side_effect=lambda f: time[f].timestamp())
+    prepare_scanner(mock_scanner, datetime.datetime(2015, 3, 4, 10, 20, 30, 40))
 
     queue1 = Queue('queue1', 1, mock.sentinel.QUEUE_LENGTH)
     queue2 = Queue('queue2', 1, mock.sentinel.QUEUE_LENGTH)
@@ -360,6 +447,8 @@ def test_organizer_srcdir_time(mock_os):
     organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (queue1, queue2))
 
     assert organizer.srcdir_time == datetime.datetime(2015, 3, 4, 10, 20, 30)
+    mock_scanner.assert_called_once_with(mock.sentinel.SRCDIR, exclude=NO_EXCLUDES)
+    mock_scanner.return_value.newest_mtime_ns.assert_called_once_with()
 
 
 @mock.patch('psnapshot.snapshot.os')
@@ -379,26 +468,56 @@ def test_organizer_snapshots_time(mock_os):
     assert organizer.snapshots_time == datetime.datetime(2015, 1, 1, 10, 9, 6)
 
 
-@mock.patch('psnapshot.snapshot.os')
-def test_organizer_push_snapshot(mock_os):
+def prepare_rotation(mock_os):
+    """Helper to set up organizer with a full daily and an empty weekly queue."""
     prepare_os_with_directory_list(mock_os)
 
-    mock_queue1 = mock.MagicMock()
-    mock_queue2 = mock.MagicMock()
+    daily = Queue('daily', 1, 2)
+    weekly = Queue('weekly', 7, 2)
+    daily.snapshots = [Snapshot('daily-20150102000000'), Snapshot('daily-20150101000000')]
+    weekly.snapshots = [Snapshot('weekly-20141201000000'), Snapshot('weekly-20141101000000')]
 
-    organizer = Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (mock_queue1, mock_queue2))
+    return Organizer(mock.sentinel.SRCDIR, mock.sentinel.DSTDIR, (daily, weekly))
 
-    mock_snapshot_2a = mock.MagicMock()
-    mock_snapshot_2b = mock.MagicMock()
 
-    mock_queue1.push_snapshots = mock.MagicMock(return_value=(mock.sentinel.SNAPSHOT_1A, mock.sentinel.SNAPSHOT_1B))
-    mock_queue2.push_snapshots = mock.MagicMock(return_value=(mock_snapshot_2a, mock_snapshot_2b))
+@mock.patch('psnapshot.snapshot.RotationExecutor')
+@mock.patch('psnapshot.snapshot.os')
+def test_organizer_plan_push_changes_nothing(mock_os, mock_executor):
+    organizer = prepare_rotation(mock_os)
+    mock_os.rename = mock.MagicMock()
+
+    plan, _ = organizer.plan_push(Snapshot('daily-20150103000000'))
+
+    assert plan.renames == [('daily-20150101000000', 'weekly-20150101000000')]
+    assert plan.deletes == ['weekly-20141101000000']
+    assert plan.describe() == ['rename daily-20150101000000 -> weekly-20150101000000', 'delete weekly-20141101000000']
+    assert [s.name for s in organizer.queues[0].snapshots] == ['daily-20150102000000', 'daily-20150101000000']
+    assert not mock_os.rename.called
+    assert not mock_executor.called
+
+
+@mock.patch('psnapshot.snapshot.RotationExecutor')
+@mock.patch('psnapshot.snapshot.os')
+def test_organizer_push_snapshot(mock_os, mock_executor):
+    organizer = prepare_rotation(mock_os)
+
+    plan = organizer.push(Snapshot('daily-20150103000000'))
+
+    mock_executor.assert_called_once_with(mock.sentinel.DSTDIR)
+    mock_executor.return_value.apply.assert_called_once_with(plan)
+    assert [s.name for s in organizer.queues[0].snapshots] == ['daily-20150103000000', 'daily-20150102000000']
+    assert [s.name for s in organizer.queues[1].snapshots] == ['weekly-20150101000000', 'weekly-20141201000000']
+
+
+@mock.patch('psnapshot.snapshot.RotationExecutor')
+@mock.patch('psnapshot.snapshot.os')
+def test_organizer_push_snapshot_dry_run(mock_os, mock_executor):
+    organizer = prepare_rotation(mock_os)
 
-    organizer.push(mock.sentinel.SNAPSHOT)
+    plan = organizer.push(Snapshot('daily-20150103000000'), dry_run=True)
 
-    mock_queue1.push_snapshots.assert_called_once_with((mock.sentinel.SNAPSHOT,))
-    mock_queue2.push_snapshots.assert_called_once_with((mock.sentinel.SNAPSHOT_1A, mock.sentinel.SNAPSHOT_1B))
-    assert mock_snapshot_2a.delete.called
-    assert mock_snapshot_2b.delete.called
+    assert plan.deletes == ['weekly-20141101000000']
+    assert not mock_executor.called
+    assert [s.name for s in organizer.queues[1].snapshots] == ['weekly-20141201000000', 'weekly-20141101000000']
 
 # TODO: implement top-level control and test
@@ -0,0 +1,51 @@
+import os
+
+from psnapshot.trash import Reaper, move_to_trash, trash_path
+
+
+def prepare_trash(dstdir, count):
+    for index in range(count):
+        snapshot = os.path.join(dstdir, 'queue-2015010100000{}'.format(index))
+        os.makedirs(os.path.join(snapshot, 'subdir'))
+        with open(os.path.join(snapshot, 'subdir', 'file'), 'w') as file:
+            file.write('data')
+        os.symlink('subdir', os.path.join(snapshot, 'link'))
+        move_to_trash(snapshot)
+
+
+def test_move_to_trash(tmpdir):
+    dstdir = str(tmpdir)
+    prepare_trash(dstdir, 2)
+
+    assert os.listdir(dstdir) == ['.trash']
+    names = os.listdir(trash_path(dstdir))
+    assert len(names) == 2
+    assert all(name.startswith('queue-2015010100000') for name in names)
+
+
+def test_reaper_empties_trash(tmpdir):
+    dstdir = str(tmpdir)
+    prepare_trash(dstdir, 2)
+
+    reaper = Reaper(trash_path(dstdir))
+    assert reaper.reap()
+    assert reaper.removed == 4
+    assert reaper.bytes_freed == 2 * (4 + len('subdir'))
+    assert os.listdir(dstdir) == []
+
+
+def test_reaper_missing_trash(tmpdir):
+    assert Reaper(trash_path(str(tmpdir))).reap()
+
+
+def test_reaper_timeout_resumed(tmpdir):
+    dstdir = str(tmpdir)
+    prepare_trash(dstdir, 2)
+
+    reaper = Reaper(trash_path(dstdir), timeout=0)
+    assert not reaper.reap()
+    assert reaper.removed == 1
+    assert len(os.listdir(trash_path(dstdir))) == 2
+
+    assert Reaper(trash_path(dstdir)).reap()
+    assert os.listdir(dstdir) == []
@@ -0,0 +1,67 @@
+import datetime
+import os
+from unittest import mock
+
+from psnapshot.usage import InodeTable, snapshot_usage
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def prepare_snapshots(tmpdir):
+    """Source with two snapshots, the newer one sharing all files with source."""
+    srcdir = tmpdir.mkdir('src')
+    dstdir = tmpdir.mkdir('dst')
+    old = dstdir.mkdir('daily-20150101000000')
+    new = dstdir.mkdir('daily-20150102000000')
+
+    write(str(old.join('only-old')), '1' * 10)
+    write(str(old.join('kept')), '2' * 100)
+    os.link(str(old.join('only-old')), str(old.join('only-old-twice')))
+    write(str(srcdir.join('current')), '3' * 1000)
+    for name in ('kept', 'current'):
+        source = old.join(name) if name == 'kept' else srcdir.join(name)
+        os.link(str(source), str(new.join(name)))
+    os.link(str(old.join('kept')), str(srcdir.join('kept')))
+
+    snapshots = [mock.MagicMock(dirpath=str(new), time=datetime.datetime(2015, 1, 2)),
+                 mock.MagicMock(dirpath=str(old), time=datetime.datetime(2015, 1, 1))]
+    return str(dstdir), snapshots
+
+
+def test_snapshot_usage(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+
+    assert snapshot_usage(dstdir, snapshots) == [(0, 1100), (10, 100)]
+
+
+def test_snapshot_usage_cached(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+    snapshot_usage(dstdir, snapshots)
+
+    with mock.patch.object(InodeTable, 'scan') as mock_scan:
+        assert snapshot_usage(dstdir, snapshots) == [(0, 1100), (10, 100)]
+        assert not mock_scan.called
+
+    # cache of expired snapshot is dropped:
+    snapshot_usage(dstdir, snapshots[:1])
+    assert os.listdir(os.path.join(dstdir, '.psnapshot', 'usage')) == ['20150102000000']
+
+
+def test_inode_table_roundtrip(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+    path = str(tmpdir.join('table'))
+
+    table = InodeTable.scan(snapshots[1].dirpath)
+    table.save(path)
+    loaded = InodeTable.load(path)
+
+    assert sorted(loaded.sizes) == [10, 100]
+    assert sorted(loaded.counts) == [1, 2]
+    assert list(loaded.inodes) == list(table.inodes)
+    assert loaded.scan_ns == table.scan_ns
+
+    tmpdir.join('corrupt').write('x')
+    assert InodeTable.load(str(tmpdir.join('corrupt'))) is None
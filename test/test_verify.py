@@ -0,0 +1,101 @@
+import datetime
+import os
+from unittest import mock
+
+from psnapshot.verify import ADDED, MALFORMED, MISSING, MODIFIED, HashCache, Problem, Verifier, load_manifest, save_manifest
+
+
+def write(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def prepare_snapshots(tmpdir):
+    """Two snapshots sharing a hard-linked file."""
+    dstdir = tmpdir.mkdir('dst')
+    old = dstdir.mkdir('daily-20150101000000')
+    new = dstdir.mkdir('daily-20150102000000')
+
+    old.mkdir('sub')
+    write(str(old.join('sub', 'kept')), 'kept')
+    write(str(old.join('only-old')), 'old')
+    new.mkdir('sub')
+    os.link(str(old.join('sub', 'kept')), str(new.join('sub', 'kept')))
+    write(str(new.join('only-new')), 'new')
+
+    snapshots = [mock.MagicMock(dirpath=str(new), time=datetime.datetime(2015, 1, 2)),
+                 mock.MagicMock(dirpath=str(old), time=datetime.datetime(2015, 1, 1))]
+    return str(dstdir), snapshots
+
+
+def test_verify_records_manifests(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+    verifier = Verifier(dstdir, workers=2)
+
+    assert verifier.verify(snapshots) == [[], []]
+    # hard-linked file is hashed once:
+    assert verifier.hashed == 3
+
+    manifest = load_manifest(os.path.join(dstdir, '.psnapshot', 'checksums', '20150102000000'))
+    assert sorted(manifest) == ['only-new', os.path.join('sub', 'kept')]
+
+
+def test_verify_uses_cached_hashes(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+    Verifier(dstdir, workers=2).verify(snapshots)
+
+    write(os.path.join(snapshots[0].dirpath, 'added'), 'added')
+    verifier = Verifier(dstdir, workers=2)
+    assert verifier.verify(snapshots) == [[Problem(ADDED, 'added')], []]
+    assert verifier.hashed == 1
+
+    verifier = Verifier(dstdir, workers=2, rehash=True)
+    verifier.verify(snapshots)
+    assert verifier.hashed == 4
+
+
+def test_verify_detects_changes(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+    Verifier(dstdir, workers=2).verify(snapshots)
+
+    os.unlink(os.path.join(snapshots[1].dirpath, 'only-old'))
+    write(os.path.join(snapshots[1].dirpath, 'sub', 'kept'), 'changed')
+
+    assert Verifier(dstdir, workers=2).verify(snapshots) == [
+        [Problem(MODIFIED, os.path.join('sub', 'kept'))],
+        [Problem(MISSING, 'only-old'), Problem(MODIFIED, os.path.join('sub', 'kept'))],
+    ]
+
+
+def test_verify_reports_malformed_manifest_lines(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+    Verifier(dstdir, workers=2).verify(snapshots)
+
+    path = os.path.join(dstdir, '.psnapshot', 'checksums', '20150101000000')
+    with open(path, 'a') as file:
+        file.write('garbage\n')
+
+    assert Verifier(dstdir, workers=2).verify(snapshots) == [[], [Problem(MALFORMED, 'line 3')]]
+
+
+def test_verify_drops_expired(tmpdir):
+    dstdir, snapshots = prepare_snapshots(tmpdir)
+    Verifier(dstdir, workers=2).verify(snapshots)
+    Verifier(dstdir, workers=2).verify(snapshots[:1])
+
+    assert os.listdir(os.path.join(dstdir, '.psnapshot', 'checksums')) == ['20150102000000']
+    cache = HashCache(os.path.join(dstdir, '.psnapshot', HashCache.FILENAME))
+    try:
+        assert cache._db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0] == 2
+    finally:
+        cache.close()
+
+
+def test_manifest_roundtrip(tmpdir):
+    path = str(tmpdir.join('manifest'))
+    digests = {'a  b': '00', os.path.join('sub', '\udcff'): '11'}
+
+    save_manifest(path, digests)
+
+    assert load_manifest(path) == digests
+    assert load_manifest(str(tmpdir.join('missing'))) is None
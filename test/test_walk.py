@@ -0,0 +1,50 @@
+import os
+import threading
+
+import pytest
+from psnapshot.walk import DirectoryRecord, opened_directory, walk_parallel
+
+
+def test_walk_parallel_visits_all():
+    def visit(number):
+        return number, [number * 2 + 1, number * 2 + 2] if number < 100 else []
+
+    assert sorted(walk_parallel(visit, [0], workers=3, batch_size=4)) == list(range(201))
+
+
+def test_walk_parallel_applies_back_pressure():
+    lock = threading.Lock()
+    visited = []
+
+    def visit(number):
+        with lock:
+            visited.append(number)
+        return number, [number * 2 + 1, number * 2 + 2]
+
+    results = walk_parallel(visit, [0], workers=2)
+    for _ in range(3):
+        next(results)
+    # beyond the consumed results, only the tasks in flight are visited while the caller does not consume more:
+    threading.Event().wait(0.1)
+    assert len(visited) <= 3 + 2 * 2
+    results.close()
+
+
+def test_opened_directory(tmpdir):
+    os.mkdir(os.path.join(str(tmpdir), 'sub'))
+    root_fd = os.open(str(tmpdir), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        with opened_directory('sub', root_fd) as fd:
+            assert os.listdir(fd) == []
+        with pytest.raises(OSError):
+            os.fstat(fd)
+    finally:
+        os.close(root_fd)
+
+
+def test_directory_record_from_stat(tmpdir):
+    stat = os.stat(str(tmpdir))
+    record = DirectoryRecord.from_stat('a', stat)
+
+    assert (record.relpath, record.mode, record.uid, record.mtime_ns) == ('a', stat.st_mode, stat.st_uid, stat.st_mtime_ns)
+    assert not hasattr(record, '__dict__')